@@ -0,0 +1,151 @@
+import asyncio
+import functools
+import logging
+import random
+import signal
+from typing import Callable
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+import backends as backends
+import config as config
+import metrics as metrics
+from bot import RagBot
+from scheduler import create_async_scheduler
+from streaming import AsyncThrottledEditor
+
+
+def configure_async_telegram_api() -> None:
+    """Timeouts, connection pool and server of the aiohttp Bot API client"""
+    asyncio_helper.REQUEST_TIMEOUT = config.TELEGRAM_READ_TIMEOUT
+    # Connections kept by the shared aiohttp session
+    asyncio_helper.REQUEST_LIMIT = config.TELEGRAM_POOL_SIZE
+    if config.TELEGRAM_API_URL:
+        base = config.TELEGRAM_API_URL.rstrip("/")
+        asyncio_helper.API_URL = f"{base}/bot{{0}}/{{1}}"
+        asyncio_helper.FILE_URL = f"{base}/file/bot{{0}}/{{1}}"
+
+
+class AsyncRagBot(RagBot):
+    """Asyncio variant of RagBot: many chats are answered concurrently in one process"""
+
+    def _create_bot(self, token: str) -> AsyncTeleBot:
+        configure_async_telegram_api()
+        return AsyncTeleBot(token)
+
+    def _create_scheduler(self):
+        # Jobs of one chat run one at a time, in priority and arrival order
+        return create_async_scheduler()
+
+    def _handler(self, handler: Callable) -> Callable:
+        """Shared sync handler as the coroutine AsyncTeleBot awaits"""
+
+        @functools.wraps(handler)
+        async def handle(message):
+            handler(message)
+
+        return handle
+
+    def _answer_method(self, kind: str) -> Callable:
+        if kind == "search":
+            return self.processor.aprocess_web_search
+        return self.processor.aprocess_query
+
+    async def _execute_command(
+        self, kind: str, message, username: str, text: str
+    ) -> None:
+        with metrics.span(f"command:{kind}"):
+            await self._run_command(kind, message, username, text)
+
+    async def _run_command(self, kind: str, message, username: str, text: str) -> None:
+        chat_id = message.chat.id
+        if kind == "remember":
+            await self.bot.reply_to(message, self._remember(message, username, text))
+            return
+
+        await self.bot.send_chat_action(chat_id, "typing")
+
+        if config.STREAM_ANSWERS:
+            await self._stream_answer(kind, message, username, text)
+            return
+
+        reply_msg = await self.bot.reply_to(
+            message, random.choice(config.PENDING_MESSAGES)
+        )
+        try:
+            answer = await self._answer_method(kind)(
+                chat_id,
+                message.message_id,
+                reply_msg.message_id,
+                username,
+                text,
+                self.bot_username,
+            )
+        except Exception as e:
+            answer = self._fallback(kind, e)
+        await self.bot.edit_message_text(
+            answer, chat_id=chat_id, message_id=reply_msg.message_id
+        )
+
+    async def _stream_answer(
+        self, kind: str, message, username: str, text: str
+    ) -> None:
+        """Answer via the streaming LLM path, editing the placeholder as text arrives"""
+        chat_id = message.chat.id
+        reply_msg = await self.bot.reply_to(
+            message, random.choice(config.PENDING_MESSAGES)
+        )
+        editor = AsyncThrottledEditor(
+            lambda partial: self.bot.edit_message_text(
+                partial, chat_id=chat_id, message_id=reply_msg.message_id
+            ),
+            can_edit=lambda: self.limiter.is_ready(chat_id),
+        )
+        answer = ""
+        try:
+            async for answer in self.processor.astream_answer(
+                chat_id, username, text, self.bot_username, web_search=kind == "search"
+            ):
+                await editor.update(answer)
+        except Exception as e:
+            fallback = self._fallback(kind, e)
+            # Whatever was streamed stays; the placeholder alone does not
+            if not answer:
+                answer = fallback
+        await editor.finish(answer)
+
+    async def run(self) -> None:
+        """Start the bot and begin polling for messages"""
+        logging.info("Бот запущен (asyncio)")
+        # docker stop sends SIGTERM: cancel polling so pending docs get indexed
+        task = asyncio.current_task()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+        try:
+            await self.bot.infinity_polling(timeout=20, skip_pending=False)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            logging.info("Бот остановлен, дописываю очередь индексации")
+            await self.scheduler.close()
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.processor.shutdown
+            )
+            await self.bot.close_session()
+
+
+def main():
+    """Entry point for the asyncio runtime"""
+    metrics.start_metrics_server()
+    # Polling starts right away; models load in the background or on first use
+    if config.WARM_UP_MODELS:
+        backends.warm_up()
+    bot = AsyncRagBot(
+        token=config.TELEGRAM_TOKEN,
+        bot_username=config.BOT_USERNAME,
+        history_size=getattr(config, "N_LAST_MESSAGES", 10),
+    )
+    logging.info("Бот инициализирован")
+    asyncio.run(bot.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+"""
+Pluggable backends for the LLM, embeddings and web search.
+
+Production uses Together, SentenceTransformer and DuckDuckGo, optionally
+with a small llama.cpp model on CPU next to the remote LLM. The offline
+stand-ins (LLM_BACKEND=fake, EMBEDDING_BACKEND=hash, SEARCH_BACKEND=canned or
+fixture, QDRANT_BACKEND=memory) make the bot runnable and measurable without network.
+
+Backends are built lazily through get_llm(), get_embed_model(),
+get_search_tool() and get_tokenizer(): on first use or by the warm_up()
+thread, whichever comes first. readiness() reports what has been loaded.
+"""
+
+import asyncio
+import hashlib
+import logging
+import math
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from llama_index.core.base.llms.types import (
+    CompletionResponse,
+    CompletionResponseGen,
+    LLMMetadata,
+)
+from llama_index.core import Settings
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.llms import CustomLLM
+from llama_index.core.llms.callbacks import llm_completion_callback
+
+import config as config
+import metrics as metrics
+from resilience import create_resilient_llm
+
+CANNED_SEARCH_RESULTS = [
+    {
+        "title": "Погода в Москве на неделю",
+        "href": "https://example.com/weather",
+        "body": "Завтра в Москве +5, облачно, небольшой дождь к вечеру.",
+    },
+    {
+        "title": "Курс доллара сегодня",
+        "href": "https://example.com/usd",
+        "body": "Официальный курс ЦБ на сегодня — 92 рубля за доллар.",
+    },
+    {
+        "title": "Рецепт шаурмы дома",
+        "href": "https://example.com/shawarma",
+        "body": "Лаваш, курица, чесночный соус, огурцы и помидоры.",
+    },
+]
+
+
+class FakeLLM(CustomLLM):
+    """LLM stand-in that answers after a configurable delay"""
+
+    latency: float = 1.0
+    tokens_per_second: float = 50.0
+    answer: str = (
+        "ну ты и вопросы задаёшь, конечно. ладно, держи ответ, но это было тупо"
+    )
+    context_window: int = 8000
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(context_window=self.context_window, model_name="fake")
+
+    def _tokens(self) -> List[str]:
+        return re.findall(r"\S+\s*", self.answer)
+
+    def _token_delay(self) -> float:
+        return 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    @llm_completion_callback()
+    def complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        time.sleep(self.latency + self._token_delay() * len(self._tokens()))
+        return CompletionResponse(text=self.answer)
+
+    @llm_completion_callback()
+    def stream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        time.sleep(self.latency)
+        text = ""
+        for token in self._tokens():
+            time.sleep(self._token_delay())
+            text += token
+            yield CompletionResponse(text=text, delta=token)
+
+    async def acomplete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        await asyncio.sleep(self.latency + self._token_delay() * len(self._tokens()))
+        return CompletionResponse(text=self.answer)
+
+    async def astream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ):
+        async def gen():
+            await asyncio.sleep(self.latency)
+            text = ""
+            for token in self._tokens():
+                await asyncio.sleep(self._token_delay())
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+
+        return gen()
+
+
+class HashEmbedding(BaseEmbedding):
+    """Hashed bag-of-words embedding: no model, same 1024 dimensions"""
+
+    dim: int = 1024
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dim
+        for token in re.findall(r"\w+", text.lower()):
+            digest = hashlib.md5(token.encode("utf-8")).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dim
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        with metrics.span("embed", texts=1):
+            return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        with metrics.span("embed", texts=1):
+            return self._embed(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        with metrics.span("embed", texts=len(texts)):
+            return [self._embed(t) for t in texts]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class CannedSearchProvider:
+    """Web search stand-in returning fixed results after a configurable delay"""
+
+    name = "canned"
+
+    def __init__(self, latency: float = 0.5, results: list = None):
+        self.latency = latency
+        self.results = results if results is not None else CANNED_SEARCH_RESULTS
+
+    def search(self, query: str, region: str) -> list:
+        time.sleep(self.latency)
+        return list(self.results)
+
+
+def build_llm(model: Optional[str] = None):
+    """LLM selected by config.LLM_BACKEND; model overrides config.LLM_MODEL"""
+    if config.LLM_BACKEND == "fake":
+        return FakeLLM(
+            context_window=config.LLM_CONTEXT_WINDOW,
+            latency=config.FAKE_LLM_LATENCY,
+            tokens_per_second=config.FAKE_LLM_TOKENS_PER_SECOND,
+        )
+    from llama_index.llms.together import TogetherLLM
+
+    kwargs = {"api_base": config.TOGETHER_API_BASE} if config.TOGETHER_API_BASE else {}
+    return TogetherLLM(
+        model=model or config.LLM_MODEL,
+        api_key=config.TOGETHER_API_KEY,
+        context_window=config.LLM_CONTEXT_WINDOW,
+        # One attempt per request: ResilientLLM retries, hedges and gives up
+        timeout=config.LLM_ATTEMPT_TIMEOUT,
+        max_retries=0,
+        **kwargs,
+    )
+
+
+def build_local_llm():
+    """Small local LLM selected by config.LOCAL_LLM_BACKEND"""
+    if config.LOCAL_LLM_BACKEND == "fake":
+        return FakeLLM(
+            context_window=config.LOCAL_LLM_CONTEXT_WINDOW,
+            latency=config.FAKE_LOCAL_LLM_LATENCY,
+            tokens_per_second=4 * config.FAKE_LLM_TOKENS_PER_SECOND,
+            answer="хз, спроси попозже, сейчас думать лень",
+        )
+    if config.LOCAL_LLM_BACKEND != "llama_cpp":
+        raise ValueError(f"Неизвестная локальная модель {config.LOCAL_LLM_BACKEND!r}")
+    if not config.LOCAL_LLM_MODEL_PATH:
+        # Without a path LlamaCPP would download its default model
+        raise ValueError("Для LOCAL_LLM_BACKEND=llama_cpp нужен LOCAL_LLM_MODEL_PATH")
+    from llama_index.llms.llama_cpp import LlamaCPP
+
+    model_kwargs = {"n_gpu_layers": 0}
+    if config.LOCAL_LLM_THREADS:
+        model_kwargs["n_threads"] = config.LOCAL_LLM_THREADS
+    return LlamaCPP(
+        model_path=config.LOCAL_LLM_MODEL_PATH,
+        temperature=config.LOCAL_LLM_TEMPERATURE,
+        max_new_tokens=config.LOCAL_LLM_MAX_TOKENS,
+        context_window=config.LOCAL_LLM_CONTEXT_WINDOW,
+        model_kwargs=model_kwargs,
+        verbose=False,
+    )
+
+
+def build_embed_model():
+    """Embedding model selected by config.EMBEDDING_BACKEND"""
+    if config.EMBEDDING_BACKEND == "hash":
+        return HashEmbedding(embed_batch_size=config.EMBED_BATCH_SIZE)
+    from llm_interface import SentenceTransformerEmbeddings
+
+    return SentenceTransformerEmbeddings(
+        embed_batch_size=config.EMBED_BATCH_SIZE,
+        cache_memory_mb=config.EMBED_CACHE_MEMORY_MB,
+        cache_dir=config.EMBED_CACHE_DIR or None,
+        cache_disk_mb=config.EMBED_CACHE_DISK_MAX_MB,
+        backend=config.EMBED_INFERENCE_BACKEND,
+        num_threads=config.EMBED_NUM_THREADS,
+        max_seq_length=config.EMBED_MAX_SEQ_LENGTH,
+        onnx_dir=config.EMBED_ONNX_DIR,
+        quantization_config=config.EMBED_QUANTIZATION_CONFIG,
+        fp32_tolerance=config.EMBED_FP32_TOLERANCE,
+        batch_max_items=config.EMBED_BATCH_MAX_ITEMS,
+        batch_max_delay=config.EMBED_BATCH_MAX_DELAY_MS / 1000,
+        batch_max_pending=config.EMBED_BATCH_MAX_PENDING,
+    )
+
+
+def build_search_provider(name: str):
+    """One web search provider: duckduckgo | google | canned | fixture"""
+    import search
+
+    if name == "canned":
+        return CannedSearchProvider(latency=config.FAKE_SEARCH_LATENCY)
+    if name == "fixture":
+        return search.FixtureProvider(config.SEARCH_FIXTURE_PATH)
+    if name == "google":
+        return search.GoogleProvider(
+            config.GOOGLE_API_KEY,
+            config.SEARCH_ENGINE,
+            max_results=config.SEARCH_MAX_RESULTS,
+            timeout=config.SEARCH_TIMEOUT,
+        )
+    if name == "duckduckgo":
+        return search.DuckDuckGoProvider(
+            max_results=config.SEARCH_MAX_RESULTS, timeout=config.SEARCH_TIMEOUT
+        )
+    raise ValueError(f"Неизвестный поисковый бэкенд {name!r}")
+
+
+def build_search_tool():
+    """Cached web search over config.SEARCH_BACKEND and its fallback"""
+    import search
+
+    names = [config.SEARCH_BACKEND]
+    if config.SEARCH_FALLBACK_BACKEND:
+        names.append(config.SEARCH_FALLBACK_BACKEND)
+    cache = None
+    if config.SEARCH_CACHE_TTL > 0:
+        cache = search.SearchCache(
+            ttl=config.SEARCH_CACHE_TTL,
+            max_entries=config.SEARCH_CACHE_MAX_ENTRIES,
+            disk_path=config.SEARCH_CACHE_DIR or None,
+        )
+    return search.WebSearch(
+        [build_search_provider(name) for name in names],
+        cache=cache,
+        timeout=config.SEARCH_TIMEOUT,
+    )
+
+
+def build_cross_encoder():
+    """CPU cross-encoder that scores (query, chunk) pairs for re-ranking"""
+    from sentence_transformers import CrossEncoder
+
+    return CrossEncoder(
+        config.RERANK_CROSS_ENCODER_MODEL,
+        max_length=config.RERANK_CROSS_ENCODER_MAX_LENGTH,
+        device="cpu",
+    )
+
+
+class _LazyBackend:
+    """Builds a backend once, on first use or from the warm-up thread"""
+
+    def __init__(self, name: str, factory: Callable[[], Any]):
+        self.name = name
+        self._factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+        self.load_seconds: Optional[float] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._value is not None
+
+    def get(self):
+        if self._value is None:
+            with self._lock:
+                # Another thread may have finished loading while we waited
+                if self._value is None:
+                    started = time.perf_counter()
+                    with metrics.span(f"load:{self.name}"):
+                        value = self._factory()
+                    self.load_seconds = time.perf_counter() - started
+                    self._value = value
+                    logging.info(f"{self.name} загружен за {self.load_seconds:.1f}с")
+        return self._value
+
+    async def aget(self):
+        """Like get(), but loads in the default executor to keep the loop free"""
+        if self._value is not None:
+            return self._value
+        return await asyncio.get_running_loop().run_in_executor(None, self.get)
+
+
+def _load_embed_model():
+    model = build_embed_model()
+    # llama_index components without an explicit model fall back to Settings
+    Settings.embed_model = model
+    return model
+
+
+def _load_llm():
+    llm = build_llm()
+    Settings.llm = llm
+    return create_resilient_llm(llm)
+
+
+def _load_tokenizer():
+    # Prompt budgets are counted with llama_index's tokenizer (tiktoken);
+    # the first call loads the BPE ranks, so it is done here
+    tokenizer = Settings.tokenizer
+    tokenizer("warm up")
+    return tokenizer
+
+
+# Order matters for warm-up: embeddings are needed first, by background indexing
+_BACKENDS: Dict[str, _LazyBackend] = {
+    "embed_model": _LazyBackend("embed_model", _load_embed_model),
+    "llm": _LazyBackend("llm", _load_llm),
+    "search_tool": _LazyBackend("search_tool", build_search_tool),
+    "tokenizer": _LazyBackend("tokenizer", _load_tokenizer),
+}
+if config.SUMMARIES_ENABLED and config.SUMMARY_LLM_MODEL:
+    _BACKENDS["summary_llm"] = _LazyBackend(
+        "summary_llm",
+        lambda: create_resilient_llm(
+            build_llm(config.SUMMARY_LLM_MODEL), "summary_llm"
+        ),
+    )
+if config.LOCAL_LLM_BACKEND:
+    _BACKENDS["local_llm"] = _LazyBackend("local_llm", build_local_llm)
+if config.RERANK_CROSS_ENCODER_MODEL:
+    _BACKENDS["cross_encoder"] = _LazyBackend("cross_encoder", build_cross_encoder)
+
+
+def get_embed_model() -> BaseEmbedding:
+    return _BACKENDS["embed_model"].get()
+
+
+def get_llm():
+    return _BACKENDS["llm"].get()
+
+
+def get_search_tool():
+    return _BACKENDS["search_tool"].get()
+
+
+async def aget_embed_model() -> BaseEmbedding:
+    return await _BACKENDS["embed_model"].aget()
+
+
+async def aget_llm():
+    return await _BACKENDS["llm"].aget()
+
+
+async def aget_search_tool():
+    return await _BACKENDS["search_tool"].aget()
+
+
+def get_tokenizer() -> Callable[[str], List]:
+    return _BACKENDS["tokenizer"].get()
+
+
+def get_summary_llm():
+    """Cheaper LLM for background summaries, or the main one"""
+    if "summary_llm" in _BACKENDS:
+        return _BACKENDS["summary_llm"].get()
+    return get_llm()
+
+
+def get_local_llm():
+    """Local CPU model; only registered when LOCAL_LLM_BACKEND is set"""
+    return _BACKENDS["local_llm"].get()
+
+
+def get_cross_encoder():
+    return _BACKENDS["cross_encoder"].get()
+
+
+def readiness() -> Dict[str, bool]:
+    """Which backends have been loaded"""
+    return {name: backend.loaded for name, backend in _BACKENDS.items()}
+
+
+def load_times() -> Dict[str, Optional[float]]:
+    """Seconds each loaded backend took to build"""
+    return {name: backend.load_seconds for name, backend in _BACKENDS.items()}
+
+
+def warm_up() -> threading.Thread:
+    """Load every backend in a daemon thread; requests never wait for it to start"""
+
+    def run():
+        for backend in _BACKENDS.values():
+            try:
+                backend.get()
+            except Exception:
+                # Not fatal: the first request that needs it will retry and fail loudly
+                logging.exception(f"Не удалось заранее загрузить {backend.name}")
+        logging.info("Модели прогреты")
+
+    thread = threading.Thread(target=run, name="model-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+metrics.set_readiness_check(readiness)
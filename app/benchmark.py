@@ -0,0 +1,571 @@
+"""
+End-to-end latency benchmark on local stand-in backends.
+
+    python benchmark.py traffic --messages 2000 --chats 20 --workers 4
+    python benchmark.py startup --runs 5
+    python benchmark.py embeddings --backends torch,onnx,onnx-int8
+    python benchmark.py triggers --triggers 4,50,200
+
+Synthetic chat traffic is replayed through the RagBot handlers and
+MessageProcessor with a fake LLM, canned search results, an in-process Qdrant
+and a fake Telegram API. The report lists p50/p95/p99 latency of every
+metrics span (queue wait, embed, retrieve, prompt build, LLM, Telegram send,
+...), per handler type, and sustained messages per second. Any backend can be switched
+back to the real one through the usual environment variables.
+
+The startup benchmark starts fresh interpreters and reports the time until the
+bot could start polling and the time until every lazily loaded model is ready.
+The embeddings benchmark compares load time, memory, encode throughput and
+agreement with fp32 across the embedding inference backends, and concurrent
+single-text throughput with and without the micro-batcher. The triggers
+benchmark times the regular-message classification path against the
+substring loops it replaced, for growing trigger tables.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Optional, Tuple
+
+STAND_IN_BACKENDS = {
+    "LLM_BACKEND": "fake",
+    "SEARCH_BACKEND": "canned",
+    "QDRANT_BACKEND": "memory",
+}
+
+PHRASES = [
+    "кто сегодня идёт в бар",
+    "я опять проспал работу",
+    "скиньте мем про котов",
+    "@dan ты где пропал",
+    "го в доту вечером",
+    "у меня сломался ноут, кто шарит",
+    "завтра дедлайн, а я ничего не сделал",
+    "спасибо боту за вчерашнее",
+    "купил новые кроссовки, норм?",
+    "доброе утро всем",
+]
+QUESTIONS = [
+    "что я говорил про ноут?",
+    "кто вчера проспал?",
+    "что думаешь про мои кроссовки?",
+    "куда мы идём вечером?",
+    "как дела?",
+]
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, math.ceil(q / 100 * len(sorted_values)) - 1)
+    return sorted_values[rank]
+
+
+class StageRecorder:
+    """Collects wall-clock durations per stage"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    def report(self) -> str:
+        lines = [
+            f"{'stage':<22}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}"
+            f"{'p99 ms':>10}{'mean ms':>10}"
+        ]
+        for stage in sorted(self.samples):
+            values = sorted(self.samples[stage])
+            mean = sum(values) / len(values)
+            lines.append(
+                f"{stage:<22}{len(values):>8}"
+                f"{percentile(values, 50) * 1000:>10.1f}"
+                f"{percentile(values, 95) * 1000:>10.1f}"
+                f"{percentile(values, 99) * 1000:>10.1f}"
+                f"{mean * 1000:>10.1f}"
+            )
+        return "\n".join(lines)
+
+
+class FakeTelegram:
+    """Telegram API stand-in: every call takes a fixed round trip"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self._ids = itertools.count(1_000_000)
+
+    def _call(self) -> None:
+        time.sleep(self.latency)
+
+    def reply_to(self, message, text, **kwargs):
+        self._call()
+        return SimpleNamespace(message_id=next(self._ids), chat=message.chat, text=text)
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._call()
+        return SimpleNamespace(message_id=next(self._ids), text=text)
+
+    def send_chat_action(self, chat_id, action, **kwargs):
+        self._call()
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self._call()
+
+
+def synthetic_messages(
+    count: int,
+    chats: int,
+    users: int,
+    bot_username: str,
+    mention_rate: float,
+    seed: int,
+) -> Iterator[Tuple[str, SimpleNamespace]]:
+    """Yield (kind, message) pairs resembling a busy group chat"""
+    rng = random.Random(seed)
+    usernames = [f"user{i}" for i in range(users)]
+    for message_id in range(1, count + 1):
+        chat_id = -1000 - rng.randrange(chats)
+        username = rng.choice(usernames)
+        roll = rng.random()
+        if roll < mention_rate * 0.1:
+            kind, text = "remember", f"@{bot_username} запомни {rng.choice(PHRASES)}"
+        elif roll < mention_rate * 0.2:
+            kind, text = "search", f"@{bot_username} загугли {rng.choice(QUESTIONS)}"
+        elif roll < mention_rate:
+            kind, text = "mention", f"@{bot_username} {rng.choice(QUESTIONS)}"
+        elif roll < mention_rate + 0.01:
+            kind, text = "all", "@all го созвон"
+        else:
+            kind, text = "regular", rng.choice(PHRASES)
+        yield kind, SimpleNamespace(
+            message_id=message_id,
+            chat=SimpleNamespace(id=chat_id),
+            from_user=SimpleNamespace(username=username),
+            text=text,
+            reply_to_message=None,
+        )
+
+
+def run_traffic(args) -> None:
+    """Replay synthetic traffic and print the latency report"""
+    import backends
+    import metrics
+    from bot import RagBot
+
+    # Prompt dumps would dominate the run
+    logging.getLogger().setLevel(logging.WARNING)
+    bot_username = "bench_bot"
+    recorder = StageRecorder()
+    metrics.add_span_listener(recorder.record)
+    rag_bot = RagBot(token="123456:bench", bot_username=bot_username)
+    rag_bot.bot = FakeTelegram(args.telegram_latency)
+    if not args.flood_limits:
+        # Replay is far denser than real chats; only measure our own overhead
+        from scheduler import TelegramRateLimiter
+
+        rag_bot.limiter = TelegramRateLimiter(
+            rate=1e9, chat_rate=1e9, group_rate=1e9, chat_burst=1e9
+        )
+    rag_bot._instrument_telegram()
+    # Production warms models up before traffic arrives; keep loads out of the stats
+    backends.warm_up().join()
+
+    # One worker owns each chat, so per-chat order is kept like in production
+    shards: Dict[int, list] = defaultdict(list)
+    for kind, message in synthetic_messages(
+        args.messages,
+        args.chats,
+        args.users,
+        bot_username,
+        args.mention_rate,
+        args.seed,
+    ):
+        shards[message.chat.id % args.workers].append((kind, message))
+
+    def handle(kind: str, message) -> None:
+        started = time.perf_counter()
+        if f"@{bot_username}" in message.text:
+            rag_bot._handle_mention(message)
+        else:
+            rag_bot.handle_regular_message(message)
+        recorder.record(f"handler:{kind}", time.perf_counter() - started)
+
+    def replay(shard: list) -> None:
+        for kind, message in shard:
+            handle(kind, message)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        list(pool.map(replay, shards.values()))
+    # Handlers only queue commands; the run ends when the scheduler is done
+    rag_bot.scheduler.close()
+    elapsed = time.perf_counter() - started
+
+    drain_started = time.perf_counter()
+    rag_bot.processor.shutdown()
+    drain = time.perf_counter() - drain_started
+
+    print(recorder.report())
+    print()
+    print(f"messages:        {args.messages} in {elapsed:.2f}s")
+    print(f"throughput:      {args.messages / elapsed:.1f} msg/s")
+    print(f"indexing drain:  {drain:.2f}s, queue {rag_bot.processor.indexer.stats()}")
+
+
+def measure_startup() -> dict:
+    """Cold start of one interpreter: imports, bot construction, model warm-up"""
+    started = time.perf_counter()
+    import backends
+    from bot import RagBot
+
+    imported = time.perf_counter()
+    rag_bot = RagBot(token="123456:bench", bot_username="bench_bot")
+    ready_to_poll = time.perf_counter()
+    backends.warm_up().join()
+    warmed = time.perf_counter()
+    rag_bot.scheduler.close()
+    rag_bot.processor.shutdown()
+    return {
+        "import": imported - started,
+        "construct": ready_to_poll - imported,
+        "time_to_poll": ready_to_poll - started,
+        "time_to_ready": warmed - started,
+        **{f"load:{name}": s for name, s in backends.load_times().items()},
+    }
+
+
+def run_startup(args) -> None:
+    """Measure cold starts in fresh interpreters and print the report"""
+    if args.child:
+        logging.getLogger().setLevel(logging.WARNING)
+        print(json.dumps(measure_startup()))
+        return
+
+    recorder = StageRecorder()
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "startup", "--child"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        for stage, seconds in json.loads(output.strip().splitlines()[-1]).items():
+            if seconds is not None:
+                recorder.record(stage, seconds)
+    print(recorder.report())
+
+
+def rss_mb() -> float:
+    """Resident memory of this process"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure_embeddings(args) -> dict:
+    """Load one inference backend and time encoding synthetic chat messages"""
+    import config
+    from llm_interface import (
+        PROBE_TEXTS,
+        EmbeddingBatcher,
+        fp32_agreement,
+        load_sentence_transformer,
+    )
+
+    rng = random.Random(args.seed)
+    texts = [
+        " ".join(rng.choice(PHRASES) for _ in range(rng.randint(1, 8)))
+        for _ in range(args.texts)
+    ]
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    model = load_sentence_transformer(
+        args.model,
+        args.backend,
+        num_threads=args.threads,
+        max_seq_length=args.max_seq_length,
+        onnx_dir=config.EMBED_ONNX_DIR,
+        quantization_config=config.EMBED_QUANTIZATION_CONFIG,
+    )
+    loaded = time.perf_counter()
+    model.encode(texts[: args.batch_size], batch_size=args.batch_size)  # warm-up
+
+    encode_started = time.perf_counter()
+    model.encode(texts, batch_size=args.batch_size, normalize_embeddings=True)
+    encode_seconds = time.perf_counter() - encode_started
+    single = []
+    for text in texts[:50]:
+        single_started = time.perf_counter()
+        model.encode([text], normalize_embeddings=True)
+        single.append(time.perf_counter() - single_started)
+    result = {
+        "backend": args.backend,
+        "load_s": loaded - started,
+        "rss_mb": rss_mb() - rss_before,
+        "texts_per_s": len(texts) / encode_seconds,
+        "single_p50_ms": percentile(sorted(single), 50) * 1000,
+        "min_cosine": None,
+    }
+
+    # Many handlers embedding one query each: direct model calls vs the batcher
+    def encode_batch(batch):
+        return list(model.encode(batch, normalize_embeddings=True))
+
+    batcher = EmbeddingBatcher(encode_batch, max_batch=args.batch_size)
+    batcher.start()
+    for name, encode in (("direct", encode_batch), ("batched", batcher.encode)):
+        chunks = [texts[i :: args.concurrency] for i in range(args.concurrency)]
+        concurrent_started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(lambda chunk: [encode([t]) for t in chunk], chunks))
+        result[f"{name}_per_s"] = len(texts) / (
+            time.perf_counter() - concurrent_started
+        )
+    batcher.close()
+
+    if args.backend != "torch":
+        reference = load_sentence_transformer(
+            args.model, "torch", max_seq_length=args.max_seq_length
+        )
+        result["min_cosine"] = fp32_agreement(
+            model, reference, PROBE_TEXTS + texts[:100]
+        )
+    return result
+
+
+def run_embeddings(args) -> None:
+    """Benchmark every requested backend in its own interpreter"""
+    if args.child:
+        logging.getLogger().setLevel(logging.WARNING)
+        print(json.dumps(measure_embeddings(args)))
+        return
+
+    print(
+        f"{'backend':<12}{'load s':>9}{'rss MB':>9}{'texts/s':>10}"
+        f"{'1-text ms':>11}{'min cos':>9}{'direct/s':>10}{'batched/s':>11}"
+    )
+    for backend in args.backends.split(","):
+        command = [
+            sys.executable,
+            os.path.abspath(__file__),
+            "embeddings",
+            "--child",
+            "--backend",
+            backend,
+            "--model",
+            args.model,
+            "--texts",
+            str(args.texts),
+            "--batch-size",
+            str(args.batch_size),
+            "--threads",
+            str(args.threads),
+            "--max-seq-length",
+            str(args.max_seq_length),
+            "--seed",
+            str(args.seed),
+            "--concurrency",
+            str(args.concurrency),
+        ]
+        output = subprocess.run(
+            command, check=True, capture_output=True, text=True
+        ).stdout
+        r = json.loads(output.strip().splitlines()[-1])
+        cosine = "-" if r["min_cosine"] is None else f"{r['min_cosine']:.4f}"
+        print(
+            f"{r['backend']:<12}{r['load_s']:>9.1f}{r['rss_mb']:>9.0f}"
+            f"{r['texts_per_s']:>10.1f}{r['single_p50_ms']:>11.1f}{cosine:>9}"
+            f"{r['direct_per_s']:>10.1f}{r['batched_per_s']:>11.1f}"
+        )
+
+
+class LegacyClassifier:
+    """Regular-message checks as the handlers made them before TriggerMatcher"""
+
+    def __init__(self, bot_username: str, triggers: dict):
+        self.bot_username = bot_username
+        self.triggers = triggers
+
+    def _is_all_command(self, text: str) -> bool:
+        return "@all" in text.lower()
+
+    def _check_passive_triggers(self, text: str) -> Optional[str]:
+        text_lower = text.lower()
+        for trigger in self.triggers:
+            if trigger in text_lower:
+                return trigger
+        return None
+
+    def route(self, text: str) -> Optional[str]:
+        if f"@{self.bot_username}" in text:  # mention handler filter
+            return "mention"
+        if f"@{self.bot_username}" not in text:  # regular handler filter
+            if self._is_all_command(text):
+                return "all"
+            return self._check_passive_triggers(text)
+        return None
+
+
+class MatcherClassifier:
+    """The same decisions through TriggerMatcher, as the handlers make them"""
+
+    def __init__(self, matcher):
+        self.triggers = matcher
+
+    def _is_all_command(self, text: str) -> bool:
+        return self.triggers.classify(text).all
+
+    def _check_passive_triggers(self, text: str) -> Optional[str]:
+        return self.triggers.classify(text).trigger
+
+    def route(self, text: str) -> Optional[str]:
+        if self.triggers.classify(text).mention:
+            return "mention"
+        if not self.triggers.classify(text).mention:
+            if self._is_all_command(text):
+                return "all"
+            return self._check_passive_triggers(text)
+        return None
+
+
+def run_triggers(args) -> None:
+    """Time message classification for trigger tables of several sizes"""
+    import config
+    from triggers import TriggerMatcher
+
+    bot_username = "bench_bot"
+    rng = random.Random(args.seed)
+    # Every text is unique, like real chat messages
+    texts = [
+        f"{message.text} {message.message_id}"
+        for _, message in synthetic_messages(
+            args.messages, 10, 5, bot_username, 0.05, args.seed
+        )
+    ]
+    words = sorted({word for phrase in PHRASES for word in phrase.split()})
+    print(f"{'triggers':>8}{'loop ns':>10}{'matcher ns':>12}{'speedup':>9}")
+    for size in (int(n) for n in args.triggers.split(",")):
+        triggers = dict(config.PASSIVE_TRIGGERS)
+        while len(triggers) < size:
+            triggers[" ".join(rng.sample(words, 2))] = ["ок"]
+        legacy = LegacyClassifier(bot_username, triggers)
+        matcher = MatcherClassifier(TriggerMatcher(bot_username, triggers))
+        for text in texts:
+            assert legacy.route(text) == matcher.route(text), text
+        timings = []
+        for fn in (legacy.route, matcher.route):
+            best = float("inf")
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                for text in texts:
+                    fn(text)
+                best = min(best, time.perf_counter() - started)
+            timings.append(best / len(texts) * 1e9)
+        print(
+            f"{size:>8}{timings[0]:>10.0f}{timings[1]:>12.0f}"
+            f"{timings[0] / timings[1]:>8.1f}x"
+        )
+
+
+def main():
+    """CLI entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    traffic = sub.add_parser("traffic", help="replay synthetic chat traffic")
+    traffic.add_argument("--messages", type=int, default=1000)
+    traffic.add_argument("--chats", type=int, default=10)
+    traffic.add_argument("--users", type=int, default=5)
+    traffic.add_argument("--workers", type=int, default=2)
+    traffic.add_argument("--mention-rate", type=float, default=0.05)
+    traffic.add_argument("--telegram-latency", type=float, default=0.05)
+    traffic.add_argument("--llm-latency", type=float, default=1.0)
+    traffic.add_argument(
+        "--flood-limits",
+        action="store_true",
+        help="apply the Telegram rate limits from config to the fake API",
+    )
+    traffic.add_argument(
+        "--fake-embeddings",
+        action="store_true",
+        help="hashed embeddings instead of the SentenceTransformer model",
+    )
+    traffic.add_argument("--seed", type=int, default=42)
+
+    startup = sub.add_parser("startup", help="measure cold start and model warm-up")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument(
+        "--fake-embeddings",
+        action="store_true",
+        help="hashed embeddings instead of the SentenceTransformer model",
+    )
+    startup.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+
+    embeddings = sub.add_parser(
+        "embeddings", help="compare embedding inference backends"
+    )
+    embeddings.add_argument("--backends", default="torch,onnx,onnx-int8")
+    embeddings.add_argument("--model", default="ai-forever/ru-en-RoSBERTa")
+    embeddings.add_argument("--texts", type=int, default=500)
+    embeddings.add_argument("--batch-size", type=int, default=64)
+    embeddings.add_argument("--threads", type=int, default=0)
+    embeddings.add_argument("--max-seq-length", type=int, default=0)
+    embeddings.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="threads embedding one text each, with and without the batcher",
+    )
+    embeddings.add_argument("--seed", type=int, default=42)
+    embeddings.add_argument("--backend", help=argparse.SUPPRESS)
+    embeddings.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+
+    triggers = sub.add_parser(
+        "triggers", help="time regular-message trigger classification"
+    )
+    triggers.add_argument("--messages", type=int, default=20000)
+    triggers.add_argument("--triggers", default="4,16,50,200")
+    triggers.add_argument("--repeat", type=int, default=5)
+    triggers.add_argument("--seed", type=int, default=42)
+
+    args = parser.parse_args()
+    for name, value in STAND_IN_BACKENDS.items():
+        os.environ.setdefault(name, value)
+    os.environ.setdefault("FAKE_LLM_LATENCY", str(getattr(args, "llm_latency", 1.0)))
+    if getattr(args, "fake_embeddings", False):
+        os.environ["EMBEDDING_BACKEND"] = "hash"
+
+    if args.command == "traffic":
+        run_traffic(args)
+    elif args.command == "startup":
+        run_startup(args)
+    elif args.command == "embeddings":
+        run_embeddings(args)
+    elif args.command == "triggers":
+        run_triggers(args)
+
+
+if __name__ == "__main__":
+    main()
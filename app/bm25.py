@@ -0,0 +1,75 @@
+"""
+BM25 term weights as Qdrant sparse vectors.
+
+Documents store only the term-frequency part of BM25, saturated with k1 and
+normalized by length with b. Qdrant applies IDF itself at query time
+(Modifier.IDF), so the keyword index stays correct as documents are upserted
+one batch at a time, without corpus statistics on our side.
+"""
+
+import hashlib
+import re
+from collections import Counter
+from typing import List
+
+from qdrant_client import models
+
+# Words, numbers and @usernames
+TOKEN_RE = re.compile(r"@?\w+")
+
+
+class BM25Encoder:
+    """
+    Turns text into sparse vectors for a Qdrant sparse index with Modifier.IDF.
+
+    Args:
+        k1: Term-frequency saturation.
+        b: Strength of document length normalization.
+        avg_doc_length: Typical document length in tokens.
+        stem_length: Words are cut to this many characters, a crude stemmer
+            that folds most Russian inflections; 0 disables it.
+    """
+
+    def __init__(
+        self,
+        k1: float = 1.2,
+        b: float = 0.75,
+        avg_doc_length: float = 50.0,
+        stem_length: int = 6,
+    ):
+        self.k1 = k1
+        self.b = b
+        self.avg_doc_length = avg_doc_length
+        self.stem_length = stem_length
+
+    def tokenize(self, text: str) -> List[str]:
+        tokens = []
+        for token in TOKEN_RE.findall(text.lower().replace("ё", "е")):
+            if token.startswith("@"):
+                # "@dan" should also match a plain "dan" and the other way round
+                tokens.append(token)
+                token = token[1:]
+            if self.stem_length and len(token) > self.stem_length:
+                token = token[: self.stem_length]
+            tokens.append(token)
+        return tokens
+
+    @staticmethod
+    def term_id(term: str) -> int:
+        """Stable 32-bit id of a term; no vocabulary to store or sync"""
+        return int.from_bytes(hashlib.md5(term.encode("utf-8")).digest()[:4], "little")
+
+    def encode_document(self, text: str) -> models.SparseVector:
+        tokens = self.tokenize(text)
+        length_norm = 1 - self.b + self.b * len(tokens) / self.avg_doc_length
+        weights = {}
+        for term, tf in Counter(tokens).items():
+            weights[self.term_id(term)] = (
+                tf * (self.k1 + 1) / (tf + self.k1 * length_norm)
+            )
+        return models.SparseVector(indices=list(weights), values=list(weights.values()))
+
+    def encode_query(self, text: str) -> models.SparseVector:
+        # Every query term counts once; IDF comes from the index
+        ids = list(dict.fromkeys(self.term_id(term) for term in self.tokenize(text)))
+        return models.SparseVector(indices=ids, values=[1.0] * len(ids))
@@ -1,52 +1,140 @@
+import functools
 import logging
 import random
+import signal
 from datetime import datetime, timedelta, timezone
-from telebot import TeleBot, logger as telebot_logger
+from telebot import TeleBot, apihelper, logger as telebot_logger
+import backends as backends
 import config as config
+import metrics as metrics
 from helper import MessageProcessor
 from rag_engine import RagEngine
+from resilience import CircuitOpenError, create_retry, is_telegram_retryable
+from scheduler import CHEAP, LLM, create_rate_limiter, create_scheduler
+from streaming import ThrottledEditor
+from triggers import TriggerMatcher
 from typing import Callable
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 telebot_logger.setLevel(logging.INFO)
 
+FALLBACK_REPLIES = metrics.REGISTRY.counter(
+    "ragbot_fallback_replies_total",
+    "Answers replaced by a fallback message",
+    ["kind", "reason"],
+)
+
+# Calls that leave the same state when repeated
+IDEMPOTENT_TELEGRAM_METHODS = ("send_chat_action", "edit_message_text")
+
+
+def configure_telegram_api() -> None:
+    """Timeouts, session lifetime and server of the blocking Bot API client"""
+    apihelper.CONNECT_TIMEOUT = config.TELEGRAM_CONNECT_TIMEOUT
+    apihelper.READ_TIMEOUT = config.TELEGRAM_READ_TIMEOUT
+    # Sessions keep connections alive; recycling them picks up DNS changes
+    apihelper.SESSION_TIME_TO_LIVE = config.TELEGRAM_SESSION_TTL
+    if config.TELEGRAM_API_URL:
+        base = config.TELEGRAM_API_URL.rstrip("/")
+        apihelper.API_URL = f"{base}/bot{{0}}/{{1}}"
+        apihelper.FILE_URL = f"{base}/file/bot{{0}}/{{1}}"
+
 
 class RagBot:
     """Telegram bot with RAG integration"""
 
     def __init__(self, token: str, bot_username: str, history_size: int = 10):
         """Initialize the bot with configuration"""
-        self.bot = TeleBot(token)
+        self.bot = self._create_bot(token)
         self.bot_username = bot_username
+        self._setup_components(history_size)
+
+    def _create_bot(self, token: str) -> TeleBot:
+        configure_telegram_api()
+        return TeleBot(token)
+
+    def _create_scheduler(self):
+        return create_scheduler()
+
+    def _setup_components(self, history_size: int) -> None:
+        """Setup shared by the sync and asyncio bots once the client exists"""
+        self.triggers = TriggerMatcher(
+            self.bot_username,
+            path=config.TRIGGERS_PATH,
+            reload_interval=config.TRIGGERS_RELOAD_INTERVAL,
+        )
         self.processor = MessageProcessor(RagEngine(), history_size)
+        # Commands run on the scheduler, outgoing calls wait for the rate limiter
+        self.scheduler = self._create_scheduler()
+        self.limiter = create_rate_limiter()
+        self._instrument_telegram()
         self._setup_handlers()
 
+    def _instrument_telegram(self) -> None:
+        """Rate-limit, retry and time outgoing Telegram calls as telegram_send"""
+        for name in (
+            "reply_to",
+            "send_message",
+            "send_chat_action",
+            "edit_message_text",
+        ):
+            method = metrics.timed("telegram_send", getattr(self.bot, name))
+            # Chat actions do not count against a chat's message limit
+            method = self.limiter.wrap(method, per_chat=name != "send_chat_action")
+            # Every attempt waits for the rate limiter again
+            retry = create_retry(
+                "telegram",
+                config.TELEGRAM_RETRIES,
+                retry_on=functools.partial(
+                    is_telegram_retryable,
+                    idempotent=name in IDEMPOTENT_TELEGRAM_METHODS,
+                ),
+            )
+            setattr(self.bot, name, retry.wrap(method))
+
+    def _reply_soon(self, message, text: str) -> None:
+        """Queue a cheap reply; it goes ahead of pending LLM answers"""
+        self.scheduler.submit(
+            message.chat.id, self.bot.reply_to, message, text, priority=CHEAP
+        )
+
+    def _handler(self, handler: Callable) -> Callable:
+        """
+        Handler as the Telegram client calls it. Handlers only decide and
+        queue replies, so the same ones serve the asyncio bot.
+        """
+        return handler
+
     def _setup_handlers(self) -> None:
         """Configure message handlers"""
 
         # 1. Handle voice messages
-        self.bot.message_handler(content_types=["voice"])(self._handle_voice)
+        self.bot.message_handler(content_types=["voice"])(
+            self._handler(self._handle_voice)
+        )
 
         # 2. Handle stickers (random chance to react)
-        self.bot.message_handler(content_types=["sticker"])(self._handle_sticker)
+        self.bot.message_handler(content_types=["sticker"])(
+            self._handler(self._handle_sticker)
+        )
 
         # 3. Handle mentions (most specific text handler)
         self.bot.message_handler(
-            func=lambda m: m.text and f"@{self.bot_username}" in m.text
-        )(self._handle_mention)
+            func=lambda m: m.text and self.triggers.classify(m.text).mention
+        )(self._handler(self._handle_mention))
 
         # 4. Handle replies to bot messages
         self.bot.message_handler(
             func=lambda m: m.reply_to_message
             and m.reply_to_message.from_user
             and m.reply_to_message.from_user.username == self.bot_username
-        )(self._handle_reply)
+        )(self._handler(self._handle_reply))
 
         # 5. Handle regular messages LAST (catches everything else)
         self.bot.message_handler(
-            func=lambda m: m.text and f"@{self.bot_username}" not in m.text
-        )(self.handle_regular_message)
+            func=lambda m: m.text and not self.triggers.classify(m.text).mention
+        )(self._handler(self.handle_regular_message))
 
     def _handle_voice(self, message):
         """React to voice messages"""
@@ -58,7 +146,7 @@ class RagBot:
             "пропускаю голосовое с чистой совестью",
         ]
         if random.random() < 0.6:  # 60% chance to react
-            self.bot.reply_to(message, random.choice(responses))
+            self._reply_soon(message, random.choice(responses))
 
     def _handle_sticker(self, message):
         """Occasionally react to stickers"""
@@ -69,17 +157,16 @@ class RagBot:
             "стикерами общаемся? ну ок",
         ]
         if random.random() < 0.15:  # 15% chance to react
-            self.bot.reply_to(message, random.choice(responses))
+            self._reply_soon(message, random.choice(responses))
 
     def _check_passive_triggers(self, message) -> bool:
         """Check for passive triggers in regular messages. Returns True if triggered."""
-        text_lower = message.text.lower()
-        for trigger, responses in config.PASSIVE_TRIGGERS.items():
-            if trigger in text_lower:
-                if random.random() < 0.7:  # 70% chance to fire
-                    self.bot.reply_to(message, random.choice(responses))
-                return True
-        return False
+        match = self.triggers.classify(message.text)
+        if match.trigger is None:
+            return False
+        if match.responses and random.random() < 0.7:  # 70% chance to fire
+            self._reply_soon(message, random.choice(match.responses))
+        return True
 
     def _check_late_night(self, message) -> bool:
         """Roast someone for texting at 3-5 AM Moscow time."""
@@ -92,7 +179,7 @@ class RagBot:
                 "3 часа ночи, а ты в телеге сидишь",
                 "ложись спать, я серьёзно",
             ]
-            self.bot.reply_to(message, random.choice(responses))
+            self._reply_soon(message, random.choice(responses))
             return True
         return False
 
@@ -103,7 +190,7 @@ class RagBot:
         text = self._extract_mention_text(message)
 
         if not text:
-            self.bot.reply_to(
+            self._reply_soon(
                 message,
                 f"❗️ Укажи вопрос после @{self.bot_username}.\n"
                 f"Пример: @{self.bot_username} Как дела?",
@@ -123,24 +210,74 @@ class RagBot:
 
         self._process_command(message, chat_id, username, text)
 
+    def _fallback(self, kind: str, error: Exception) -> str:
+        """Reply sent in place of an answer that could not be produced"""
+        if isinstance(error, CircuitOpenError):
+            reason = "circuit_open"
+            logging.warning(f"Отвечаю заглушкой: {error}")
+        else:
+            reason = "error"
+            logging.error("Не удалось ответить, отвечаю заглушкой", exc_info=error)
+        FALLBACK_REPLIES.inc(kind=kind, reason=reason)
+        return random.choice(config.FALLBACK_MESSAGES)
+
+    def _command_kind(self, text: str) -> str:
+        """Metrics label of a command"""
+        if self._is_remember_command(text):
+            return "remember"
+        if self._is_web_search_command(text):
+            return "search"
+        return "query"
+
     def _process_command(self, message, chat_id: int, username: str, text: str) -> None:
         """Central command processing logic for both mentions and replies"""
-        # Handle "remember" command
-        if self._is_remember_command(text):
-            response = self.processor.process_remember_command(
-                chat_id, message.message_id, username, text
-            )
-            self.bot.reply_to(message, response)
+        kind = self._command_kind(text)
+        metrics.REQUESTS.inc(kind=kind)
+        # "запомни" needs no LLM; a newer question from the same user replaces
+        # one that is still waiting
+        cheap = kind == "remember"
+        self.scheduler.submit(
+            chat_id,
+            self._execute_command,
+            kind,
+            message,
+            username,
+            text,
+            priority=CHEAP if cheap else LLM,
+            coalesce_key=None if cheap else username,
+        )
+
+    def _execute_command(self, kind: str, message, username: str, text: str) -> None:
+        with metrics.span(f"command:{kind}"):
+            self._run_command(kind, message, username, text)
+
+    def _remember(self, message, username: str, text: str) -> str:
+        """Reply to a "запомни" command"""
+        return self.processor.process_remember_command(
+            message.chat.id, message.message_id, username, text
+        )
+
+    def _answer_method(self, kind: str) -> Callable:
+        """Processor method that answers a "search" or "query" command"""
+        if kind == "search":
+            return self.processor.process_web_search
+        return self.processor.process_query
+
+    def _run_command(self, kind: str, message, username: str, text: str) -> None:
+        chat_id = message.chat.id
+        if kind == "remember":
+            self.bot.reply_to(message, self._remember(message, username, text))
             return
 
         self.bot.send_chat_action(chat_id, "typing")
 
-        # Handle web search command
-        if self._is_web_search_command(text):
-            reply_msg = self.bot.reply_to(
-                message, random.choice(config.PENDING_MESSAGES)
-            )
-            result = self.processor.process_web_search(
+        if config.STREAM_ANSWERS:
+            self._stream_answer(kind, message, username, text)
+            return
+
+        reply_msg = self.bot.reply_to(message, random.choice(config.PENDING_MESSAGES))
+        try:
+            answer = self._answer_method(kind)(
                 chat_id,
                 message.message_id,
                 reply_msg.message_id,
@@ -148,40 +285,50 @@ class RagBot:
                 text,
                 self.bot_username,
             )
-            self.bot.edit_message_text(
-                result, chat_id=chat_id, message_id=reply_msg.message_id
-            )
-            return
-
-        # Handle normal RAG query
-        reply_msg = self.bot.reply_to(message, random.choice(config.PENDING_MESSAGES))
-        answer = self.processor.process_query(
-            chat_id,
-            message.message_id,
-            reply_msg.message_id,
-            username,
-            text,
-            self.bot_username,
-        )
+        except Exception as e:
+            answer = self._fallback(kind, e)
         self.bot.edit_message_text(
             answer, chat_id=chat_id, message_id=reply_msg.message_id
         )
 
+    def _stream_answer(self, kind: str, message, username: str, text: str) -> None:
+        """Answer via the streaming LLM path, editing the placeholder as text arrives"""
+        chat_id = message.chat.id
+        reply_msg = self.bot.reply_to(message, random.choice(config.PENDING_MESSAGES))
+        editor = ThrottledEditor(
+            lambda partial: self.bot.edit_message_text(
+                partial, chat_id=chat_id, message_id=reply_msg.message_id
+            ),
+            can_edit=lambda: self.limiter.is_ready(chat_id),
+        )
+        answer = ""
+        try:
+            for answer in self.processor.stream_answer(
+                chat_id, username, text, self.bot_username, web_search=kind == "search"
+            ):
+                editor.update(answer)
+        except Exception as e:
+            fallback = self._fallback(kind, e)
+            # Whatever was streamed stays; the placeholder alone does not
+            if not answer:
+                answer = fallback
+        editor.finish(answer)
+
     def _get_username(self, message) -> str:
         """Extract username from message"""
         return f"@{message.from_user.username}"
 
     def _is_remember_command(self, text: str) -> bool:
         """Check if text contains a remember command"""
-        return "запомни" in text.lower()
+        return self.triggers.classify(text).remember
 
     def _is_web_search_command(self, text: str) -> bool:
         """Check if text contains a web search command"""
-        return "загугли" in text.lower()
+        return self.triggers.classify(text).web_search
 
     def _is_all_command(self, text: str) -> bool:
         """Check if text contains an @all command"""
-        return "@all" in text.lower()
+        return self.triggers.classify(text).all
 
     def _extract_mention_text(self, message) -> str:
         """Extract text after bot mention"""
@@ -195,7 +342,7 @@ class RagBot:
 
         # Handle "all" command
         if self._is_all_command(text):
-            self.bot.reply_to(message, self.processor.process_all_command())
+            self._reply_soon(message, self.processor.process_all_command())
             return
 
         self.processor.track_message(chat_id, message.message_id, username, text)
@@ -210,13 +357,39 @@ class RagBot:
     def run(self) -> None:
         """Start the bot and begin polling for messages"""
         logging.info("Бот запущен")
-        self.bot.infinity_polling(
-            timeout=20, long_polling_timeout=5, skip_pending=False
-        )
+        # docker stop sends SIGTERM: stop polling gracefully so pending docs get indexed
+        signal.signal(signal.SIGTERM, lambda *_: self.bot.stop_polling())
+        try:
+            self.bot.infinity_polling(
+                timeout=20, long_polling_timeout=5, skip_pending=False
+            )
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Finish queued commands and index pending documents"""
+        logging.info("Бот остановлен, дописываю очередь индексации")
+        self.scheduler.close()
+        self.processor.shutdown()
 
 
 def main():
     """Main entry point for the application"""
+    if config.BOT_MODE == "async":
+        import async_bot
+
+        async_bot.main()
+        return
+    if config.BOT_MODE == "webhook":
+        import webhook
+
+        webhook.main()
+        return
+
+    metrics.start_metrics_server()
+    # Polling starts right away; models load in the background or on first use
+    if config.WARM_UP_MODELS:
+        backends.warm_up()
     bot = RagBot(
         token=config.TELEGRAM_TOKEN,
         bot_username=config.BOT_USERNAME,
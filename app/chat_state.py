@@ -0,0 +1,313 @@
+"""
+Per-chat short-term state: recent messages and the pending author group.
+
+Messages live in a fixed-size ring buffer per chat. Only the most recently
+active chats stay in memory; an idle chat is evicted once there are more than
+max_chats, and its pending author group is handed to on_evict for indexing.
+With a database path set, changed chats are snapshotted to SQLite every few
+seconds and on close, and are read back on startup or when an evicted chat
+writes again.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import config as config
+import metrics as metrics
+from work_queue import worker_owns
+
+
+class ChatState:
+    """
+    Recent messages of one chat, the document of its current author and the
+    running summary of older messages with those not yet folded into it
+    """
+
+    __slots__ = (
+        "messages",
+        "last_user",
+        "doc",
+        "summary",
+        "unsummarized",
+        "unsummarized_dropped",
+    )
+
+    def __init__(
+        self,
+        history_size: int,
+        messages=(),
+        last_user=None,
+        doc=None,
+        summary: str = "",
+        unsummarized=(),
+    ):
+        self.messages: "deque[str]" = deque(messages, maxlen=history_size)
+        self.last_user: Optional[str] = last_user
+        self.doc: Optional[dict] = doc
+        self.summary = summary
+        self.unsummarized: List[str] = list(unsummarized)
+        # Messages removed from the front of unsummarized so far, folded or
+        # trimmed: a fold in flight locates its batch by it (not persisted)
+        self.unsummarized_dropped = 0
+
+
+class ChatStateStore:
+    """
+    Bounded in-memory chat states with optional SQLite snapshots.
+
+    Args:
+        history_size: Messages kept per chat.
+        max_chats: Chats kept in memory; least recently active ones are evicted.
+        db_path: SQLite file for snapshots; empty keeps everything in memory.
+        snapshot_interval: Seconds between snapshots of changed chats.
+        on_evict: Called with (chat_id, doc) for the pending document of an
+            evicted chat.
+        owns: Chats this process serves; only they are read back on startup
+            when several workers share the database.
+    """
+
+    COLUMNS = "messages, last_user, doc, summary, unsummarized"
+
+    def __init__(
+        self,
+        history_size: int = 10,
+        max_chats: int = 1000,
+        db_path: str = "",
+        snapshot_interval: float = 5.0,
+        on_evict: Optional[Callable[[int, dict], None]] = None,
+        owns: Optional[Callable[[int], bool]] = None,
+    ):
+        self.history_size = history_size
+        self.max_chats = max_chats
+        self.snapshot_interval = snapshot_interval
+        self.on_evict = on_evict
+        self.owns = owns
+        self._chats: "OrderedDict[int, ChatState]" = OrderedDict()
+        # Changed since the last snapshot, including already evicted chats
+        self._dirty: Dict[int, ChatState] = {}
+        # Taken by a snapshot that is still being written
+        self._saving: Dict[int, ChatState] = {}
+        self._lock = threading.RLock()
+        self._db_lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.evicted = 0
+        self.snapshots = 0
+        if db_path:
+            self._open(db_path)
+
+    def _open(self, db_path: str) -> None:
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        # WAL: a snapshot does not block readers and commits without fsync
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chats ("
+            "chat_id INTEGER PRIMARY KEY, messages TEXT NOT NULL, "
+            "last_user TEXT, doc TEXT, updated_at REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(chats)")}
+        # Databases written before rolling summaries
+        for column in ("summary", "unsummarized"):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE chats ADD COLUMN {column} TEXT")
+        # Chats with an unindexed author group first, then the most recent ones
+        cursor = self._db.execute(
+            f"SELECT chat_id, {self.COLUMNS} FROM chats "
+            "ORDER BY doc IS NOT NULL DESC, updated_at DESC"
+        )
+        rows = []
+        for row in cursor:
+            if len(rows) >= self.max_chats:
+                break
+            # Another worker's chats: it writes them, a stale copy here must not
+            if self.owns is None or self.owns(row[0]):
+                rows.append(row)
+        for chat_id, *row in reversed(rows):
+            self._chats[chat_id] = self._row_to_state(*row)
+        logging.info(f"Восстановлена история {len(rows)} чатов из {db_path}")
+
+    def _row_to_state(
+        self, messages: str, last_user, doc, summary, unsummarized
+    ) -> ChatState:
+        return ChatState(
+            self.history_size,
+            json.loads(messages),
+            last_user,
+            json.loads(doc) if doc else None,
+            summary or "",
+            json.loads(unsummarized) if unsummarized else (),
+        )
+
+    def start(self) -> None:
+        """Start the background snapshot thread (no-op without a database)"""
+        if self._db is None or self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="chat-state-snapshot", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.snapshot_interval):
+            try:
+                self.snapshot()
+            except Exception:
+                logging.exception("Не удалось сохранить историю чатов")
+
+    def _load(self, chat_id: int) -> ChatState:
+        """State of a chat that is not in memory: unsaved, from SQLite or new"""
+        state = self._dirty.get(chat_id) or self._saving.get(chat_id)
+        if state is not None:
+            return state
+        if self._db is not None:
+            with self._db_lock:
+                row = self._db.execute(
+                    f"SELECT {self.COLUMNS} FROM chats WHERE chat_id = ?",
+                    (chat_id,),
+                ).fetchone()
+            if row is not None:
+                return self._row_to_state(*row)
+        return ChatState(self.history_size)
+
+    def _get(self, chat_id: int) -> ChatState:
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = self._load(chat_id)
+            self._evict()
+        self._chats.move_to_end(chat_id)
+        return state
+
+    def _evict(self) -> None:
+        while len(self._chats) > self.max_chats:
+            chat_id, state = self._chats.popitem(last=False)
+            self.evicted += 1
+            doc, state.doc, state.last_user = state.doc, None, None
+            if doc is not None and self.on_evict is not None:
+                self.on_evict(chat_id, doc)
+            if self._db is not None and (doc is not None or chat_id in self._dirty):
+                self._dirty[chat_id] = state
+
+    @contextmanager
+    def edit(self, chat_id: int) -> Iterator[ChatState]:
+        """Change a chat's state; it is saved with the next snapshot"""
+        with self._lock:
+            state = self._get(chat_id)
+            yield state
+            if self._db is not None:
+                self._dirty[chat_id] = state
+
+    def messages(self, chat_id: int) -> List[str]:
+        """Recent messages of a chat, oldest first"""
+        with self._lock:
+            state = self._chats.get(chat_id)
+            if state is not None:
+                self._chats.move_to_end(chat_id)
+                return list(state.messages)
+            return list(self._load(chat_id).messages)
+
+    def history(self, chat_id: int) -> Tuple[str, List[str]]:
+        """Summary of a chat and its messages that are not in it, oldest first"""
+        with self._lock:
+            state = self._chats.get(chat_id)
+            if state is not None:
+                self._chats.move_to_end(chat_id)
+            else:
+                state = self._load(chat_id)
+            return state.summary, [*state.unsummarized, *state.messages]
+
+    def chat_ids(self) -> List[int]:
+        """Chats currently held in memory"""
+        with self._lock:
+            return list(self._chats)
+
+    def snapshot(self) -> int:
+        """Write the chats changed since the last snapshot; returns their number"""
+        if self._db is None:
+            return 0
+        now = time.time()
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            self._saving = dirty
+            rows = [
+                (
+                    chat_id,
+                    json.dumps(list(state.messages), ensure_ascii=False),
+                    state.last_user,
+                    json.dumps(state.doc, ensure_ascii=False) if state.doc else None,
+                    state.summary,
+                    json.dumps(state.unsummarized, ensure_ascii=False),
+                    now,
+                )
+                for chat_id, state in dirty.items()
+            ]
+        if not rows:
+            return 0
+        try:
+            with self._db_lock:
+                with self._db:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO chats "
+                        f"(chat_id, {self.COLUMNS}, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        rows,
+                    )
+        except Exception:
+            # Keep the chats for the next snapshot unless they changed again
+            with self._lock:
+                self._dirty = {**dirty, **self._dirty}
+                self._saving = {}
+            raise
+        with self._lock:
+            self._saving = {}
+            self.snapshots += 1
+        return len(rows)
+
+    def close(self) -> None:
+        """Stop the snapshot thread and write the final snapshot"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._db is not None:
+            self.snapshot()
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "chats": len(self._chats),
+                "dirty": len(self._dirty),
+                "evicted": self.evicted,
+                "snapshots": self.snapshots,
+            }
+
+
+def create_chat_store(
+    history_size: int, on_evict: Optional[Callable[[int, dict], None]] = None
+) -> ChatStateStore:
+    """Build and start a chat state store configured from config.py"""
+    store = ChatStateStore(
+        history_size=history_size,
+        max_chats=config.HISTORY_MAX_CHATS,
+        db_path=config.HISTORY_DB_PATH,
+        snapshot_interval=config.HISTORY_SNAPSHOT_INTERVAL,
+        on_evict=on_evict,
+        owns=worker_owns(),
+    )
+    store.start()
+    gauge = metrics.REGISTRY.gauge(
+        "ragbot_chat_state", "In-memory chat history store", ["field"]
+    )
+    for field in ("chats", "dirty", "evicted", "snapshots"):
+        gauge.set_function(lambda field=field: store.stats()[field], field=field)
+    return store
@@ -0,0 +1,537 @@
+"""
+Memory maintenance of the Qdrant collection: retention, merging, dedup.
+
+    python compaction.py                       # every chat
+    python compaction.py --chat-id -100123 --dry-run
+
+Every author group becomes its own point, so a busy chat piles up many small
+points that make HNSW search slower and take memory. Chat by chat:
+
+1. retention: points older than the chat's TTL, and those beyond its newest
+   max_points, go with one payload-filtered delete;
+2. merging: runs of one author's small documents, written close together, are
+   joined into documents of up to COMPACTION_CHUNK_CHARS, embedded again and
+   written over the first of them; the rest of the run is deleted;
+3. dedup: of points with nearly identical vectors only the newest is kept.
+
+Summaries (type "summary") are only subject to retention. Points younger
+than COMPACTION_MIN_AGE_HOURS are not merged. Before and after a run from the
+command line the number of points, an estimate of the memory they take and
+the median latency of filtered searches are measured and logged; periodic
+runs only measure with COMPACTION_MEASURE=1. Measuring samples random points
+instead of reading the whole collection. While migrate.py copies the
+collection, compaction waits: its deletes would not reach the copy.
+"""
+
+import argparse
+import json
+import logging
+import statistics
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from llama_index.core.schema import MetadataMode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from qdrant_client import QdrantClient, models
+
+import config as config
+import db as db
+import metrics as metrics
+from work_queue import worker_owns
+
+logging.basicConfig(level=logging.INFO)
+
+COMPACTED_POINTS = metrics.REGISTRY.counter(
+    "ragbot_compaction_points_total", "Points changed by compaction", ["action"]
+)
+
+SECONDS_PER_DAY = 86400
+
+
+class Entry(NamedTuple):
+    """What compaction needs to know about a point, without its vector"""
+
+    id: str
+    timestamp: int
+    payload: dict
+
+
+def _chat_condition(chat_id: int) -> models.FieldCondition:
+    return models.FieldCondition(key="chat_id", match=models.MatchValue(value=chat_id))
+
+
+def _dense_vector(vector) -> Optional[list]:
+    # Hybrid collections have named vectors: dense is unnamed, BM25 is separate
+    return vector.get("") if isinstance(vector, dict) else vector
+
+
+def near_duplicates(vectors: np.ndarray, threshold: float) -> List[int]:
+    """
+    Rows to drop: rows are in time order, and a row goes if its cosine
+    similarity to a later row that stays is at least threshold.
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit = vectors / np.where(norms == 0, 1, norms)
+    similarity = unit @ unit.T
+    kept = np.zeros(len(vectors), dtype=bool)
+    dropped = []
+    for i in range(len(vectors) - 1, -1, -1):
+        if (similarity[i, kept] >= threshold).any():
+            dropped.append(i)
+        else:
+            kept[i] = True
+    return dropped
+
+
+class Compactor:
+    """
+    Retention, merging and dedup of a collection, chat by chat.
+
+    Args:
+        client: Qdrant client.
+        collection: Collection (or alias) to maintain.
+        build_points: Embeds documents into points; RagEngine.build_points.
+        min_age_hours: Points younger than this are not merged.
+        small_chars: Documents shorter than this may be merged.
+        chunk_chars: Largest merged document.
+        merge_gap_minutes: Largest gap between merged documents.
+        dedup_threshold: Cosine similarity of duplicates; 0 turns dedup off.
+        dedup_window: Points compared with each other at once.
+        ttl_days: Default TTL of a chat's points; 0 keeps them.
+        max_points: Default cap of a chat's points; 0 means no cap.
+        policies: chat id -> {"ttl_days": ..., "max_points": ...} overrides.
+        owns: Chats this process maintains; None means all.
+        dry_run: Count what would change without writing.
+    """
+
+    def __init__(
+        self,
+        client: QdrantClient,
+        collection: str,
+        build_points: Callable[[list], list],
+        min_age_hours: float = 24,
+        small_chars: int = 300,
+        chunk_chars: int = 1500,
+        merge_gap_minutes: float = 60,
+        dedup_threshold: float = 0.97,
+        dedup_window: int = 2048,
+        ttl_days: float = 0,
+        max_points: int = 0,
+        policies: Optional[Dict[int, dict]] = None,
+        owns: Optional[Callable[[int], bool]] = None,
+        dry_run: bool = False,
+    ):
+        self.client = client
+        self.collection = collection
+        self.build_points = build_points
+        self.min_age = min_age_hours * 3600
+        self.small_chars = small_chars
+        self.chunk_chars = chunk_chars
+        self.merge_gap = merge_gap_minutes * 60
+        self.dedup_threshold = dedup_threshold
+        self.dedup_window = dedup_window
+        self.ttl_days = ttl_days
+        self.max_points = max_points
+        self.policies = policies or {}
+        self.owns = owns
+        self.dry_run = dry_run
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def policy(self, chat_id: int) -> Tuple[float, int]:
+        """(ttl_days, max_points) of a chat"""
+        policy = self.policies.get(chat_id, {})
+        return (
+            float(policy.get("ttl_days", self.ttl_days)),
+            int(policy.get("max_points", self.max_points)),
+        )
+
+    def _scroll(self, scroll_filter: Optional[models.Filter], with_vectors=False):
+        offset = None
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=self.collection,
+                scroll_filter=scroll_filter,
+                limit=256,
+                offset=offset,
+                with_payload=True,
+                with_vectors=with_vectors,
+            )
+            yield from points
+            if offset is None:
+                return
+
+    def _entries(self, chat_id: int) -> List[Entry]:
+        """Points of a chat in time order"""
+        now = int(time.time())
+        entries = [
+            Entry(point.id, (point.payload or {}).get("timestamp", now), point.payload)
+            for point in self._scroll(models.Filter(must=[_chat_condition(chat_id)]))
+        ]
+        entries.sort(key=lambda entry: entry.timestamp)
+        return entries
+
+    def _delete_ids(self, ids: list) -> None:
+        if ids and not self.dry_run:
+            self.client.delete(
+                collection_name=self.collection,
+                points_selector=models.PointIdsList(points=ids),
+            )
+
+    def expire(self, chat_id: int, entries: List[Entry]) -> List[Entry]:
+        """Apply the chat's retention policy; returns the points that stay"""
+        ttl_days, max_points = self.policy(chat_id)
+        cutoff = None
+        if ttl_days > 0:
+            cutoff = int(time.time() - ttl_days * SECONDS_PER_DAY)
+        if 0 < max_points < len(entries):
+            # Points sharing the oldest kept timestamp all stay
+            newest = entries[len(entries) - max_points].timestamp
+            cutoff = newest if cutoff is None else max(cutoff, newest)
+        if cutoff is None:
+            return entries
+        expired = sum(1 for entry in entries if entry.timestamp < cutoff)
+        if expired and not self.dry_run:
+            self.client.delete(
+                collection_name=self.collection,
+                points_selector=models.FilterSelector(
+                    filter=models.Filter(
+                        must=[
+                            _chat_condition(chat_id),
+                            models.FieldCondition(
+                                key="timestamp", range=models.Range(lt=cutoff)
+                            ),
+                        ]
+                    )
+                ),
+            )
+        COMPACTED_POINTS.inc(expired, action="expired")
+        return [entry for entry in entries if entry.timestamp >= cutoff]
+
+    def merge_runs(self, entries: List[Entry]) -> List[List[Entry]]:
+        """Runs of small documents of one author that can be merged"""
+        doc_ids = [entry.payload.get("doc_id") for entry in entries]
+        chunks = Counter(doc_ids)
+        old_enough = time.time() - self.min_age
+        runs: Dict[str, List[List[Entry]]] = {}
+        sizes: Dict[str, int] = {}
+        for entry, doc_id in zip(entries, doc_ids):
+            payload = entry.payload
+            # Documents cut into several chunks are big enough already
+            if (
+                doc_id is None
+                or chunks[doc_id] > 1
+                or payload.get("type") == "summary"
+                or entry.timestamp > old_enough
+            ):
+                continue
+            size = len(self._text(payload))
+            if size >= self.small_chars:
+                continue
+            author = payload.get("author", "")
+            author_runs = runs.setdefault(author, [])
+            last = author_runs[-1] if author_runs else None
+            if (
+                last is not None
+                and entry.timestamp - last[-1].timestamp <= self.merge_gap
+                and sizes[author] + size <= self.chunk_chars
+            ):
+                last.append(entry)
+                sizes[author] += size + 1
+            else:
+                author_runs.append([entry])
+                sizes[author] = size
+        return [
+            run for author_runs in runs.values() for run in author_runs if len(run) > 1
+        ]
+
+    @staticmethod
+    def _text(payload: dict) -> str:
+        return metadata_dict_to_node(payload).get_content(
+            metadata_mode=MetadataMode.NONE
+        )
+
+    @classmethod
+    def merged_document(cls, run: List[Entry]) -> dict:
+        """One document for a run, under the id of its first document"""
+        first = metadata_dict_to_node(run[0].payload)
+        return {
+            "id": first.ref_doc_id,
+            "text": "\n".join(cls._text(entry.payload) for entry in run),
+            "metadata": dict(first.metadata),
+        }
+
+    def merge(self, entries: List[Entry], batch_size: int = 64) -> List[Entry]:
+        """Merge small documents; returns the points that stay"""
+        runs = self.merge_runs(entries)
+        removed = set()
+        written: List[Entry] = []
+        for start in range(0, len(runs), batch_size):
+            batch = runs[start : start + batch_size]
+            merged = sum(len(run) for run in batch)
+            if self.dry_run:
+                removed.update(entry.id for run in batch for entry in run[1:])
+                COMPACTED_POINTS.inc(merged, action="merged")
+                continue
+            points = self.build_points([self.merged_document(run) for run in batch])
+            # Merged documents are written before the originals go
+            self.client.upsert(collection_name=self.collection, points=points)
+            new_ids = {str(point.id) for point in points}
+            old_ids = [entry.id for run in batch for entry in run]
+            self._delete_ids([i for i in old_ids if str(i) not in new_ids])
+            removed.update(old_ids)
+            written.extend(
+                Entry(point.id, point.payload.get("timestamp", 0), point.payload)
+                for point in points
+            )
+            COMPACTED_POINTS.inc(merged, action="merged")
+            COMPACTED_POINTS.inc(len(points), action="written")
+        if not runs:
+            return entries
+        entries = [entry for entry in entries if entry.id not in removed] + written
+        entries.sort(key=lambda entry: entry.timestamp)
+        return entries
+
+    def deduplicate(self, entries: List[Entry]) -> List[Entry]:
+        """Drop near-identical points, window by window; returns the rest"""
+        if self.dedup_threshold <= 0:
+            return entries
+        candidates = [e for e in entries if e.payload.get("type") != "summary"]
+        dropped = set()
+        for start in range(0, len(candidates), self.dedup_window):
+            window = candidates[start : start + self.dedup_window]
+            if len(window) < 2:
+                continue
+            points = self.client.retrieve(
+                collection_name=self.collection,
+                ids=[entry.id for entry in window],
+                with_vectors=True,
+            )
+            vectors = {point.id: _dense_vector(point.vector) for point in points}
+            window = [entry for entry in window if vectors.get(entry.id) is not None]
+            if len(window) < 2:
+                continue
+            matrix = np.asarray([vectors[entry.id] for entry in window], np.float32)
+            ids = [window[i].id for i in near_duplicates(matrix, self.dedup_threshold)]
+            self._delete_ids(ids)
+            dropped.update(ids)
+            COMPACTED_POINTS.inc(len(ids), action="deduplicated")
+        return [entry for entry in entries if entry.id not in dropped]
+
+    def compact_chat(self, chat_id: int) -> Dict[str, int]:
+        """Run all steps on one chat; returns how many points each removed"""
+        with metrics.span("compaction", chat_id=chat_id):
+            entries = self._entries(chat_id)
+            before = len(entries)
+            entries = self.expire(chat_id, entries)
+            expired = before - len(entries)
+            entries = self.merge(entries)
+            merged = before - expired - len(entries)
+            entries = self.deduplicate(entries)
+        return {
+            "expired": expired,
+            "merged": merged,
+            "deduplicated": before - expired - merged - len(entries),
+        }
+
+    def chat_ids(self) -> List[int]:
+        chat_ids = set()
+        offset = None
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=self.collection,
+                limit=1024,
+                offset=offset,
+                with_payload=["chat_id"],
+                with_vectors=False,
+            )
+            chat_ids.update(
+                point.payload["chat_id"]
+                for point in points
+                if point.payload and "chat_id" in point.payload
+            )
+            if offset is None:
+                break
+        return sorted(
+            chat_id for chat_id in chat_ids if self.owns is None or self.owns(chat_id)
+        )
+
+    def _sample(self, count: int, with_payload, with_vectors=False) -> list:
+        """Random points that have a chat_id, picked by Qdrant without a scroll"""
+        return self.client.query_points(
+            collection_name=self.collection,
+            query=models.SampleQuery(sample=models.Sample.RANDOM),
+            query_filter=models.Filter(
+                must_not=[
+                    models.IsEmptyCondition(is_empty=models.PayloadField(key="chat_id"))
+                ]
+            ),
+            limit=count,
+            with_payload=with_payload,
+            with_vectors=with_vectors,
+        ).points
+
+    def sample_queries(self, count: int = 20) -> List[Tuple[list, int]]:
+        """Stored vectors of random points, to search with as if they were queries"""
+        points = self._sample(count, ["chat_id"], with_vectors=True)
+        return [
+            (_dense_vector(point.vector), point.payload["chat_id"])
+            for point in points
+            if _dense_vector(point.vector) is not None
+        ]
+
+    def stats(
+        self, queries: List[Tuple[list, int]], repeats: int = 3, payload_sample=256
+    ) -> dict:
+        """Point count, estimated memory and median filtered search latency"""
+        points = self.client.count(collection_name=self.collection, exact=True).count
+        # Payload size is extrapolated from a random sample of points
+        sample = self._sample(payload_sample, True)
+        payload_bytes = (
+            points
+            * sum(len(json.dumps(p.payload, ensure_ascii=False)) for p in sample)
+            / len(sample)
+            if sample
+            else 0
+        )
+        info = self.client.get_collection(self.collection)
+        vectors = info.config.params.vectors
+        dense = vectors.get("") if isinstance(vectors, dict) else vectors
+        # Quantized vectors are what stays in RAM, one byte per dimension
+        bytes_per_dim = 1 if info.config.quantization_config else 4
+        # Layer 0 of HNSW keeps up to 2 * m links of 4 bytes per point
+        hnsw_bytes = points * 2 * info.config.hnsw_config.m * 4
+        latencies = []
+        for vector, chat_id in queries:
+            for _ in range(repeats):
+                started = time.perf_counter()
+                self.client.query_points(
+                    collection_name=self.collection,
+                    query=vector,
+                    query_filter=models.Filter(must=[_chat_condition(chat_id)]),
+                    limit=3,
+                )
+                latencies.append((time.perf_counter() - started) * 1000)
+        return {
+            "points": points,
+            "memory_mb": (
+                points * dense.size * bytes_per_dim + hnsw_bytes + payload_bytes
+            )
+            / 2**20,
+            "search_ms": statistics.median(latencies) if latencies else 0.0,
+        }
+
+    def _paused(self) -> bool:
+        if db.migration_in_progress(self.client, self.collection):
+            logging.info("Идёт миграция коллекции, сжатие памяти отложено")
+            return True
+        return False
+
+    def run(self, chat_ids: Optional[List[int]] = None, measure: bool = True) -> dict:
+        """
+        Compact the given chats, or all of them; returns the counts and, when
+        measure is set, the collection stats before and after.
+        """
+        if self._paused():
+            return {}
+        if measure:
+            queries = self.sample_queries()
+            before = self.stats(queries)
+        totals: Counter = Counter()
+        for chat_id in chat_ids if chat_ids is not None else self.chat_ids():
+            if self._stop.is_set() or self._paused():
+                break
+            try:
+                totals.update(self.compact_chat(chat_id))
+            except Exception:
+                logging.exception(f"Не удалось сжать память чата {chat_id}")
+        summary = (
+            f"Сжатие памяти{' (пробный прогон)' if self.dry_run else ''}: "
+            f"удалено по сроку {totals['expired']}, склеено {totals['merged']}, "
+            f"дубликатов {totals['deduplicated']}"
+        )
+        if not measure:
+            logging.info(summary)
+            return dict(totals)
+        after = self.stats(queries)
+        logging.info(
+            f"{summary}; "
+            f"точек {before['points']} -> {after['points']}, "
+            f"память ~{before['memory_mb']:.2f} -> {after['memory_mb']:.2f} МБ, "
+            f"поиск {before['search_ms']:.2f} -> {after['search_ms']:.2f} мс"
+        )
+        return {"before": before, "after": after, **totals}
+
+    def start(self, interval: float, measure: bool = False) -> None:
+        """Run every interval seconds in a background thread"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._loop,
+            args=(interval, measure),
+            name="memory-compaction",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _loop(self, interval: float, measure: bool) -> None:
+        while not self._stop.wait(interval):
+            try:
+                self.run(measure=measure)
+            except Exception:
+                logging.exception("Сжатие памяти не удалось")
+
+    def close(self) -> None:
+        """Stop after the chat being compacted"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def create_compactor(
+    build_points: Callable[[list], list],
+    client: Optional[QdrantClient] = None,
+    dry_run: bool = False,
+) -> Compactor:
+    """Compactor configured from config.py"""
+    return Compactor(
+        client or db.get_qdrant_client(),
+        config.QDRANT_COLLECTION,
+        build_points,
+        min_age_hours=config.COMPACTION_MIN_AGE_HOURS,
+        small_chars=config.COMPACTION_SMALL_CHARS,
+        chunk_chars=config.COMPACTION_CHUNK_CHARS,
+        merge_gap_minutes=config.COMPACTION_MERGE_GAP_MINUTES,
+        dedup_threshold=config.COMPACTION_DEDUP_THRESHOLD,
+        dedup_window=config.COMPACTION_DEDUP_WINDOW,
+        ttl_days=config.MEMORY_TTL_DAYS,
+        max_points=config.MEMORY_MAX_POINTS,
+        policies=config.RETENTION_POLICIES,
+        # Webhook workers each maintain the chats of their shard
+        owns=worker_owns(),
+        dry_run=dry_run,
+    )
+
+
+def main():
+    """CLI entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--chat-id", type=int, action="append", help="только этот чат (можно несколько)"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="только посчитать, ничего не менять"
+    )
+    args = parser.parse_args()
+    from rag_engine import RagEngine
+
+    rag = RagEngine()
+    create_compactor(rag.build_points, rag.client, args.dry_run).run(args.chat_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import json
 import os
 import random
 from datetime import datetime, timezone, timedelta
@@ -5,13 +6,114 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+
+def _getenv_bool(name: str, default: bool) -> bool:
+    """Read a yes/no flag from the environment"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 BOT_USERNAME = os.getenv("BOT_USERNAME")
 ADMINS = [int(x) for x in os.getenv("ADMINS", "").split(",") if x]
+# "polling" — blocking TeleBot, "async" — AsyncTeleBot with concurrent chats,
+# "webhook" — HTTP ingress and WEBHOOK_WORKERS worker processes (webhook.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+# Webhook mode: Telegram posts updates to WEBHOOK_URL, which must reach
+# WEBHOOK_PATH on WEBHOOK_PORT; the secret is checked on every request
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_BODY = int(os.getenv("WEBHOOK_MAX_BODY", 1 << 20))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+# Worker processes = chat shards; a standalone worker serves WORKER_SHARD
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 2))
+WORKER_SHARD = int(os.getenv("WORKER_SHARD", 0))
+# Queue between ingress and workers: "local" (one machine) or "redis";
+# REDIS_URL=memory:// is an in-process stand-in for Redis
+WORK_QUEUE_BACKEND = os.getenv("WORK_QUEUE_BACKEND", "local")
+WORK_QUEUE_MAX_SIZE = int(os.getenv("WORK_QUEUE_MAX_SIZE", 10000))
+WORK_QUEUE_PREFIX = os.getenv("WORK_QUEUE_PREFIX", "ragbot:updates")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
 QDRANT_HOST = os.getenv("QDRANT_HOST", "localhost:6333")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY", "")
 QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION", "telegram_history")
+# One pooled client per process; gRPC (port QDRANT_GRPC_PORT) is opt-in.
+# Idempotent calls are retried QDRANT_RETRIES times on transient errors
+QDRANT_TIMEOUT = float(os.getenv("QDRANT_TIMEOUT", 5))
+QDRANT_GRPC = _getenv_bool("QDRANT_GRPC", False)
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", 6334))
+QDRANT_POOL_SIZE = int(os.getenv("QDRANT_POOL_SIZE", 32))
+QDRANT_RETRIES = int(os.getenv("QDRANT_RETRIES", 3))
+
+# Storage profile of the Qdrant collection, see COLLECTION_PROFILES.
+# Switching profiles on a live collection: python migrate.py --profile <name>
+QDRANT_PROFILE = os.getenv("QDRANT_PROFILE", "default")
+# Quantized profiles search the compact copy for oversampling * limit
+# candidates and, with rescore, re-rank them by the original vectors: more
+# oversampling buys back recall for memory. Binary needs more than int8
+COLLECTION_PROFILES = {
+    # Plain float32 vectors in RAM
+    "default": {
+        "quantization": None,
+        "on_disk": False,
+        "m": 16,
+        "ef_construct": 100,
+        "rescore": False,
+        "oversampling": 1.0,
+    },
+    # int8 copy in RAM (4x smaller), originals in RAM for rescoring
+    "int8": {
+        "quantization": "int8",
+        "on_disk": False,
+        "m": 16,
+        "ef_construct": 100,
+        "rescore": True,
+        "oversampling": 1.5,
+    },
+    # int8 copy in RAM, originals on disk — for a small VPS
+    "int8_on_disk": {
+        "quantization": "int8",
+        "on_disk": True,
+        "m": 16,
+        "ef_construct": 100,
+        "rescore": True,
+        "oversampling": 1.5,
+    },
+    # 1 bit per dimension in RAM (32x smaller), originals on disk
+    "binary_on_disk": {
+        "quantization": "binary",
+        "on_disk": True,
+        "m": 16,
+        "ef_construct": 100,
+        "rescore": True,
+        "oversampling": 3.0,
+    },
+}
+# Optional overrides of the HNSW parameters of the chosen profile
+QDRANT_HNSW_M = os.getenv("QDRANT_HNSW_M")
+QDRANT_HNSW_EF_CONSTRUCT = os.getenv("QDRANT_HNSW_EF_CONSTRUCT")
+# Optional override of the oversampling of the collection's profile
+QDRANT_OVERSAMPLING = os.getenv("QDRANT_OVERSAMPLING")
+
+# Hybrid retrieval: BM25 sparse vectors next to the dense ones, fused with RRF
+# in one Qdrant query. Older collections get the sparse vectors via migrate.py
+HYBRID_SEARCH = _getenv_bool("HYBRID_SEARCH", True)
+SPARSE_VECTOR_NAME = "bm25"
+BM25_K1 = float(os.getenv("BM25_K1", 1.2))
+BM25_B = float(os.getenv("BM25_B", 0.75))
+BM25_AVG_DOC_LENGTH = float(os.getenv("BM25_AVG_DOC_LENGTH", 50))
+# Candidates taken from each of the dense and sparse searches before fusion
+HYBRID_PREFETCH_LIMIT = int(os.getenv("HYBRID_PREFETCH_LIMIT", 20))
+# Seconds between checks whether the collection behind the alias gained or
+# lost BM25 vectors or changed profile (migrate.py swaps it under a running bot)
+HYBRID_RECHECK_INTERVAL = float(os.getenv("HYBRID_RECHECK_INTERVAL", 60))
 
 TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
 EMBEDDING_MODEL = os.getenv(
@@ -22,10 +124,201 @@ ARTEM_USERNAME = os.getenv("ARTEM_USERNAME")
 ALEX_USERNAME = os.getenv("ALEX_USERNAME")
 DAN_USERNAME = os.getenv("DAN_USERNAME")
 N_LAST_MESSAGES = int(os.getenv("N_LAST_MESSAGES", 10))
+# Chat history store: idle chats beyond HISTORY_MAX_CHATS leave memory; with a
+# database path, history and pending author groups survive restarts
+HISTORY_MAX_CHATS = int(os.getenv("HISTORY_MAX_CHATS", 1000))
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "")
+HISTORY_SNAPSHOT_INTERVAL = float(os.getenv("HISTORY_SNAPSHOT_INTERVAL", 5))
+
+# Rolling summaries (opt-in): prompts get a per-chat summary and a raw tail of
+# SUMMARY_TAIL_MESSAGES instead of N_LAST_MESSAGES. Messages leaving the tail
+# are folded into the summary in the background, SUMMARY_FOLD_MESSAGES at a
+# time, by SUMMARY_LLM_MODEL (empty: the main LLM)
+SUMMARIES_ENABLED = _getenv_bool("SUMMARIES_ENABLED", False)
+SUMMARY_TAIL_MESSAGES = int(os.getenv("SUMMARY_TAIL_MESSAGES", 4))
+SUMMARY_FOLD_MESSAGES = int(os.getenv("SUMMARY_FOLD_MESSAGES", 6))
+SUMMARY_MAX_WORDS = int(os.getenv("SUMMARY_MAX_WORDS", 120))
+SUMMARY_QUEUE_SIZE = int(os.getenv("SUMMARY_QUEUE_SIZE", 256))
+SUMMARY_LLM_MODEL = os.getenv("SUMMARY_LLM_MODEL", "")
+
+# Memory maintenance (compaction.py): retention, merging of small author
+# groups and removal of near-duplicates. The bot runs it every
+# COMPACTION_INTERVAL seconds; 0 leaves it to `python compaction.py` in cron
+COMPACTION_INTERVAL = float(os.getenv("COMPACTION_INTERVAL", 0))
+# Periodic runs also measure point count, memory and search latency before
+# and after; each measurement samples points and runs test searches
+COMPACTION_MEASURE = _getenv_bool("COMPACTION_MEASURE", False)
+# Points younger than this are left alone: their chat is still being indexed
+COMPACTION_MIN_AGE_HOURS = float(os.getenv("COMPACTION_MIN_AGE_HOURS", 24))
+# Same-author documents shorter than COMPACTION_SMALL_CHARS, written at most
+# COMPACTION_MERGE_GAP_MINUTES apart, merge into documents of up to
+# COMPACTION_CHUNK_CHARS
+COMPACTION_SMALL_CHARS = int(os.getenv("COMPACTION_SMALL_CHARS", 300))
+COMPACTION_CHUNK_CHARS = int(os.getenv("COMPACTION_CHUNK_CHARS", 1500))
+COMPACTION_MERGE_GAP_MINUTES = float(os.getenv("COMPACTION_MERGE_GAP_MINUTES", 60))
+# Cosine similarity at which the older of two points is dropped; 0 turns it off
+COMPACTION_DEDUP_THRESHOLD = float(os.getenv("COMPACTION_DEDUP_THRESHOLD", 0.97))
+# Points compared with each other at once, in time order
+COMPACTION_DEDUP_WINDOW = int(os.getenv("COMPACTION_DEDUP_WINDOW", 2048))
+# Retention for every chat: points older than MEMORY_TTL_DAYS, and beyond the
+# newest MEMORY_MAX_POINTS of a chat, are deleted (0: keep). Per-chat
+# overrides as JSON: {"-100123": {"ttl_days": 30, "max_points": 5000}}
+MEMORY_TTL_DAYS = float(os.getenv("MEMORY_TTL_DAYS", 0))
+MEMORY_MAX_POINTS = int(os.getenv("MEMORY_MAX_POINTS", 0))
+RETENTION_POLICIES = {
+    int(chat_id): policy
+    for chat_id, policy in json.loads(os.getenv("RETENTION_POLICIES", "{}")).items()
+}
+
+# Prompt token budget: the window minus the answer reserve is shared between
+# chat history and retrieved memory / search results
+LLM_CONTEXT_WINDOW = int(os.getenv("LLM_CONTEXT_WINDOW", 8000))
+PROMPT_RESERVED_OUTPUT_TOKENS = int(os.getenv("PROMPT_RESERVED_OUTPUT_TOKENS", 512))
+PROMPT_HISTORY_SHARE = float(os.getenv("PROMPT_HISTORY_SHARE", 0.35))
+PROMPT_MAX_SNIPPET_TOKENS = int(os.getenv("PROMPT_MAX_SNIPPET_TOKENS", 300))
+PROMPT_MAX_RESULT_TOKENS = int(os.getenv("PROMPT_MAX_RESULT_TOKENS", 150))
+
+# Re-ranking of retrieved memory: RERANK_FETCH_K candidates are fetched with
+# their vectors, favoured when recent, optionally scored by a CPU cross-encoder
+# and diversified with MMR down to top_k. RERANK_FETCH_K=0 turns the stage off
+RERANK_FETCH_K = int(os.getenv("RERANK_FETCH_K", 12))
+RERANK_MMR_LAMBDA = float(os.getenv("RERANK_MMR_LAMBDA", 0.5))
+RERANK_DECAY_HALF_LIFE_DAYS = float(os.getenv("RERANK_DECAY_HALF_LIFE_DAYS", 180))
+RERANK_DECAY_WEIGHT = float(os.getenv("RERANK_DECAY_WEIGHT", 0.2))
+# e.g. cross-encoder/mmarco-mMiniLMv2-L12-H384-v1; empty skips the cross-encoder
+RERANK_CROSS_ENCODER_MODEL = os.getenv("RERANK_CROSS_ENCODER_MODEL", "")
+RERANK_CROSS_ENCODER_MAX_LENGTH = int(os.getenv("RERANK_CROSS_ENCODER_MAX_LENGTH", 256))
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", 50))
+
+# Observability: /metrics HTTP port (0 disables) and share of prompts logged at INFO
+METRICS_PORT = int(os.getenv("METRICS_PORT", 8000))
+PROMPT_LOG_SAMPLE_RATE = float(os.getenv("PROMPT_LOG_SAMPLE_RATE", 0.0))
+
+# Background indexing of chat messages into Qdrant
+INDEX_QUEUE_SIZE = int(os.getenv("INDEX_QUEUE_SIZE", 1000))
+INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", 32))
+INDEX_FLUSH_INTERVAL = float(os.getenv("INDEX_FLUSH_INTERVAL", 10))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 64))
+# Embedding cache: in-memory LRU cap and optional persistent directory, which
+# stops growing at EMBED_CACHE_DISK_MAX_MB (0: no cap)
+EMBED_CACHE_MEMORY_MB = float(os.getenv("EMBED_CACHE_MEMORY_MB", 64))
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", "")
+EMBED_CACHE_DISK_MAX_MB = float(os.getenv("EMBED_CACHE_DISK_MAX_MB", 1024))
+# Embedding inference: torch (fp32), onnx (fp32) or onnx-int8 (dynamic quantization)
+EMBED_INFERENCE_BACKEND = os.getenv("EMBED_INFERENCE_BACKEND", "torch")
+EMBED_NUM_THREADS = int(os.getenv("EMBED_NUM_THREADS", 0))  # 0 = runtime default
+EMBED_MAX_SEQ_LENGTH = int(os.getenv("EMBED_MAX_SEQ_LENGTH", 0))  # 0 = model default
+# Exported/quantized ONNX models are kept here so they are built only once
+EMBED_ONNX_DIR = os.getenv("EMBED_ONNX_DIR", "onnx_models")
+EMBED_QUANTIZATION_CONFIG = os.getenv("EMBED_QUANTIZATION_CONFIG", "avx512_vnni")
+# Max allowed 1 - cosine between ONNX and fp32 vectors; 0 skips the check.
+# Measured once per export and stored with it in EMBED_ONNX_DIR
+EMBED_FP32_TOLERANCE = float(os.getenv("EMBED_FP32_TOLERANCE", 0.02))
+# Micro-batching: concurrent embedding requests share model calls (1 disables)
+EMBED_BATCH_MAX_ITEMS = int(os.getenv("EMBED_BATCH_MAX_ITEMS", 32))
+EMBED_BATCH_MAX_DELAY_MS = float(os.getenv("EMBED_BATCH_MAX_DELAY_MS", 5))
+EMBED_BATCH_MAX_PENDING = int(os.getenv("EMBED_BATCH_MAX_PENDING", 1024))
+
+# Streaming answers: the placeholder is edited while the LLM is generating.
+# Telegram allows roughly one edit per second per message, fewer in busy groups.
+STREAM_ANSWERS = _getenv_bool("STREAM_ANSWERS", True)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.0))
+STREAM_MIN_DELTA_CHARS = int(os.getenv("STREAM_MIN_DELTA_CHARS", 20))
+
+# Scheduler between handlers and MessageProcessor: one job at a time per chat,
+# at most LLM_CONCURRENCY answers generated at once, cheap replies first
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 4))
+SCHEDULER_CHEAP_WORKERS = int(os.getenv("SCHEDULER_CHEAP_WORKERS", 2))
+# Outgoing Telegram calls per second (Bot API flood limits): whole bot, one
+# private chat, one group; a chat may get TELEGRAM_CHAT_BURST back to back
+TELEGRAM_RATE = float(os.getenv("TELEGRAM_RATE", 30))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", 20 / 60))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", 3))
+# Bot API connections: TELEGRAM_API_URL points at another server (a local Bot
+# API server or a fake one in tests); sessions are recycled after
+# TELEGRAM_SESSION_TTL seconds. Failed sends are retried TELEGRAM_RETRIES times
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", 5))
+TELEGRAM_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", 30))
+TELEGRAM_SESSION_TTL = float(os.getenv("TELEGRAM_SESSION_TTL", 600))
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", 50))
+TELEGRAM_RETRIES = int(os.getenv("TELEGRAM_RETRIES", 3))
+
+# Semantic answer cache in front of RagEngine.query / search_web (opt-in)
+RESPONSE_CACHE_ENABLED = _getenv_bool("RESPONSE_CACHE_ENABLED", False)
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", 0.95))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 3600))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 500))
+
+# Backends: production services or local stand-ins for benchmarks and offline runs
+LLM_BACKEND = os.getenv("LLM_BACKEND", "together")  # together | fake
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "sentence-transformers")  # | hash
+# duckduckgo | google | canned | fixture
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "duckduckgo")
+QDRANT_BACKEND = os.getenv("QDRANT_BACKEND", "remote")  # remote | memory
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", 1.0))
+FAKE_LLM_TOKENS_PER_SECOND = float(os.getenv("FAKE_LLM_TOKENS_PER_SECOND", 50))
+FAKE_SEARCH_LATENCY = float(os.getenv("FAKE_SEARCH_LATENCY", 0.5))
+
+# LLM calls: the whole call, retries included, must finish in LLM_DEADLINE
+# seconds, one attempt in LLM_ATTEMPT_TIMEOUT, the first streamed token in
+# LLM_FIRST_TOKEN_TIMEOUT. An attempt still running after LLM_HEDGE_AFTER
+# seconds gets a twin request and the first answer wins (0: no hedging).
+# LLM_BREAKER_FAILURES transient failures in a row stop calls for
+# LLM_BREAKER_RESET seconds, and the bot answers with FALLBACK_MESSAGES
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", 45))
+LLM_ATTEMPT_TIMEOUT = float(os.getenv("LLM_ATTEMPT_TIMEOUT", 20))
+LLM_FIRST_TOKEN_TIMEOUT = float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT", 15))
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", 3))
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", 8))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", 5))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", 30))
+# OpenAI-compatible endpoint instead of Together's (a fake server in tests)
+TOGETHER_API_BASE = os.getenv("TOGETHER_API_BASE", "")
+# Backoff between retries: random up to RETRY_BASE_DELAY * 2^attempt, capped
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 0.2))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 2))
+
+# Small local model on CPU next to the remote one (empty: off).
+# llama_cpp loads the quantized GGUF at LOCAL_LLM_MODEL_PATH (needs the optional
+# llama-index-llms-llama-cpp package, not in requirements.txt); fake is a stand-in
+LOCAL_LLM_BACKEND = os.getenv("LOCAL_LLM_BACKEND", "")  # | llama_cpp | fake
+LOCAL_LLM_MODEL_PATH = os.getenv("LOCAL_LLM_MODEL_PATH", "")
+LOCAL_LLM_CONTEXT_WINDOW = int(os.getenv("LOCAL_LLM_CONTEXT_WINDOW", 2048))
+LOCAL_LLM_MAX_TOKENS = int(os.getenv("LOCAL_LLM_MAX_TOKENS", 160))
+LOCAL_LLM_TEMPERATURE = float(os.getenv("LOCAL_LLM_TEMPERATURE", 0.7))
+LOCAL_LLM_THREADS = int(os.getenv("LOCAL_LLM_THREADS", 0))  # 0: llama.cpp decides
+FAKE_LOCAL_LLM_LATENCY = float(os.getenv("FAKE_LOCAL_LLM_LATENCY", 0.2))
+# Routing: questions of LLM_ROUTE_LOCAL_KINDS (query | search) up to
+# LLM_ROUTE_LOCAL_MAX_CHARS characters go to the local model when it is free.
+# A remote answer not ready after LLM_ROUTE_FALLBACK_AFTER seconds is raced by
+# the local model (0: local only once the remote call has failed)
+LLM_ROUTE_LOCAL_MAX_CHARS = int(os.getenv("LLM_ROUTE_LOCAL_MAX_CHARS", 60))
+LLM_ROUTE_LOCAL_KINDS = [
+    kind.strip()
+    for kind in os.getenv("LLM_ROUTE_LOCAL_KINDS", "query").split(",")
+    if kind.strip()
+]
+LLM_ROUTE_FALLBACK_AFTER = float(os.getenv("LLM_ROUTE_FALLBACK_AFTER", 10))
+# Models load lazily; with warm-up on they are loaded by a background thread
+# right after start instead of by the first request that needs them
+WARM_UP_MODELS = _getenv_bool("WARM_UP_MODELS", True)
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 SEARCH_ENGINE = os.getenv("SEARCH_ENGINE")
 
+# Web search layer: per-provider timeout, optional fallback provider and a
+# result cache keyed on the normalized query (memory, plus disk if a dir is set)
+SEARCH_FALLBACK_BACKEND = os.getenv("SEARCH_FALLBACK_BACKEND", "")
+SEARCH_TIMEOUT = float(os.getenv("SEARCH_TIMEOUT", 5))
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", 5))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", 3600))  # 0 disables
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 256))
+SEARCH_CACHE_DIR = os.getenv("SEARCH_CACHE_DIR", "")
+# Recorded responses for SEARCH_BACKEND=fixture: {"query": [results], "*": [...]}
+SEARCH_FIXTURE_PATH = os.getenv("SEARCH_FIXTURE_PATH", "search_fixture.json")
+
 PENDING_MESSAGES = [
     "Погодь...",
     "Ща...",
@@ -52,32 +345,53 @@ REMEMBER_RESPONSES = [
     "✅ Ладно, запомнил, но зачем мне это",
 ]
 
+# Sent instead of an answer when the LLM or the memory is unavailable
+FALLBACK_MESSAGES = [
+    "чёт мозги отвалились, спроси через минуту",
+    "нейронка прилегла отдохнуть. попробуй позже",
+    "я завис. не ты первый, не ты последний",
+    "сервер думает, что ты его достал. давай попозже",
+]
+
 # Timezone for Moscow (UTC+3)
 MSK = timezone(timedelta(hours=3))
 
 
-def get_mood() -> str:
-    """Return a mood modifier based on time of day (Moscow time)."""
+def get_mood_bucket() -> str:
+    """Return the time-of-day bucket (Moscow time) that drives the mood."""
     hour = datetime.now(MSK).hour
 
     if 0 <= hour < 6:
-        return (
-            "Сейчас ночь, ты не выспался и философствуешь. "
-            "Отвечаешь задумчиво, лениво, иногда глубокомысленно, иногда бредово. "
-            "Можешь спросить собеседника какого хрена он не спит."
-        )
+        return "night"
     elif 6 <= hour < 10:
-        return (
-            "Сейчас раннее утро, ты раздражён и не выспался. "
-            "Отвечаешь ворчливо и недовольно. Всё бесит."
-        )
+        return "morning"
     elif 10 <= hour < 18:
-        return "Дневной режим. Ты в нормальном настроении, но всё ещё токсичный друг."
+        return "day"
     else:
-        return (
-            "Вечер. Ты расслаблен, более дружелюбный чем обычно, "
-            "но всё ещё подъёбываешь."
-        )
+        return "evening"
+
+
+MOODS = {
+    "night": (
+        "Сейчас ночь, ты не выспался и философствуешь. "
+        "Отвечаешь задумчиво, лениво, иногда глубокомысленно, иногда бредово. "
+        "Можешь спросить собеседника какого хрена он не спит."
+    ),
+    "morning": (
+        "Сейчас раннее утро, ты раздражён и не выспался. "
+        "Отвечаешь ворчливо и недовольно. Всё бесит."
+    ),
+    "day": "Дневной режим. Ты в нормальном настроении, но всё ещё токсичный друг.",
+    "evening": (
+        "Вечер. Ты расслаблен, более дружелюбный чем обычно, "
+        "но всё ещё подъёбываешь."
+    ),
+}
+
+
+def get_mood() -> str:
+    """Return a mood modifier based on time of day (Moscow time)."""
+    return MOODS[get_mood_bucket()]
 
 
 # Passive reactions — bot responds without being mentioned
@@ -104,3 +418,8 @@ PASSIVE_TRIGGERS = {
         "наконец-то тишина",
     ],
 }
+
+# Passive triggers can also live in a JSON file of the same shape, re-read on
+# change without a restart
+TRIGGERS_PATH = os.getenv("TRIGGERS_PATH", "")
+TRIGGERS_RELOAD_INTERVAL = float(os.getenv("TRIGGERS_RELOAD_INTERVAL", 5))
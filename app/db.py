@@ -1,13 +1,341 @@
-from qdrant_client import QdrantClient
+import functools
+import inspect
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+import httpx
+from qdrant_client import AsyncQdrantClient, QdrantClient, models
 import os
 
 import config as config
+from resilience import create_retry
 
 
-def get_qdrant_client() -> QdrantClient:
-    return QdrantClient(
+class _SerializedQdrantClient(QdrantClient):
+    """In-process Qdrant is not thread-safe: handlers and the indexer take turns"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        lock = threading.RLock()
+        for name in dir(QdrantClient):
+            if name.startswith("_") or not inspect.isfunction(
+                getattr(QdrantClient, name)
+            ):
+                continue
+            method = getattr(self, name)
+
+            def locked(*a, _method=method, **kw):
+                with lock:
+                    return _method(*a, **kw)
+
+            setattr(self, name, functools.wraps(method)(locked))
+
+
+# Shared in-process instance for QDRANT_BACKEND=memory
+_memory_client: Optional[QdrantClient] = None
+# One remote client per process: its connection pool is shared by every caller
+_remote_client: Optional[QdrantClient] = None
+_remote_lock = threading.Lock()
+
+# Calls retried on transient errors. Points have deterministic ids, so a
+# repeated upsert or delete leaves the same state as one that went through
+RETRIED_METHODS = (
+    "count",
+    "delete",
+    "get_collection",
+    "query_batch_points",
+    "query_points",
+    "retrieve",
+    "scroll",
+    "set_payload",
+    "upsert",
+)
+
+
+def _remote_settings() -> dict:
+    return dict(
         host=config.QDRANT_HOST,
-        api_key=config.QDRANT_API_KEY,
+        api_key=config.QDRANT_API_KEY or None,
         port=6333,
         https=False,
+        timeout=config.QDRANT_TIMEOUT,
+        prefer_grpc=config.QDRANT_GRPC,
+        grpc_port=config.QDRANT_GRPC_PORT,
+        # Keep-alive connections are reused by handlers, indexer and retrieval
+        limits=httpx.Limits(
+            max_connections=config.QDRANT_POOL_SIZE,
+            max_keepalive_connections=config.QDRANT_POOL_SIZE,
+        ),
+    )
+
+
+def _with_retries(client):
+    retry = create_retry("qdrant", config.QDRANT_RETRIES)
+    for name in RETRIED_METHODS:
+        setattr(client, name, retry.wrap(getattr(client, name)))
+    return client
+
+
+def get_qdrant_client() -> QdrantClient:
+    global _memory_client, _remote_client
+    if config.QDRANT_BACKEND == "memory":
+        if _memory_client is None:
+            _memory_client = _SerializedQdrantClient(":memory:")
+        return _memory_client
+    with _remote_lock:
+        if _remote_client is None:
+            _remote_client = _with_retries(QdrantClient(**_remote_settings()))
+        return _remote_client
+
+
+def get_async_qdrant_client() -> Optional[AsyncQdrantClient]:
+    # An in-memory async client would not see the sync client's data
+    if config.QDRANT_BACKEND == "memory":
+        return None
+    return _with_retries(AsyncQdrantClient(**_remote_settings()))
+
+
+# Payload fields used to filter retrieval and migration; each gets a Qdrant
+# payload index. indexed_at is the write time (timestamp is the message time)
+PAYLOAD_INDEXES = {
+    "chat_id": models.PayloadSchemaType.INTEGER,
+    "author": models.PayloadSchemaType.KEYWORD,
+    "timestamp": models.PayloadSchemaType.INTEGER,
+    "indexed_at": models.PayloadSchemaType.INTEGER,
+}
+
+# Collection metadata key set while migrate.py copies the collection
+MIGRATION_MARKER = "migrating_to"
+
+
+def get_profile(name: Optional[str] = None) -> dict:
+    """Resolve a collection profile from config, applying HNSW overrides"""
+    name = name or config.QDRANT_PROFILE
+    if name not in config.COLLECTION_PROFILES:
+        raise ValueError(
+            f"Неизвестный профиль коллекции {name!r}, "
+            f"доступны: {', '.join(config.COLLECTION_PROFILES)}"
+        )
+    profile = dict(config.COLLECTION_PROFILES[name], name=name)
+    if config.QDRANT_HNSW_M:
+        profile["m"] = int(config.QDRANT_HNSW_M)
+    if config.QDRANT_HNSW_EF_CONSTRUCT:
+        profile["ef_construct"] = int(config.QDRANT_HNSW_EF_CONSTRUCT)
+    if config.QDRANT_OVERSAMPLING:
+        profile["oversampling"] = float(config.QDRANT_OVERSAMPLING)
+    return profile
+
+
+def collection_profile(client: QdrantClient, alias_name: str) -> dict:
+    """
+    Profile of the collection behind the alias, read from its versioned name;
+    config.QDRANT_PROFILE for collections without one
+    """
+    physical = resolve_collection(client, alias_name) or alias_name
+    prefix = f"{alias_name}_"
+    if physical.startswith(prefix):
+        name = physical[len(prefix) :].rsplit("_", 1)[0]
+        if name in config.COLLECTION_PROFILES:
+            return get_profile(name)
+    return get_profile()
+
+
+def search_params(profile: dict) -> Optional[models.SearchParams]:
+    """Rescoring and oversampling of a quantized profile; None without quantization"""
+    if not profile["quantization"]:
+        return None
+    return models.SearchParams(
+        quantization=models.QuantizationSearchParams(
+            rescore=profile["rescore"], oversampling=profile["oversampling"]
+        )
+    )
+
+
+def create_collection(
+    client: QdrantClient, collection_name: str, profile: dict
+) -> None:
+    """Create a physical collection with the storage settings of a profile"""
+    quantization_config = None
+    if profile["quantization"] == "int8":
+        quantization_config = models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8, quantile=0.99, always_ram=True
+            )
+        )
+    elif profile["quantization"] == "binary":
+        quantization_config = models.BinaryQuantization(
+            binary=models.BinaryQuantizationConfig(always_ram=True)
+        )
+    client.create_collection(
+        collection_name=collection_name,
+        vectors_config=models.VectorParams(
+            size=1024, distance=models.Distance.COSINE, on_disk=profile["on_disk"]
+        ),
+        # BM25 term weights; Qdrant multiplies them by IDF at query time
+        sparse_vectors_config={
+            config.SPARSE_VECTOR_NAME: models.SparseVectorParams(
+                index=models.SparseIndexParams(on_disk=profile["on_disk"]),
+                modifier=models.Modifier.IDF,
+            )
+        },
+        hnsw_config=models.HnswConfigDiff(
+            m=profile["m"], ef_construct=profile["ef_construct"]
+        ),
+        quantization_config=quantization_config,
+    )
+
+
+def has_sparse_vectors(client: QdrantClient, collection_name: str) -> bool:
+    """Whether the collection was created with the BM25 sparse vectors"""
+    sparse = client.get_collection(collection_name).config.params.sparse_vectors
+    return bool(sparse) and config.SPARSE_VECTOR_NAME in sparse
+
+
+def versioned_collection_name(alias_name: str, profile: dict) -> str:
+    """Name of a physical collection hidden behind the alias"""
+    return f"{alias_name}_{profile['name']}_{time.strftime('%Y%m%d%H%M%S')}"
+
+
+def resolve_collection(client: QdrantClient, name: str) -> Optional[str]:
+    """Physical collection behind an alias (or the name itself), None if missing"""
+    for alias in client.get_aliases().aliases:
+        if alias.alias_name == name:
+            return alias.collection_name
+    if client.collection_exists(name):
+        return name
+    return None
+
+
+def ensure_payload_indexes(client: QdrantClient, collection_name: str) -> None:
+    """Make sure the filtering payload fields are indexed"""
+    if config.QDRANT_BACKEND == "memory":
+        # Local Qdrant ignores payload indexes
+        return
+    existing = client.get_collection(collection_name).payload_schema or {}
+    for field, schema in PAYLOAD_INDEXES.items():
+        if field not in existing:
+            client.create_payload_index(
+                collection_name=collection_name,
+                field_name=field,
+                field_schema=schema,
+            )
+
+
+def ensure_collection(client: QdrantClient, collection_name: str) -> None:
+    """
+    Create the collection if needed and make sure payload indexes exist.
+    New collections live behind an alias so that migrate.py can swap them.
+    """
+    physical = resolve_collection(client, collection_name)
+    if physical is None:
+        profile = get_profile()
+        physical = versioned_collection_name(collection_name, profile)
+        try:
+            create_collection(client, physical, profile)
+            # Another process (e.g. a webhook worker) may have claimed the alias
+            if resolve_collection(client, collection_name) is None:
+                client.update_collection_aliases(
+                    change_aliases_operations=[
+                        models.CreateAliasOperation(
+                            create_alias=models.CreateAlias(
+                                collection_name=physical, alias_name=collection_name
+                            )
+                        )
+                    ]
+                )
+                logging.info(
+                    f"Создана коллекция {physical} (профиль {profile['name']})"
+                )
+        except Exception:
+            # Lost the race: the same name or the alias already exists
+            if resolve_collection(
+                client, collection_name
+            ) is None and not client.collection_exists(physical):
+                raise
+        existing = resolve_collection(client, collection_name)
+        if existing is not None and existing != physical:
+            # The collection we created is empty and nothing points to it
+            if client.collection_exists(physical):
+                client.delete_collection(physical)
+            physical = existing
+    ensure_payload_indexes(client, physical)
+
+
+# Collection metadata key set once every point has its chat payload
+BACKFILL_MARKER = "chat_payload_backfilled"
+
+
+def collection_metadata(client: QdrantClient, collection_name: str) -> dict:
+    """Metadata of a collection; empty on Qdrant servers without it (< 1.16)"""
+    info = client.get_collection(collection_name)
+    return getattr(info.config, "metadata", None) or {}
+
+
+def migration_in_progress(client: QdrantClient, collection_name: str) -> bool:
+    """Whether migrate.py is copying the collection behind the alias"""
+    physical = resolve_collection(client, collection_name) or collection_name
+    return bool(collection_metadata(client, physical).get(MIGRATION_MARKER))
+
+
+def backfill_chat_payload(
+    client: QdrantClient, collection_name: str, batch_size: int = 256
+) -> int:
+    """
+    Add chat_id/timestamp payload to points indexed before they were stored.
+    Old document ids look like "{chat_id}_{message_id}". A finished backfill
+    is recorded in the collection metadata, so later starts skip the scan.
+    """
+    physical = resolve_collection(client, collection_name) or collection_name
+    if collection_metadata(client, physical).get(BACKFILL_MARKER):
+        return 0
+    missing = models.Filter(
+        must=[models.IsEmptyCondition(is_empty=models.PayloadField(key="chat_id"))]
     )
+    updated = 0
+    skipped = 0
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=physical,
+            scroll_filter=missing,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=False,
+        )
+        for point in points:
+            payload = point.payload or {}
+            doc_id = payload.get("doc_id") or payload.get("ref_doc_id") or ""
+            try:
+                patch = {"chat_id": int(doc_id.rsplit("_", 1)[0])}
+            except (AttributeError, ValueError):
+                # Not an old message id: left as it is
+                skipped += 1
+                continue
+            try:
+                patch["timestamp"] = int(
+                    datetime.fromisoformat(payload["date"]).timestamp()
+                )
+            except (KeyError, TypeError, ValueError):
+                # No usable date: the point gets its chat but no timestamp
+                pass
+            client.set_payload(
+                collection_name=physical, payload=patch, points=[point.id]
+            )
+            updated += 1
+        if offset is None:
+            break
+    if updated:
+        logging.info(f"Добавлен chat_id в payload {updated} старых точек")
+    if skipped:
+        logging.warning(f"Не удалось добавить chat_id в payload {skipped} точек")
+    try:
+        client.update_collection(
+            collection_name=physical, metadata={BACKFILL_MARKER: True}
+        )
+    except Exception:
+        # Qdrant before 1.16 has no collection metadata: scan again next time
+        logging.warning(f"Не удалось отметить дозаполнение payload в {physical}")
+    return updated
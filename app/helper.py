@@ -2,9 +2,14 @@ import logging
 import random
 from telebot import TeleBot, logger as telebot_logger
 import config as config
+import metrics as metrics
 from rag_engine import RagEngine
+from indexer import IndexingQueue, create_indexing_queue
+from chat_state import ChatState, ChatStateStore, create_chat_store
+from summarizer import ChatSummarizer, create_summarizer
+from compaction import Compactor, create_compactor
 from datetime import datetime
-from typing import Dict, List, Optional, Union, Callable
+from typing import AsyncIterator, Iterator, List, Optional, Union, Callable
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -14,14 +19,35 @@ telebot_logger.setLevel(logging.INFO)
 class MessageProcessor:
     """Handles message processing, history tracking, and RAG operations"""
 
-    def __init__(self, rag_engine: RagEngine, history_size: int = 10):
+    def __init__(
+        self,
+        rag_engine: RagEngine,
+        history_size: int = 10,
+        indexer: Optional[IndexingQueue] = None,
+        chats: Optional[ChatStateStore] = None,
+    ):
         """Initialize the message processor with RAG engine and history settings"""
         self.rag = rag_engine
+        if config.SUMMARIES_ENABLED:
+            # Older messages reach prompts through the chat's summary
+            history_size = min(history_size, config.SUMMARY_TAIL_MESSAGES)
         self.history_size = history_size
-        # State management
-        self.current_doc: Dict[int, dict] = {}  # chat_id -> current document
-        self.last_user: Dict[int, str] = {}  # chat_id -> username of last author
-        self.last_messages: Dict[int, List[str]] = {}  # chat_id -> message history
+        # Documents are embedded and upserted in the background, never on handlers
+        self.indexer = indexer or create_indexing_queue(rag_engine)
+        # Per-chat history and current author document; survives restarts
+        self.chats = chats or create_chat_store(
+            history_size, on_evict=lambda chat_id, doc: self.index_document(doc)
+        )
+        self.summarizer: Optional[ChatSummarizer] = None
+        if config.SUMMARIES_ENABLED:
+            self.summarizer = create_summarizer(self.chats, self.index_document)
+        # Retention, merging of small author groups and dedup of the memory
+        self.compactor: Optional[Compactor] = None
+        if config.COMPACTION_INTERVAL > 0:
+            self.compactor = create_compactor(
+                rag_engine.build_points, rag_engine.client
+            )
+            self.compactor.start(config.COMPACTION_INTERVAL, config.COMPACTION_MEASURE)
 
     def format_user_message(self, username: str, text: str) -> str:
         """Format a message with username prefix"""
@@ -31,55 +57,101 @@ class MessageProcessor:
         """Format a bot response with username prefix"""
         return f"От @{bot_username}: {text}"
 
+    def _append(self, chat: ChatState, text: str) -> bool:
+        """Append to the history window; True if the chat is due for a summary"""
+        if self.summarizer is None:
+            chat.messages.append(text)
+            return False
+        return self.summarizer.append(chat, text)
+
     def add_to_history(self, chat_id: int, text: str) -> None:
         """Add message to chat history, maintaining history size limit"""
-        history = self.last_messages.setdefault(chat_id, [])
-        history.append(text)
-        if len(history) > self.history_size:
-            history.pop(0)
+        with self.chats.edit(chat_id) as chat:
+            due = self._append(chat, text)
+        if due:
+            self.summarizer.submit(chat_id)
 
     def get_history(self, chat_id: int) -> List[str]:
-        """Get message history for the specified chat"""
-        return self.last_messages.get(chat_id, [])
+        """Get message history for the specified chat, led by its summary"""
+        if self.summarizer is None:
+            return self.chats.messages(chat_id)
+        summary, messages = self.chats.history(chat_id)
+        if summary:
+            return [f"Конспект того, что было раньше: {summary}", *messages]
+        return messages
 
     def create_document(
         self, chat_id: int, message_id: int, text: str, author: str
     ) -> dict:
         """Create a document object for indexing"""
+        now = datetime.now()
         return {
             "id": f"{chat_id}_{message_id}",
             "text": text,
             "metadata": {
                 "author": author,
-                "date": datetime.now().isoformat(),
+                "date": now.isoformat(),
+                # Indexed Qdrant payload for per-chat filtered retrieval
+                "chat_id": chat_id,
+                "timestamp": int(now.timestamp()),
             },
         }
 
     def index_document(self, doc: dict) -> None:
-        """Index a single document in the RAG engine"""
-        self.rag.index_documents([doc])
+        """Queue a single document for background indexing in the RAG engine"""
+        self.indexer.submit(doc)
 
     def flush_current_doc(self, chat_id: int) -> None:
         """Index and clear the current document buffer for a chat"""
-        self.current_doc.pop(chat_id, None)
+        with self.chats.edit(chat_id) as chat:
+            doc, chat.doc = chat.doc, None
+        if doc:
+            self.index_document(doc)
+
+    def shutdown(self) -> None:
+        """Flush all buffered author groups and wait for the indexing queue"""
+        if self.compactor is not None:
+            self.compactor.close()
+        for chat_id in self.chats.chat_ids():
+            self.flush_current_doc(chat_id)
+            # Next message after a flush must start a new document
+            with self.chats.edit(chat_id) as chat:
+                chat.last_user = None
+        if self.summarizer is not None:
+            # Folds index their summaries, so they finish before the indexer
+            self.summarizer.close()
+        self.indexer.close()
+        self.chats.close()
 
     def track_message(
         self, chat_id: int, message_id: int, username: str, text: str
     ) -> None:
         """Track a regular message, grouping consecutive messages by author"""
+        with metrics.span("track_message"):
+            self._track_message(chat_id, message_id, username, text)
+
+    def _track_message(
+        self, chat_id: int, message_id: int, username: str, text: str
+    ) -> None:
         formatted_text = self.format_user_message(username, text)
-        self.add_to_history(chat_id, formatted_text)
-        # Check if same user as before
-        if self.last_user.get(chat_id) == username:
-            # Same author - append to current document
-            self.current_doc[chat_id]["text"] += f"\n{formatted_text}"
-        else:
-            # New author - flush previous and create new document
-            self.flush_current_doc(chat_id)
-            self.current_doc[chat_id] = self.create_document(
-                chat_id, message_id, formatted_text, username
-            )
-            self.last_user[chat_id] = username
+        previous = None
+        with self.chats.edit(chat_id) as chat:
+            due = self._append(chat, formatted_text)
+            # Check if same user as before
+            if chat.last_user == username and chat.doc is not None:
+                # Same author - append to current document
+                chat.doc["text"] += f"\n{formatted_text}"
+            else:
+                # New author - flush previous and create new document
+                previous = chat.doc
+                chat.doc = self.create_document(
+                    chat_id, message_id, formatted_text, username
+                )
+                chat.last_user = username
+        if previous:
+            self.index_document(previous)
+        if due:
+            self.summarizer.submit(chat_id)
 
     def process_remember_command(
         self, chat_id: int, message_id: int, username: str, text: str
@@ -109,7 +181,7 @@ class MessageProcessor:
         self.add_to_history(chat_id, formatted_text)
 
         history = self.get_history(chat_id)
-        result = self.rag.search_web(text, username, history)
+        result = self.rag.search_web(text, username, history, chat_id)
 
         # Create and index bot response
         bot_text = self.format_bot_response(bot_username, result)
@@ -131,10 +203,94 @@ class MessageProcessor:
         self.add_to_history(chat_id, formatted_text)
 
         history = self.get_history(chat_id)
-        answer = self.rag.query(text, username, history)
+        answer = self.rag.query(text, username, history, chat_id)
 
         # Create and index bot response
         bot_text = self.format_bot_response(bot_username, answer)
         self.add_to_history(chat_id, bot_text)
 
         return answer
+
+    async def aprocess_web_search(
+        self,
+        chat_id: int,
+        message_id: int,
+        bot_message_id: int,
+        username: str,
+        text: str,
+        bot_username: str,
+    ) -> str:
+        """Async variant of process_web_search"""
+        formatted_text = self.format_user_message(username, text)
+        self.add_to_history(chat_id, formatted_text)
+
+        history = self.get_history(chat_id)
+        result = await self.rag.asearch_web(text, username, history, chat_id)
+
+        bot_text = self.format_bot_response(bot_username, result)
+        self.add_to_history(chat_id, bot_text)
+
+        return result
+
+    async def aprocess_query(
+        self,
+        chat_id: int,
+        message_id: int,
+        bot_message_id: int,
+        username: str,
+        text: str,
+        bot_username: str,
+    ) -> str:
+        """Async variant of process_query"""
+        formatted_text = self.format_user_message(username, text)
+        self.add_to_history(chat_id, formatted_text)
+
+        history = self.get_history(chat_id)
+        answer = await self.rag.aquery(text, username, history, chat_id)
+
+        bot_text = self.format_bot_response(bot_username, answer)
+        self.add_to_history(chat_id, bot_text)
+
+        return answer
+
+    def stream_answer(
+        self,
+        chat_id: int,
+        username: str,
+        text: str,
+        bot_username: str,
+        web_search: bool = False,
+    ) -> Iterator[str]:
+        """Stream a RAG or web search answer; the full answer is added to history at the end"""
+        formatted_text = self.format_user_message(username, text)
+        self.add_to_history(chat_id, formatted_text)
+
+        history = self.get_history(chat_id)
+        stream = self.rag.stream_search_web if web_search else self.rag.stream_query
+        answer = ""
+        for answer in stream(text, username, history, chat_id):
+            yield answer
+
+        bot_text = self.format_bot_response(bot_username, answer)
+        self.add_to_history(chat_id, bot_text)
+
+    async def astream_answer(
+        self,
+        chat_id: int,
+        username: str,
+        text: str,
+        bot_username: str,
+        web_search: bool = False,
+    ) -> AsyncIterator[str]:
+        """Async variant of stream_answer"""
+        formatted_text = self.format_user_message(username, text)
+        self.add_to_history(chat_id, formatted_text)
+
+        history = self.get_history(chat_id)
+        stream = self.rag.astream_search_web if web_search else self.rag.astream_query
+        answer = ""
+        async for answer in stream(text, username, history, chat_id):
+            yield answer
+
+        bot_text = self.format_bot_response(bot_username, answer)
+        self.add_to_history(chat_id, bot_text)
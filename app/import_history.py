@@ -0,0 +1,270 @@
+"""
+Seed long-term memory from a Telegram Desktop chat export.
+
+    python import_history.py result.json [--chat-id -1001234567890]
+
+The export is streamed with ijson, so memory use does not depend on its size.
+Consecutive messages of one author become one document, the same way the bot
+groups live messages, and get the same ids: importing over live history
+overwrites documents instead of duplicating them. Documents are embedded in
+large batches while earlier batches are upserted by a thread pool. Progress
+is checkpointed after every batch that is fully stored; running the same
+command again continues where it stopped.
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+import ijson
+from ijson.common import ObjectBuilder
+
+import config as config
+from rag_engine import RagEngine
+
+logging.basicConfig(level=logging.INFO)
+
+# Exports of one chat keep messages at the top level, full account exports
+# keep them per chat under chats.list
+CHAT_PREFIXES = {
+    "": "messages.item",
+    "chats.list.item": "chats.list.item.messages.item",
+}
+# Chat types whose bot API id carries the -100 prefix
+CHANNEL_TYPES = {"private_supergroup", "public_supergroup", "private_channel"}
+
+
+def bot_chat_id(export_id: int, chat_type: str) -> int:
+    """Chat id as the bot API reports it for an id from the export"""
+    if chat_type in CHANNEL_TYPES:
+        return int(f"-100{export_id}")
+    if chat_type == "private_group":
+        return -export_id
+    return export_id
+
+
+def message_text(text) -> str:
+    """Plain text of a message: exports split formatted text into entities"""
+    if isinstance(text, str):
+        return text
+    return "".join(part if isinstance(part, str) else part["text"] for part in text)
+
+
+def iter_messages(f) -> Iterator[Tuple[int, dict]]:
+    """(chat id, message) pairs, one message in memory at a time"""
+    chat = {"id": None, "type": ""}
+    builder: Optional[ObjectBuilder] = None
+    message_prefix = ""
+    for prefix, event, value in ijson.parse(f, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == message_prefix and event == "end_map":
+                yield bot_chat_id(chat["id"], chat["type"]), builder.value
+                builder = None
+            continue
+        for chat_prefix, messages_prefix in CHAT_PREFIXES.items():
+            if prefix == messages_prefix and event == "start_map":
+                builder = ObjectBuilder()
+                builder.event(event, value)
+                message_prefix = prefix
+            elif prefix == f"{chat_prefix}.id".lstrip("."):
+                chat["id"] = value
+            elif prefix == f"{chat_prefix}.type".lstrip("."):
+                chat["type"] = value
+
+
+class ExportImporter:
+    """
+    Turns exported messages into documents and stores them in batches.
+
+    Args:
+        rag: Engine whose build_points() embeds documents.
+        batch_size: Documents per embedding batch.
+        workers: Parallel Qdrant upserts.
+        checkpoint_path: JSON file with the last stored message id per chat.
+        authors: Export author name or from_id -> username used in documents.
+        chat_id: Store every message under this chat id instead of the export's.
+    """
+
+    def __init__(
+        self,
+        rag: RagEngine,
+        batch_size: int = 512,
+        workers: int = 4,
+        checkpoint_path: Optional[str] = None,
+        authors: Optional[Dict[str, str]] = None,
+        chat_id: Optional[int] = None,
+    ):
+        self.rag = rag
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint_path = checkpoint_path
+        self.authors = authors or {}
+        self.chat_id = chat_id
+        self.done: Dict[str, int] = {}
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "r", encoding="utf-8") as f:
+                self.done = json.load(f)["chats"]
+            logging.info(f"Продолжаю импорт с чекпоинта {checkpoint_path}")
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="import-upsert")
+        # Upserts in submission order with the progress they complete
+        self._pending: Deque[Tuple[Future, Dict[str, int]]] = deque()
+        self.messages = 0
+        self.docs = 0
+        self.points = 0
+
+    def _author(self, message: dict) -> str:
+        name = message.get("from") or ""
+        return self.authors.get(
+            message.get("from_id", ""), self.authors.get(name, name)
+        )
+
+    def _document(self, chat_id: int, first: dict, author: str, lines: List[str]):
+        """Same shape as MessageProcessor.create_document"""
+        if "date_unixtime" in first:
+            timestamp = int(first["date_unixtime"])
+        else:
+            # Exports made before 2021 only have local time
+            timestamp = int(datetime.fromisoformat(first["date"]).timestamp())
+        return {
+            "id": f"{chat_id}_{first['id']}",
+            "text": "\n".join(lines),
+            "metadata": {
+                "author": author,
+                "date": datetime.fromtimestamp(timestamp).isoformat(),
+                "chat_id": chat_id,
+                "timestamp": timestamp,
+            },
+        }
+
+    def documents(self, messages) -> Iterator[Tuple[dict, int]]:
+        """Author groups as (document, id of its last message)"""
+        group: Optional[Tuple[int, dict, str]] = None
+        lines: List[str] = []
+        last_id = 0
+        for export_chat_id, message in messages:
+            chat_id = self.chat_id if self.chat_id is not None else export_chat_id
+            if message.get("type") != "message":
+                continue
+            if message["id"] <= self.done.get(str(chat_id), 0):
+                continue
+            text = message_text(message.get("text", "")).strip()
+            if not text:
+                continue
+            self.messages += 1
+            author = self._author(message)
+            if group is not None and (group[0], group[2]) == (chat_id, author):
+                lines.append(f"От {author}: {text}")
+                last_id = message["id"]
+                continue
+            if group is not None:
+                yield self._document(group[0], group[1], group[2], lines), last_id
+            group, lines, last_id = (chat_id, message, author), [], message["id"]
+            lines.append(f"От {author}: {text}")
+        if group is not None:
+            yield self._document(group[0], group[1], group[2], lines), last_id
+
+    def _upsert(self, points: list) -> None:
+        self.rag.client.upsert(collection_name=config.QDRANT_COLLECTION, points=points)
+
+    def _store(self, batch: List[Tuple[dict, int]]) -> None:
+        """Embed one batch here and upsert it in the pool"""
+        points = self.rag.build_points([doc for doc, _ in batch])
+        progress: Dict[str, int] = {}
+        for doc, last_id in batch:
+            progress[str(doc["metadata"]["chat_id"])] = last_id
+        # Bounded in-flight upserts keep memory flat and apply backpressure
+        while len(self._pending) >= self.workers:
+            self._complete_oldest()
+        self._pending.append((self._pool.submit(self._upsert, points), progress))
+        self.docs += len(batch)
+        self.points += len(points)
+
+    def _complete_oldest(self) -> None:
+        future, progress = self._pending.popleft()
+        future.result()
+        self.done.update(progress)
+        self._save_checkpoint()
+
+    def _save_checkpoint(self) -> None:
+        if not self.checkpoint_path:
+            return
+        tmp = f"{self.checkpoint_path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"chats": self.done}, f)
+        os.replace(tmp, self.checkpoint_path)
+
+    def run(self, path: str) -> dict:
+        """Import an export file; returns the final counters"""
+        size = os.path.getsize(path)
+        started = time.monotonic()
+        batch: List[Tuple[dict, int]] = []
+        with open(path, "rb") as f:
+            try:
+                for item in self.documents(iter_messages(f)):
+                    batch.append(item)
+                    if len(batch) < self.batch_size:
+                        continue
+                    self._store(batch)
+                    batch = []
+                    self._report(started, f.tell() / size)
+                if batch:
+                    self._store(batch)
+                while self._pending:
+                    self._complete_oldest()
+            finally:
+                self._pool.shutdown(wait=True)
+        self._report(started, 1.0)
+        return {"messages": self.messages, "docs": self.docs, "points": self.points}
+
+    def _report(self, started: float, share: float) -> None:
+        elapsed = max(time.monotonic() - started, 1e-6)
+        logging.info(
+            f"{share:.1%} файла: {self.messages} сообщений, {self.docs} документов, "
+            f"{self.points} точек за {elapsed:.0f}с "
+            f"({self.messages / elapsed:.0f} сообщ/с, {self.points / elapsed:.0f} точек/с)"
+        )
+
+
+def main():
+    """CLI entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("path", help="result.json из экспорта Telegram Desktop")
+    parser.add_argument(
+        "--chat-id", type=int, help="id чата в боте, если он отличается от экспорта"
+    )
+    parser.add_argument(
+        "--authors",
+        help="JSON: имя автора или from_id из экспорта -> @username в документах",
+    )
+    parser.add_argument("--batch-size", type=int, default=512)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--checkpoint", help="файл чекпоинта (по умолчанию <path>.checkpoint.json)"
+    )
+    args = parser.parse_args()
+
+    authors = None
+    if args.authors:
+        with open(args.authors, "r", encoding="utf-8") as f:
+            authors = json.load(f)
+    importer = ExportImporter(
+        RagEngine(),
+        batch_size=args.batch_size,
+        workers=args.workers,
+        checkpoint_path=args.checkpoint or f"{args.path}.checkpoint.json",
+        authors=authors,
+        chat_id=args.chat_id,
+    )
+    totals = importer.run(args.path)
+    logging.info(f"Импорт завершён: {totals}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import logging
+import queue
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import config as config
+import metrics as metrics
+
+INDEX_WAIT_SECONDS = metrics.REGISTRY.histogram(
+    "ragbot_index_wait_seconds", "Time from enqueue to document stored in Qdrant"
+)
+
+# Sentinel that asks the worker to index whatever is buffered right now
+_FLUSH = object()
+
+
+class IndexingQueue:
+    """Bounded background queue that batches documents into the RAG engine"""
+
+    def __init__(
+        self,
+        rag_engine,
+        max_size: int = 1000,
+        batch_size: int = 32,
+        flush_interval: float = 10.0,
+        max_retries: int = 3,
+    ):
+        """Initialize the queue; call start() to launch the worker thread"""
+        self.rag = rag_engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_size)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        # Metrics
+        self.enqueued = 0
+        self.indexed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_batch_size = 0
+        self.last_batch_seconds = 0.0
+        self.last_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._total_wait_seconds = 0.0
+
+    def start(self) -> None:
+        """Start the background worker thread"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="indexing-queue", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, doc: dict) -> bool:
+        """Enqueue a document without blocking. Returns False if it was dropped"""
+        try:
+            self._queue.put_nowait((time.monotonic(), doc))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logging.warning(
+                f"Очередь индексации переполнена, документ {doc['id']} пропущен"
+            )
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def flush(self) -> None:
+        """Ask the worker to index buffered documents without waiting for a full batch"""
+        try:
+            self._queue.put_nowait(_FLUSH)
+        except queue.Full:
+            # A full queue means the worker is about to hit the size trigger anyway
+            pass
+
+    def close(self, timeout: float = 30.0) -> None:
+        """Index everything still queued and stop the worker"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        # Worker was never started or did not finish in time: drain inline
+        batch = self._drain()
+        if batch:
+            self._index_batch(batch)
+
+    def depth(self) -> int:
+        """Number of documents waiting in the queue"""
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        """Snapshot of queue depth and latency metrics"""
+        with self._lock:
+            avg_wait = self._total_wait_seconds / self.indexed if self.indexed else 0.0
+            return {
+                "depth": self.depth(),
+                "enqueued": self.enqueued,
+                "indexed": self.indexed,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "batches": self.batches,
+                "last_batch_size": self.last_batch_size,
+                "last_batch_seconds": self.last_batch_seconds,
+                "last_wait_seconds": self.last_wait_seconds,
+                "avg_wait_seconds": avg_wait,
+                "max_wait_seconds": self.max_wait_seconds,
+            }
+
+    def _drain(self) -> List[Tuple[float, dict]]:
+        """Pop every queued document without blocking"""
+        batch = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return batch
+            if item is not _FLUSH:
+                batch.append(item)
+
+    def _run(self) -> None:
+        """Worker loop: flush on batch size, on flush interval and on shutdown"""
+        batch: List[Tuple[float, dict]] = []
+        deadline = time.monotonic() + self.flush_interval
+        while not self._stop.is_set():
+            timeout = max(0.0, deadline - time.monotonic()) if batch else 0.5
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is not None and item is not _FLUSH:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+
+            if batch and (
+                item is _FLUSH
+                or len(batch) >= self.batch_size
+                or time.monotonic() >= deadline
+            ):
+                self._index_batch(batch)
+                batch = []
+
+        batch.extend(self._drain())
+        if batch:
+            self._index_batch(batch)
+
+    def _index_batch(self, batch: List[Tuple[float, dict]]) -> None:
+        """Embed and upsert one batch, retrying transient failures"""
+        # Later submissions with the same id override earlier ones
+        docs = list({doc["id"]: doc for _, doc in batch}.values())
+        started = time.monotonic()
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                with metrics.span("index_batch", docs=len(docs)):
+                    self.rag.index_documents(docs)
+                break
+            except Exception:
+                logging.exception(
+                    f"Не удалось проиндексировать пачку из {len(docs)} документов "
+                    f"(попытка {attempt}/{self.max_retries})"
+                )
+                if attempt == self.max_retries:
+                    with self._lock:
+                        self.failed += len(batch)
+                    return
+                time.sleep(2**attempt)
+
+        finished = time.monotonic()
+        waits = [finished - enqueued_at for enqueued_at, _ in batch]
+        for wait in waits:
+            INDEX_WAIT_SECONDS.observe(wait)
+        with self._lock:
+            self.indexed += len(batch)
+            self.batches += 1
+            self.last_batch_size = len(batch)
+            self.last_batch_seconds = finished - started
+            self.last_wait_seconds = max(waits)
+            self.max_wait_seconds = max(self.max_wait_seconds, max(waits))
+            self._total_wait_seconds += sum(waits)
+        logging.info(
+            f"Проиндексировано {len(docs)} документов за {finished - started:.2f}с, "
+            f"в очереди {self.depth()}"
+        )
+
+
+def create_indexing_queue(rag_engine) -> IndexingQueue:
+    """Build and start an indexing queue configured from config.py"""
+    indexer = IndexingQueue(
+        rag_engine,
+        max_size=config.INDEX_QUEUE_SIZE,
+        batch_size=config.INDEX_BATCH_SIZE,
+        flush_interval=config.INDEX_FLUSH_INTERVAL,
+    )
+    indexer.start()
+    gauge = metrics.REGISTRY.gauge(
+        "ragbot_index_queue", "Background indexing queue state", ["field"]
+    )
+    for field in ("depth", "enqueued", "indexed", "dropped", "failed", "batches"):
+        gauge.set_function(lambda field=field: indexer.stats()[field], field=field)
+    return indexer
@@ -1,6 +1,509 @@
-from typing import Any, List
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import numpy as np
 from sentence_transformers import SentenceTransformer
 from llama_index.core.embeddings import BaseEmbedding
+import metrics as metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Rough per-entry overhead of the LRU tier (key string, dict slot, array header)
+_ENTRY_OVERHEAD_BYTES = 200
+
+INFERENCE_BACKENDS = ("torch", "onnx", "onnx-int8")
+
+# Probe texts for comparing an ONNX model with the fp32 torch output
+PROBE_TEXTS = [
+    "доброе утро всем",
+    "кто сегодня идёт в бар после работы?",
+    "у меня сломался ноут, кто шарит в железе",
+    "Official exchange rate for today is 92 rubles per dollar.",
+    "От dan: завтра дедлайн, а я ничего не сделал, помогите",
+    "скиньте мем про котов",
+]
+
+
+def onnx_model_dir(onnx_dir: str, model_name: str) -> str:
+    """Where the ONNX export of a model lives"""
+    return os.path.join(onnx_dir, model_name.replace("/", "--"))
+
+
+def load_sentence_transformer(
+    model_name: str,
+    backend: str = "torch",
+    num_threads: int = 0,
+    max_seq_length: int = 0,
+    onnx_dir: str = "onnx_models",
+    quantization_config: str = "avx512_vnni",
+) -> SentenceTransformer:
+    """
+    Load a SentenceTransformer on the chosen inference backend.
+
+    ONNX exports (and their int8 dynamic quantization) are written to
+    ``onnx_dir`` on first use and loaded from there afterwards.
+    """
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(
+            f"Unknown embedding backend {backend!r}, expected {INFERENCE_BACKENDS}"
+        )
+    if backend == "torch":
+        if num_threads > 0:
+            import torch
+
+            torch.set_num_threads(num_threads)
+        model = SentenceTransformer(model_name)
+    else:
+        import onnxruntime
+
+        local_dir = onnx_model_dir(onnx_dir, model_name)
+        if not os.path.isdir(local_dir):
+            logging.info(f"Экспортирую {model_name} в ONNX: {local_dir}")
+            SentenceTransformer(model_name, backend="onnx").save(local_dir)
+        model_kwargs: Dict[str, Any] = {"provider": "CPUExecutionProvider"}
+        if num_threads > 0:
+            session_options = onnxruntime.SessionOptions()
+            session_options.intra_op_num_threads = num_threads
+            session_options.inter_op_num_threads = 1
+            model_kwargs["session_options"] = session_options
+        if backend == "onnx-int8":
+            file_name = f"onnx/model_qint8_{quantization_config}.onnx"
+            if not os.path.exists(os.path.join(local_dir, file_name)):
+                from sentence_transformers import export_dynamic_quantized_onnx_model
+
+                logging.info(f"Квантую {model_name} в int8 ({quantization_config})")
+                export_dynamic_quantized_onnx_model(
+                    SentenceTransformer(local_dir, backend="onnx"),
+                    quantization_config=quantization_config,
+                    model_name_or_path=local_dir,
+                )
+            model_kwargs["file_name"] = file_name
+        model = SentenceTransformer(
+            local_dir, backend="onnx", model_kwargs=model_kwargs
+        )
+    if max_seq_length > 0:
+        # Chat messages are short; long documents are cut instead of paying O(n^2)
+        model.max_seq_length = max_seq_length
+    return model
+
+
+def fp32_agreement(
+    model: SentenceTransformer, reference: SentenceTransformer, texts: List[str]
+) -> float:
+    """Lowest cosine similarity between two models' vectors over the texts"""
+    ours = np.asarray(model.encode(texts, normalize_embeddings=True))
+    theirs = np.asarray(reference.encode(texts, normalize_embeddings=True))
+    if ours.shape != theirs.shape:
+        return 0.0
+    return float(np.min(np.sum(ours * theirs, axis=1)))
+
+
+def stored_fp32_agreement(
+    model: SentenceTransformer,
+    model_name: str,
+    backend: str,
+    max_seq_length: int = 0,
+    onnx_dir: str = "onnx_models",
+    quantization_config: str = "avx512_vnni",
+) -> float:
+    """
+    fp32_agreement of an ONNX model, measured once against fp32 torch and kept
+    in fp32_agreement.json next to the export, so later starts load one model
+    """
+    path = os.path.join(onnx_model_dir(onnx_dir, model_name), "fp32_agreement.json")
+    key = f"{backend}|max_seq_length={max_seq_length}"
+    if backend == "onnx-int8":
+        key += f"|{quantization_config}"
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            measured = json.load(f)
+    except (FileNotFoundError, ValueError):
+        measured = {}
+    if key in measured:
+        return measured[key]
+    reference = load_sentence_transformer(
+        model_name, "torch", max_seq_length=max_seq_length
+    )
+    measured[key] = fp32_agreement(model, reference, PROBE_TEXTS)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(measured, f, indent=2)
+    os.replace(tmp_path, path)
+    return measured[key]
+
+
+class _DiskEmbeddingTier:
+    """
+    Append-only on-disk embedding store, read through a memory map.
+
+    Vectors are float32 rows in ``embeddings.f32``; ``keys.txt`` holds one key
+    per row. A vector is written before its key, so a crash can leave at most
+    an orphan row that is dropped on the next start. Processes sharing the
+    directory take an flock on ``lock`` to append and to repair, and pick up
+    the rows the others appended before writing their own. Once the store
+    holds max_rows vectors it stops growing; 0 means no cap.
+    """
+
+    def __init__(self, path: str, dim: int, max_rows: int = 0) -> None:
+        os.makedirs(path, exist_ok=True)
+        self._dim = dim
+        self._max_rows = max_rows
+        self._vectors_path = os.path.join(path, "embeddings.f32")
+        self._keys_path = os.path.join(path, "keys.txt")
+        self._rows: Dict[str, int] = {}
+        self._count = 0
+        self._keys_offset = 0
+        self._map: Optional[np.memmap] = None
+        self._full_logged = False
+        self._lock_file = open(os.path.join(path, "lock"), "a")
+        with self._locked():
+            self._repair()
+            self._read_new_keys()
+        self._vectors_file = open(self._vectors_path, "ab")
+        self._keys_file = open(self._keys_path, "ab")
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        if fcntl is None:
+            # No flock (Windows): one process per directory
+            yield
+            return
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _repair(self) -> None:
+        """Cut an orphan vector or a torn last key so rows match keys again"""
+        row_bytes = self._dim * 4
+        vectors_size = (
+            os.path.getsize(self._vectors_path)
+            if os.path.exists(self._vectors_path)
+            else 0
+        )
+        data = b""
+        if os.path.exists(self._keys_path):
+            with open(self._keys_path, "rb") as f:
+                data = f.read()
+        keys = data.split(b"\n")[:-1][: vectors_size // row_bytes]
+        keys_size = sum(len(key) + 1 for key in keys)
+        # Both files only lose a tail, so nothing is rewritten in place
+        if vectors_size != len(keys) * row_bytes:
+            with open(self._vectors_path, "ab") as f:
+                f.truncate(len(keys) * row_bytes)
+        if len(data) != keys_size:
+            with open(self._keys_path, "ab") as f:
+                f.truncate(keys_size)
+
+    def _read_new_keys(self) -> None:
+        """Index complete key lines appended since the last read"""
+        try:
+            with open(self._keys_path, "rb") as f:
+                f.seek(self._keys_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # A line without its newline is still being written
+        data = data[: data.rfind(b"\n") + 1]
+        for line in data.splitlines():
+            self._rows[line.decode("ascii")] = self._count
+            self._count += 1
+        self._keys_offset += len(data)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        row = self._rows.get(key)
+        if row is None and os.path.getsize(self._keys_path) > self._keys_offset:
+            # Another process may have stored it
+            self._read_new_keys()
+            row = self._rows.get(key)
+        if row is None:
+            return None
+        if self._map is None or row >= self._map.shape[0]:
+            # File grew since the last mapping
+            self._map = np.memmap(
+                self._vectors_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(self._count, self._dim),
+            )
+        return np.array(self._map[row])
+
+    def _full(self) -> bool:
+        if not self._max_rows or self._count < self._max_rows:
+            return False
+        if not self._full_logged:
+            logging.warning(
+                f"Дисковый кэш эмбеддингов заполнен ({self._count} векторов), "
+                "новые векторы на диск не пишутся"
+            )
+            self._full_logged = True
+        return True
+
+    def put(self, key: str, vector: np.ndarray) -> None:
+        if key in self._rows or vector.shape[0] != self._dim or self._full():
+            return
+        with self._locked():
+            self._read_new_keys()
+            if key in self._rows or self._full():
+                return
+            self._vectors_file.write(vector.astype(np.float32).tobytes())
+            self._vectors_file.flush()
+            line = f"{key}\n".encode("ascii")
+            self._keys_file.write(line)
+            self._keys_file.flush()
+            self._rows[key] = self._count
+            self._count += 1
+            self._keys_offset += len(line)
+
+
+class EmbeddingCache:
+    """
+    Content-hash keyed embedding cache.
+
+    Args:
+        namespace: Anything that changes the vectors (model, normalization).
+        max_memory_bytes: Cap for the in-memory LRU tier; 0 disables it.
+        disk_path: Directory for the persistent memory-mapped tier (optional).
+        dim: Embedding dimension, required for the disk tier.
+        max_disk_bytes: Size at which the disk tier stops growing; 0: no cap.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        max_memory_bytes: int,
+        disk_path: Optional[str] = None,
+        dim: Optional[int] = None,
+        max_disk_bytes: int = 0,
+    ) -> None:
+        self._namespace = namespace
+        self._max_memory_bytes = max_memory_bytes
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._disk: Optional[_DiskEmbeddingTier] = None
+        if disk_path and dim:
+            ns_dir = hashlib.sha1(namespace.encode("utf-8")).hexdigest()[:12]
+            self._disk = _DiskEmbeddingTier(
+                os.path.join(disk_path, ns_dir), dim, max_disk_bytes // (dim * 4)
+            )
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, text: str) -> str:
+        return hashlib.sha1(f"{self._namespace}\0{text}".encode("utf-8")).hexdigest()
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        key = self.key(text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return vector
+            if self._disk is not None:
+                vector = self._disk.get(key)
+                if vector is not None:
+                    self.disk_hits += 1
+                    self._remember(key, vector)
+                    return vector
+            self.misses += 1
+            return None
+
+    def put(self, text: str, vector: np.ndarray) -> None:
+        key = self.key(text)
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+            if self._disk is not None:
+                self._disk.put(key, vector)
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        """Insert into the LRU tier and evict down to the memory cap"""
+        if self._max_memory_bytes <= 0:
+            return
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = vector
+        self._memory_bytes += vector.nbytes + _ENTRY_OVERHEAD_BYTES
+        while self._memory_bytes > self._max_memory_bytes and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes + _ENTRY_OVERHEAD_BYTES
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk) if self._disk is not None else 0,
+            }
+
+
+BATCH_SIZES = metrics.REGISTRY.histogram(
+    "ragbot_embed_batch_size",
+    "Texts per model call of the embedding batcher",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+
+
+class EmbeddingBatcher:
+    """
+    Micro-batching scheduler shared by every caller of one encoder.
+
+    Requests that arrive while the model is busy are encoded together in the
+    next call. A lone request on an idle batcher is encoded immediately; the
+    collection window (max_delay) is only spent when other requests are
+    already waiting, so single-request latency does not grow.
+
+    Args:
+        encode_fn: Encodes a list of texts into one vector per text.
+        max_batch: Max texts per model call.
+        max_delay: Max seconds to keep collecting once a batch has formed.
+        max_pending: Queued texts above which callers block (backpressure).
+    """
+
+    def __init__(
+        self,
+        encode_fn: Callable[[List[str]], List[np.ndarray]],
+        max_batch: int = 32,
+        max_delay: float = 0.005,
+        max_pending: int = 1024,
+    ) -> None:
+        self._encode_fn = encode_fn
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: "queue.Queue[Optional[Tuple[str, Future]]]" = queue.Queue(
+            maxsize=max_pending
+        )
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.batches = 0
+        self.items = 0
+
+    def start(self) -> None:
+        """Start the worker thread that owns the model"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="embedding-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Encode what is queued and stop the worker"""
+        self._stop.set()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, text: str) -> Future:
+        """Queue one text; blocks while max_pending texts are already waiting"""
+        future: Future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def encode(self, texts: List[str]) -> List[np.ndarray]:
+        """Encode texts through the shared batches and wait for the vectors"""
+        futures = [self.submit(text) for text in texts]
+        return [future.result() for future in futures]
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        return {"pending": self.depth(), "batches": self.batches, "items": self.items}
+
+    def _collect(self) -> List[Tuple[str, Future]]:
+        """Wait for one request, then gather the ones queued behind it"""
+        try:
+            item = self._queue.get(timeout=0.5)
+        except queue.Empty:
+            return []
+        batch = [item] if item is not None else []
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                batch.append(item)
+        # Under load more requests are likely a few ms away; an idle batcher
+        # (single request) does not wait
+        if 1 < len(batch) < self.max_batch and self.max_delay > 0:
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is not None:
+                    batch.append(item)
+        return batch
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            batch = self._collect()
+            if batch:
+                self._encode_batch(batch)
+        # Nobody must be left waiting on a future after close()
+        while True:
+            batch = self._collect_nowait()
+            if not batch:
+                return
+            self._encode_batch(batch)
+
+    def _collect_nowait(self) -> List[Tuple[str, Future]]:
+        batch = []
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                batch.append(item)
+        return batch
+
+    def _encode_batch(self, batch: List[Tuple[str, Future]]) -> None:
+        # Similar lengths side by side keep padding low in every model sub-batch
+        order = sorted(range(len(batch)), key=lambda i: len(batch[i][0]))
+        try:
+            vectors = self._encode_fn([batch[i][0] for i in order])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for i, vector in zip(order, vectors):
+            batch[i][1].set_result(vector)
+        self.batches += 1
+        self.items += len(batch)
+        BATCH_SIZES.observe(len(batch))
 
 
 class SentenceTransformerEmbeddings(BaseEmbedding):
@@ -10,62 +513,184 @@ class SentenceTransformerEmbeddings(BaseEmbedding):
     Args:
         model_name: HuggingFace model identifier for SentenceTransformer.
         normalize_embeddings: Whether to normalize embeddings (default True).
+        cache_memory_mb: Memory cap of the LRU embedding cache; 0 disables it.
+        cache_dir: Directory for the persistent embedding cache (optional).
+        cache_disk_mb: Size cap of the persistent cache; 0: no cap.
+        backend: Inference backend, one of INFERENCE_BACKENDS.
+        num_threads: CPU threads for inference; 0 keeps the runtime default.
+        max_seq_length: Truncate inputs to this many tokens; 0 keeps the model's.
+        onnx_dir: Where ONNX exports are stored.
+        quantization_config: onnxruntime int8 preset (avx512_vnni, avx2, arm64).
+        fp32_tolerance: For ONNX backends, max allowed 1 - cosine against fp32
+            torch on PROBE_TEXTS; above it the fp32 model is used. 0 skips it.
+            The cosine is measured on the first start and stored with the export.
+        batch_max_items: Route encoding through an EmbeddingBatcher with this
+            batch cap, so concurrent handlers share model calls; <= 1 disables.
+        batch_max_delay: Collection window of the batcher, seconds.
+        batch_max_pending: Queued texts above which callers block.
     """
 
     def __init__(
         self,
         model_name: str = "ai-forever/ru-en-RoSBERTa",
         normalize_embeddings: bool = True,
+        cache_memory_mb: float = 0,
+        cache_dir: Optional[str] = None,
+        cache_disk_mb: float = 0,
+        backend: str = "torch",
+        num_threads: int = 0,
+        max_seq_length: int = 0,
+        onnx_dir: str = "onnx_models",
+        quantization_config: str = "avx512_vnni",
+        fp32_tolerance: float = 0.02,
+        batch_max_items: int = 0,
+        batch_max_delay: float = 0.005,
+        batch_max_pending: int = 1024,
         **kwargs: Any,
     ) -> None:
         super().__init__(**kwargs)
         # Load the SentenceTransformer model
-        self._model = SentenceTransformer(model_name)
+        self._model = load_sentence_transformer(
+            model_name,
+            backend,
+            num_threads=num_threads,
+            max_seq_length=max_seq_length,
+            onnx_dir=onnx_dir,
+            quantization_config=quantization_config,
+        )
+        if backend != "torch" and fp32_tolerance > 0:
+            similarity = stored_fp32_agreement(
+                self._model,
+                model_name,
+                backend,
+                max_seq_length=max_seq_length,
+                onnx_dir=onnx_dir,
+                quantization_config=quantization_config,
+            )
+            if similarity < 1 - fp32_tolerance:
+                logging.error(
+                    f"{backend} расходится с fp32: косинус {similarity:.4f} "
+                    f"< {1 - fp32_tolerance:.4f}, использую torch fp32"
+                )
+                self._model, backend = (
+                    load_sentence_transformer(
+                        model_name,
+                        "torch",
+                        num_threads=num_threads,
+                        max_seq_length=max_seq_length,
+                    ),
+                    "torch",
+                )
+            else:
+                logging.info(f"{backend}: косинус с fp32 не ниже {similarity:.4f}")
         # Use a private attribute to avoid Pydantic conflicts
         self._normalize_embeddings = normalize_embeddings
+        self._cache: Optional[EmbeddingCache] = None
+        if cache_memory_mb > 0 or cache_dir:
+            # ONNX/int8 and truncated vectors differ slightly from the plain fp32
+            # ones, so they get their own entries; plain fp32 keeps the old keys
+            namespace = f"{model_name}|normalize={normalize_embeddings}"
+            if backend != "torch":
+                namespace += f"|backend={backend}"
+            if max_seq_length > 0:
+                namespace += f"|max_seq_length={max_seq_length}"
+            self._cache = EmbeddingCache(
+                namespace=namespace,
+                max_memory_bytes=int(cache_memory_mb * 1024 * 1024),
+                disk_path=cache_dir,
+                dim=self._model.get_sentence_embedding_dimension(),
+                max_disk_bytes=int(cache_disk_mb * 1024 * 1024),
+            )
+            cache_gauge = metrics.REGISTRY.gauge(
+                "ragbot_embedding_cache", "Embedding cache counters", ["field"]
+            )
+            for field in ("hits", "disk_hits", "misses", "memory_bytes"):
+                cache_gauge.set_function(
+                    lambda field=field: self.cache_stats()[field], field=field
+                )
+
+        self._batcher: Optional[EmbeddingBatcher] = None
+        if batch_max_items > 1:
+            self._batcher = EmbeddingBatcher(
+                self._encode_batch,
+                max_batch=batch_max_items,
+                max_delay=batch_max_delay,
+                max_pending=batch_max_pending,
+            )
+            self._batcher.start()
+            batcher_gauge = metrics.REGISTRY.gauge(
+                "ragbot_embed_batcher", "Embedding batcher counters", ["field"]
+            )
+            for field in ("pending", "batches", "items"):
+                batcher_gauge.set_function(
+                    lambda field=field: self._batcher.stats()[field], field=field
+                )
+
+    def cache_stats(self) -> dict:
+        """Hit/miss counters of the embedding cache (empty if disabled)"""
+        return self._cache.stats() if self._cache is not None else {}
+
+    def _encode_batch(self, texts: List[str]) -> List[np.ndarray]:
+        """One model call"""
+        with metrics.span("embed", texts=len(texts)):
+            embeddings = self._model.encode(
+                texts, normalize_embeddings=self._normalize_embeddings
+            )
+        return [np.asarray(emb, dtype=np.float32) for emb in embeddings]
+
+    def _encode_uncached(self, texts: List[str]) -> List[np.ndarray]:
+        if self._batcher is not None:
+            return self._batcher.encode(texts)
+        return self._encode_batch(texts)
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        """
+        Encode texts, serving repeated strings from the cache.
+        """
+        if self._cache is None:
+            return [emb.tolist() for emb in self._encode_uncached(texts)]
+
+        vectors: List[Optional[np.ndarray]] = [self._cache.get(t) for t in texts]
+        # Encode each missing string once, even if it repeats in the batch
+        missing = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+        if missing:
+            fresh = {}
+            for text, emb in zip(missing, self._encode_uncached(missing)):
+                fresh[text] = emb
+                self._cache.put(text, emb)
+            vectors = [fresh[t] if v is None else v for t, v in zip(texts, vectors)]
+        return [v.tolist() for v in vectors]
 
     def _get_query_embedding(self, query: str) -> List[float]:
         """
         Generate an embedding for a single query string.
         """
-        embeddings = self._model.encode(
-            [query], normalize_embeddings=self._normalize_embeddings
-        )
-        # Convert to Python list
-        emb = embeddings[0]
-        return emb.tolist() if hasattr(emb, "tolist") else list(emb)
+        return self._encode([query])[0]
 
     def _get_text_embedding(self, text: str) -> List[float]:
         """
         Generate an embedding for a single text string.
         """
-        embeddings = self._model.encode(
-            [text], normalize_embeddings=self._normalize_embeddings
-        )
-        emb = embeddings[0]
-        return emb.tolist() if hasattr(emb, "tolist") else list(emb)
+        return self._encode([text])[0]
 
     def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
         """
         Generate embeddings for a list of text strings.
         """
-        embeddings = self._model.encode(
-            texts, normalize_embeddings=self._normalize_embeddings
-        )
-        # Ensure Python native lists
-        result: List[List[float]] = []
-        for emb in embeddings:
-            result.append(emb.tolist() if hasattr(emb, "tolist") else list(emb))
-        return result
+        return self._encode(texts)
 
-    # Async wrappers matching llama_index signature
+    # Async wrappers matching llama_index signature.
+    # Encoding is CPU-bound, so it runs in the default executor to keep the loop free.
     async def _aget_query_embedding(self, query: str) -> List[float]:  # noqa: F821
-        return self._get_query_embedding(query)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._get_query_embedding, query)
 
     async def _aget_text_embedding(self, text: str) -> List[float]:  # noqa: F821
-        return self._get_text_embedding(text)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._get_text_embedding, text)
 
     async def _aget_text_embeddings(
         self, texts: List[str]
     ) -> List[List[float]]:  # noqa: F821
-        return self._get_text_embeddings(texts)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._get_text_embeddings, texts)
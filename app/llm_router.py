@@ -0,0 +1,374 @@
+"""
+Routing between the remote LLM and a small local one on CPU.
+
+Short questions of the kinds in local_kinds go to the local model while it
+is free; everything else goes to the remote model. The local model is also
+the fallback: it answers when the remote call fails, and when a remote
+complete() is still running after fallback_after seconds it starts too and
+the first answer wins. Prompts are built per target through prompt_for(local),
+since the local model has a much smaller context window.
+
+complete() returns the model that answered along with the text, and stream
+chunks carry it in additional_kwargs["route"], so callers can tell a remote
+answer from a local or fallback one (e.g. to cache only remote answers).
+
+The local model generates one answer at a time (a llama.cpp model is not
+thread-safe and one generation already takes every core given to it), so a
+busy local model sends short questions to the remote one instead.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional
+from typing import Sequence, Tuple
+
+from llama_index.core.base.llms.types import CompletionResponse
+
+import backends as backends
+import config as config
+import metrics as metrics
+from resilience import DeadlineExceeded
+
+LOCAL = "local"
+REMOTE = "remote"
+
+LLM_ROUTES = metrics.REGISTRY.counter(
+    "ragbot_llm_routes_total",
+    "LLM calls by model and routing reason",
+    ["route", "reason"],
+)
+LLM_ROUTE_SECONDS = metrics.REGISTRY.histogram(
+    "ragbot_llm_route_seconds",
+    "Time to the first chunk and to the whole answer, by the model that answered",
+    ["route", "stage"],
+)
+
+# Marks an empty stream
+_END = object()
+
+
+def chunk_route(chunk: CompletionResponse) -> str:
+    """Model that produced a streamed chunk; REMOTE for chunks from a bare LLM"""
+    return chunk.additional_kwargs.get("route", REMOTE)
+
+
+def _prefetched(stream) -> Iterator:
+    """Pulls the first chunk now, so a failing stream raises before any output"""
+    stream = iter(stream)
+    first = next(stream, _END)
+
+    def gen():
+        if first is not _END:
+            yield first
+        yield from stream
+
+    return gen()
+
+
+class LLMRouter:
+    """
+    Sends each answer to the local or the remote LLM and falls back between them.
+
+    Args:
+        remote: Returns the remote LLM (backends.get_llm).
+        local: Returns the local LLM (backends.get_local_llm).
+        max_local_chars: Longest question the local model answers first.
+        local_kinds: Kinds of answers ("query", "search") it may answer first.
+        fallback_after: Seconds a remote complete() may run before the local
+            model starts too; 0: the local model only answers failed calls.
+        local_wait: Seconds a fallback waits for the busy local model.
+        max_workers: Threads for the blocking calls.
+    """
+
+    def __init__(
+        self,
+        remote: Callable[[], Any],
+        local: Callable[[], Any],
+        max_local_chars: int = 60,
+        local_kinds: Sequence[str] = ("query",),
+        fallback_after: float = 10.0,
+        local_wait: float = 30.0,
+        max_workers: int = 16,
+    ):
+        self.remote = remote
+        self.local = local
+        self.max_local_chars = max_local_chars
+        self.local_kinds = set(local_kinds)
+        self.fallback_after = fallback_after
+        self.local_wait = local_wait
+        self._local_lock = threading.Lock()
+        # Abandoned remote calls finish here after the local model has answered
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="llm-route"
+        )
+
+    def route(self, kind: str, query_text: str) -> Tuple[str, str]:
+        """(model, reason) a question goes to first"""
+        if kind not in self.local_kinds:
+            return REMOTE, "kind"
+        if len(query_text.strip()) > self.max_local_chars:
+            return REMOTE, "long"
+        if self._local_lock.locked():
+            return REMOTE, "local_busy"
+        return LOCAL, "short"
+
+    def _start(self, kind: str, query_text: str) -> str:
+        route, reason = self.route(kind, query_text)
+        LLM_ROUTES.inc(route=route, reason=reason)
+        return route
+
+    @staticmethod
+    def _observe(route: str, stage: str, started: float) -> None:
+        LLM_ROUTE_SECONDS.observe(
+            time.perf_counter() - started, route=route, stage=stage
+        )
+
+    def _local_complete(self, prompt: str) -> str:
+        if not self._local_lock.acquire(timeout=self.local_wait):
+            raise DeadlineExceeded(
+                f"Локальная модель занята дольше {self.local_wait:g}с"
+            )
+        try:
+            return self.local().complete(prompt).text
+        finally:
+            self._local_lock.release()
+
+    def _local_chunks(self, prompt: str) -> Iterator[CompletionResponse]:
+        if not self._local_lock.acquire(timeout=self.local_wait):
+            raise DeadlineExceeded(
+                f"Локальная модель занята дольше {self.local_wait:g}с"
+            )
+        try:
+            yield from self.local().stream_complete(prompt)
+        finally:
+            self._local_lock.release()
+
+    def _timed(self, route: str, started: float, stream) -> Iterator:
+        first = True
+        for chunk in stream:
+            if first:
+                self._observe(route, "first_token", started)
+                first = False
+            chunk.additional_kwargs["route"] = route
+            yield chunk
+        self._observe(route, "answer", started)
+
+    def complete(
+        self, kind: str, query_text: str, prompt_for: Callable[[bool], str]
+    ) -> Tuple[str, str]:
+        """(model that answered, answer text); prompt_for(local) builds the prompt"""
+        started = time.perf_counter()
+        route = self._start(kind, query_text)
+        if route == LOCAL:
+            try:
+                text = self._local_complete(prompt_for(True))
+            except Exception:
+                logging.exception("Локальная модель не ответила, спрашиваю удалённую")
+                LLM_ROUTES.inc(route=REMOTE, reason="local_failed")
+                route = REMOTE
+                text = self.remote().complete(prompt_for(False)).text
+        else:
+            route, text = self._remote_or_local(prompt_for)
+        self._observe(route, "answer", started)
+        return route, text
+
+    def _remote_or_local(self, prompt_for: Callable[[bool], str]) -> Tuple[str, str]:
+        prompt = prompt_for(False)
+        remote = self._executor.submit(lambda: self.remote().complete(prompt).text)
+        errors: Dict[str, BaseException] = {}
+        done, _ = wait({remote}, timeout=self.fallback_after or None)
+        if not done:
+            reason = "remote_slow"
+        elif remote.exception() is None:
+            return REMOTE, remote.result()
+        else:
+            errors[REMOTE] = remote.exception()
+            reason = "remote_failed"
+            logging.warning(
+                f"Удалённая модель не ответила ({errors[REMOTE]!r}), "
+                f"отвечает локальная"
+            )
+        LLM_ROUTES.inc(route=LOCAL, reason=reason)
+        futures = {self._executor.submit(self._local_complete, prompt_for(True)): LOCAL}
+        if not errors:
+            futures[remote] = REMOTE
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                route = futures.pop(future)
+                if future.exception() is None:
+                    return route, future.result()
+                errors[route] = future.exception()
+        # The remote error is the one worth reporting
+        raise errors.get(REMOTE) or errors[LOCAL]
+
+    def stream(
+        self, kind: str, query_text: str, prompt_for: Callable[[bool], str]
+    ) -> Iterator[CompletionResponse]:
+        """
+        Like complete(), but streams. Fallbacks happen only before the first
+        chunk, and a slow remote stream is not raced: ResilientLLM already
+        bounds the wait for its first token.
+        """
+        started = time.perf_counter()
+        route = self._start(kind, query_text)
+        if route == LOCAL:
+            try:
+                stream = _prefetched(self._local_chunks(prompt_for(True)))
+            except Exception:
+                logging.exception("Локальная модель не ответила, спрашиваю удалённую")
+                LLM_ROUTES.inc(route=REMOTE, reason="local_failed")
+                stream = self.remote().stream_complete(prompt_for(False))
+                route = REMOTE
+            yield from self._timed(route, started, stream)
+            return
+        try:
+            stream = self.remote().stream_complete(prompt_for(False))
+        except Exception as error:
+            logging.warning(
+                f"Удалённая модель не ответила ({error!r}), отвечает локальная"
+            )
+            LLM_ROUTES.inc(route=LOCAL, reason="remote_failed")
+            try:
+                stream = _prefetched(self._local_chunks(prompt_for(True)))
+            except Exception:
+                raise error
+            route = LOCAL
+        yield from self._timed(route, started, stream)
+
+    async def _alocal_complete(self, prompt: str) -> str:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._local_complete, prompt
+        )
+
+    async def _aremote_complete(self, prompt: str) -> str:
+        return (await self.remote().acomplete(prompt)).text
+
+    async def acomplete(
+        self, kind: str, query_text: str, prompt_for: Callable[[bool], str]
+    ) -> Tuple[str, str]:
+        """Async complete(); the local model runs in the router's threads"""
+        started = time.perf_counter()
+        route = self._start(kind, query_text)
+        if route == LOCAL:
+            try:
+                text = await self._alocal_complete(prompt_for(True))
+            except Exception:
+                logging.exception("Локальная модель не ответила, спрашиваю удалённую")
+                LLM_ROUTES.inc(route=REMOTE, reason="local_failed")
+                route = REMOTE
+                text = await self._aremote_complete(prompt_for(False))
+        else:
+            route, text = await self._aremote_or_local(prompt_for)
+        self._observe(route, "answer", started)
+        return route, text
+
+    async def _aremote_or_local(
+        self, prompt_for: Callable[[bool], str]
+    ) -> Tuple[str, str]:
+        remote = asyncio.ensure_future(self._aremote_complete(prompt_for(False)))
+        errors: Dict[str, BaseException] = {}
+        try:
+            done, _ = await asyncio.wait({remote}, timeout=self.fallback_after or None)
+            if not done:
+                reason = "remote_slow"
+            elif remote.exception() is None:
+                return REMOTE, remote.result()
+            else:
+                errors[REMOTE] = remote.exception()
+                reason = "remote_failed"
+                logging.warning(
+                    f"Удалённая модель не ответила ({errors[REMOTE]!r}), "
+                    f"отвечает локальная"
+                )
+            LLM_ROUTES.inc(route=LOCAL, reason=reason)
+            local = asyncio.ensure_future(self._alocal_complete(prompt_for(True)))
+            tasks = {local: LOCAL}
+            if not errors:
+                tasks[remote] = REMOTE
+            while tasks:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    route = tasks.pop(task)
+                    if task.exception() is None:
+                        return route, task.result()
+                    errors[route] = task.exception()
+            raise errors.get(REMOTE) or errors[LOCAL]
+        finally:
+            # A remote call that lost to the local model is not needed anymore
+            if not remote.done():
+                remote.cancel()
+
+    async def _atimed(self, route: str, started: float, stream) -> AsyncIterator:
+        first = True
+        async for chunk in stream:
+            if first:
+                self._observe(route, "first_token", started)
+                first = False
+            chunk.additional_kwargs["route"] = route
+            yield chunk
+        self._observe(route, "answer", started)
+
+    async def astream(
+        self, kind: str, query_text: str, prompt_for: Callable[[bool], str]
+    ) -> AsyncIterator[CompletionResponse]:
+        """
+        Async stream(). A local answer comes as one chunk: its generator would
+        otherwise have to be pumped from a thread chunk by chunk.
+        """
+        started = time.perf_counter()
+        route = self._start(kind, query_text)
+        if route == LOCAL:
+            try:
+                text = await self._alocal_complete(prompt_for(True))
+            except Exception:
+                logging.exception("Локальная модель не ответила, спрашиваю удалённую")
+                LLM_ROUTES.inc(route=REMOTE, reason="local_failed")
+                stream = await self.remote().astream_complete(prompt_for(False))
+                async for chunk in self._atimed(REMOTE, started, stream):
+                    yield chunk
+                return
+            self._observe(LOCAL, "first_token", started)
+            self._observe(LOCAL, "answer", started)
+            yield CompletionResponse(
+                text=text, delta=text, additional_kwargs={"route": LOCAL}
+            )
+            return
+        try:
+            stream = await self.remote().astream_complete(prompt_for(False))
+        except Exception as error:
+            logging.warning(
+                f"Удалённая модель не ответила ({error!r}), отвечает локальная"
+            )
+            LLM_ROUTES.inc(route=LOCAL, reason="remote_failed")
+            try:
+                text = await self._alocal_complete(prompt_for(True))
+            except Exception:
+                raise error
+            self._observe(LOCAL, "first_token", started)
+            self._observe(LOCAL, "answer", started)
+            yield CompletionResponse(
+                text=text, delta=text, additional_kwargs={"route": LOCAL}
+            )
+            return
+        async for chunk in self._atimed(REMOTE, started, stream):
+            yield chunk
+
+
+def create_llm_router() -> Optional[LLMRouter]:
+    """Router configured from config.py; None without a local model"""
+    if not config.LOCAL_LLM_BACKEND:
+        return None
+    return LLMRouter(
+        backends.get_llm,
+        backends.get_local_llm,
+        max_local_chars=config.LLM_ROUTE_LOCAL_MAX_CHARS,
+        local_kinds=config.LLM_ROUTE_LOCAL_KINDS,
+        fallback_after=config.LLM_ROUTE_FALLBACK_AFTER,
+        # A fallback should not outlast the remote call it replaces
+        local_wait=config.LLM_ATTEMPT_TIMEOUT,
+        max_workers=2 * config.LLM_CONCURRENCY + 4,
+    )
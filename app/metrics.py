@@ -0,0 +1,347 @@
+"""
+Lightweight metrics: per-stage timing spans, counters, gauges and a
+Prometheus-compatible /metrics endpoint. No external dependencies.
+"""
+
+import functools
+import inspect
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import (
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import config as config
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _labels_key(labelnames: Sequence[str], labels: dict) -> Tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames: Sequence[str], key: Tuple[str, ...], extra="") -> str:
+    pairs = [f'{n}="{v}"' for n, v in zip(labelnames, key)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonically increasing value per label set"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels) -> None:
+        key = _labels_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [
+                f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+                for key, value in self._values.items()
+            ]
+
+
+class Gauge:
+    """Current value, either set directly or read from a callback at scrape time"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._callbacks: Dict[Tuple[str, ...], Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[_labels_key(self.labelnames, labels)] = value
+
+    def set_function(self, fn: Callable[[], float], **labels) -> None:
+        with self._lock:
+            self._callbacks[_labels_key(self.labelnames, labels)] = fn
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+            callbacks = dict(self._callbacks)
+        for key, fn in callbacks.items():
+            try:
+                values[key] = fn()
+            except Exception:
+                logging.exception(f"Не удалось прочитать метрику {self.name}")
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+            for key, value in values.items()
+        ]
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> (bucket counts, sum, count)
+        self._values: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels_key(self.labelnames, labels)
+        with self._lock:
+            state = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """Holds all metrics and renders them in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labelnames, buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "ragbot_stage_seconds", "Duration of pipeline stages", ["stage"]
+)
+STAGE_ERRORS = REGISTRY.counter(
+    "ragbot_stage_errors_total", "Exceptions raised inside pipeline stages", ["stage"]
+)
+REQUESTS = REGISTRY.counter(
+    "ragbot_requests_total", "Handled bot commands by kind", ["kind"]
+)
+
+# Extra consumers of span timings (e.g. the benchmark needs raw samples)
+_span_listeners: List[Callable[[str, float], None]] = []
+
+
+def add_span_listener(listener: Callable[[str, float], None]) -> None:
+    """Receive (stage, seconds) for every finished span"""
+    _span_listeners.append(listener)
+
+
+def observe(stage: str, seconds: float) -> None:
+    """Record a stage duration measured elsewhere"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    for listener in _span_listeners:
+        listener(stage, seconds)
+
+
+@contextmanager
+def span(stage: str, **fields) -> Iterator[None]:
+    """Time a block as one pipeline stage; extra fields go to the debug log"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        observe(stage, seconds)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            details = " ".join(f"{k}={v}" for k, v in fields.items())
+            logging.debug(f"span stage={stage} ms={seconds * 1000:.1f} {details}")
+
+
+def timed_stream(stage: str, first_stage: str, stream: Iterator) -> Iterator:
+    """Time a generator until exhaustion, plus the delay to its first item"""
+    started = time.perf_counter()
+    first = True
+    try:
+        for item in stream:
+            if first:
+                observe(first_stage, time.perf_counter() - started)
+                first = False
+            yield item
+    finally:
+        observe(stage, time.perf_counter() - started)
+
+
+async def atimed_stream(
+    stage: str, first_stage: str, stream: AsyncIterator
+) -> AsyncIterator:
+    """Async variant of timed_stream"""
+    started = time.perf_counter()
+    first = True
+    try:
+        async for item in stream:
+            if first:
+                observe(first_stage, time.perf_counter() - started)
+                first = False
+            yield item
+    finally:
+        observe(stage, time.perf_counter() - started)
+
+
+def timed(stage: str, fn: Callable) -> Callable:
+    """Wrap a function or coroutine function in a span"""
+    if inspect.iscoroutinefunction(fn):
+
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            with span(stage):
+                return await fn(*args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with span(stage):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+# Returns component -> loaded; /ready answers 503 until every value is true
+_readiness_check: Callable[[], Dict[str, bool]] = dict
+READY = REGISTRY.gauge(
+    "ragbot_component_ready", "1 once a lazily loaded component is ready", ["component"]
+)
+
+
+def set_readiness_check(check: Callable[[], Dict[str, bool]]) -> None:
+    """Register the function behind /ready and ragbot_component_ready"""
+    global _readiness_check
+    _readiness_check = check
+    for component in check():
+        READY.set_function(
+            lambda component=component: int(_readiness_check()[component]),
+            component=component,
+        )
+
+
+def log_prompt(prompt: str) -> None:
+    """Prompts are large: log them at debug level, or at info for a sample"""
+    if random.random() < config.PROMPT_LOG_SAMPLE_RATE:
+        logging.info(f"{prompt}\n\n")
+    else:
+        logging.debug(f"{prompt}\n\n")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] == "/metrics":
+            body = REGISTRY.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+        elif self.path == "/healthz":
+            body = b"ok\n"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+        elif self.path == "/ready":
+            # Liveness is /healthz; /ready tells whether models are loaded yet
+            state = _readiness_check()
+            body = "".join(
+                f"{name} {'ready' if ready else 'loading'}\n"
+                for name, ready in state.items()
+            ).encode("utf-8")
+            self.send_response(200 if all(state.values()) else 503)
+            self.send_header("Content-Type", "text/plain")
+        else:
+            body = b"not found\n"
+            self.send_response(404)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would flood the log
+        pass
+
+
+def start_metrics_server(port: Optional[int] = None) -> Optional[ThreadingHTTPServer]:
+    """Serve /metrics from a daemon thread; port 0 disables the endpoint"""
+    port = config.METRICS_PORT if port is None else port
+    if not port:
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, name="metrics-http", daemon=True
+    ).start()
+    logging.info(f"Метрики доступны на :{port}/metrics")
+    return server
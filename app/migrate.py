@@ -0,0 +1,338 @@
+"""
+Rebuild the Qdrant collection into another storage profile without downtime.
+
+    python migrate.py --profile int8_on_disk
+
+The bot always talks to config.QDRANT_COLLECTION, which is an alias. The
+migration copies every point into a new physical collection, atomically
+repoints the alias and then catches up: points written during the copy (by
+their indexed_at write time) are copied once more, and points deleted from
+the old collection meanwhile are deleted from the new one. Compaction waits
+while the collections are marked as migrating. The old collection is
+dropped only when every one of its points is in the new one; otherwise it
+is kept and the count of missing points is logged.
+
+Collections created before hybrid search get their BM25 sparse vectors on the
+way, so running it with the current profile is how hybrid search is enabled.
+
+Old installs have a physical collection under the public name instead of an
+alias. That name is only freed by dropping the collection, and writes in
+that moment would be lost, so this one migration needs the bot stopped:
+
+    docker compose stop bot
+    python migrate.py --profile default --offline [--keep-old]
+    docker compose start bot
+
+With --keep-old a snapshot of the old collection is taken before the drop.
+"""
+
+import argparse
+import logging
+import time
+from typing import Optional
+
+from llama_index.core.schema import MetadataMode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from qdrant_client import QdrantClient, models
+
+import config as config
+import db as db
+from bm25 import BM25Encoder
+
+logging.basicConfig(level=logging.INFO)
+
+# Points written this many seconds before the copy started are re-copied too:
+# indexed_at is stamped when a batch is embedded, a little before its upsert
+CATCH_UP_MARGIN = 60
+
+
+def with_sparse_vector(point, bm25: BM25Encoder):
+    """Vectors of a point, plus a BM25 vector if it was stored without one"""
+    if isinstance(point.vector, dict):
+        if config.SPARSE_VECTOR_NAME in point.vector:
+            return point.vector
+        vectors = dict(point.vector)
+    else:
+        vectors = {"": point.vector}
+    # Same text the indexer encodes: node content with the embedded metadata
+    content = metadata_dict_to_node(point.payload).get_content(
+        metadata_mode=MetadataMode.EMBED
+    )
+    vectors[config.SPARSE_VECTOR_NAME] = bm25.encode_document(content)
+    return vectors
+
+
+def copy_points(
+    client: QdrantClient,
+    source: str,
+    target: str,
+    batch_size: int,
+    scroll_filter: Optional[models.Filter] = None,
+    bm25: Optional[BM25Encoder] = None,
+    copied_ids: Optional[set] = None,
+) -> int:
+    """Copy points with vectors and payload from source to target"""
+    copied = 0
+    offset = None
+    started = time.monotonic()
+    while True:
+        points, offset = client.scroll(
+            collection_name=source,
+            scroll_filter=scroll_filter,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True,
+        )
+        if points:
+            client.upsert(
+                collection_name=target,
+                points=[
+                    models.PointStruct(
+                        id=p.id,
+                        vector=with_sparse_vector(p, bm25) if bm25 else p.vector,
+                        payload=p.payload,
+                    )
+                    for p in points
+                ],
+            )
+            copied += len(points)
+            if copied_ids is not None:
+                copied_ids.update(p.id for p in points)
+            rate = copied / max(time.monotonic() - started, 1e-6)
+            logging.info(f"Скопировано {copied} точек ({rate:.0f}/с)")
+        if offset is None:
+            return copied
+
+
+def _id_batches(
+    client: QdrantClient,
+    collection: str,
+    batch_size: int,
+    scroll_filter: Optional[models.Filter] = None,
+):
+    """Point ids of a collection, a page at a time"""
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection,
+            scroll_filter=scroll_filter,
+            limit=batch_size,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False,
+        )
+        if points:
+            yield [point.id for point in points]
+        if offset is None:
+            return
+
+
+def _present(client: QdrantClient, collection: str, ids: list) -> set:
+    points = client.retrieve(
+        collection_name=collection, ids=ids, with_payload=False, with_vectors=False
+    )
+    return {point.id for point in points}
+
+
+def replay_deletes(
+    client: QdrantClient, source: str, target: str, ids: set, batch_size: int
+) -> int:
+    """Delete from target the points copied from source that source has lost since"""
+    ids = list(ids)
+    deleted = 0
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start : start + batch_size]
+        present = _present(client, source, batch)
+        gone = [i for i in batch if i not in present]
+        if gone:
+            client.delete(
+                collection_name=target,
+                points_selector=models.PointIdsList(points=gone),
+            )
+            deleted += len(gone)
+    return deleted
+
+
+def missing_points(
+    client: QdrantClient, source: str, target: str, batch_size: int
+) -> int:
+    """Number of points of source that target lacks"""
+    missing = 0
+    for ids in _id_batches(client, source, batch_size):
+        missing += len(ids) - len(_present(client, target, ids))
+    return missing
+
+
+def _mark_migrating(client: QdrantClient, collection: str, target: str) -> None:
+    """Set (or, with an empty target, clear) the marker compaction waits on"""
+    if not client.collection_exists(collection):
+        return
+    try:
+        client.update_collection(
+            collection_name=collection, metadata={db.MIGRATION_MARKER: target}
+        )
+    except Exception:
+        # Qdrant before 1.16 has no collection metadata; deletes are replayed
+        logging.warning(f"Не удалось пометить {collection}: сжатие не приостановлено")
+
+
+def _create_alias(alias_name: str, target: str) -> models.CreateAliasOperation:
+    return models.CreateAliasOperation(
+        create_alias=models.CreateAlias(collection_name=target, alias_name=alias_name)
+    )
+
+
+def swap_alias(client: QdrantClient, alias_name: str, target: str) -> None:
+    """Point the alias at target. Both operations go in one atomic request"""
+    client.update_collection_aliases(
+        change_aliases_operations=[
+            models.DeleteAliasOperation(
+                delete_alias=models.DeleteAlias(alias_name=alias_name)
+            ),
+            _create_alias(alias_name, target),
+        ]
+    )
+
+
+def replace_legacy_collection(
+    client: QdrantClient, name: str, target: str, keep_old: bool
+) -> None:
+    """Drop the physical collection called name and make name an alias of target"""
+    if keep_old:
+        snapshot = client.create_snapshot(collection_name=name)
+        logging.info(f"Снимок старой коллекции {name}: {snapshot.name}")
+    client.delete_collection(name)
+    try:
+        client.update_collection_aliases(
+            change_aliases_operations=[_create_alias(name, target)]
+        )
+    except Exception:
+        logging.error(f"Данные уже в {target}: создайте алиас {name} -> {target}")
+        raise
+
+
+def _copy_and_swap(
+    client: QdrantClient,
+    alias_name: str,
+    source: str,
+    target: str,
+    batch_size: int,
+    keep_old: bool,
+) -> int:
+    """
+    Copy source into target, point the alias at target and catch up;
+    returns the number of points copied
+    """
+    bm25 = BM25Encoder(
+        k1=config.BM25_K1, b=config.BM25_B, avg_doc_length=config.BM25_AVG_DOC_LENGTH
+    )
+    copy_started = int(time.time()) - CATCH_UP_MARGIN
+    # Ids only, to replay deletes: about 100 bytes per point
+    copied_ids: set = set()
+    copied = copy_points(
+        client, source, target, batch_size, bm25=bm25, copied_ids=copied_ids
+    )
+
+    if source == alias_name:
+        # The bot is stopped, so the copy is complete
+        replace_legacy_collection(client, alias_name, target, keep_old)
+        return copied
+
+    swap_alias(client, alias_name, target)
+    # Writes and deletes that reached the old collection during the copy
+    recent = models.Filter(
+        must=[
+            models.FieldCondition(
+                key="indexed_at", range=models.Range(gte=copy_started)
+            )
+        ]
+    )
+    copy_points(client, source, target, batch_size, recent, bm25)
+    deleted = replay_deletes(client, source, target, copied_ids, batch_size)
+    if deleted:
+        logging.info(f"Удалено {deleted} точек, удалённых из {source} при копировании")
+    missing = missing_points(client, source, target, batch_size)
+    if missing:
+        logging.error(
+            f"В {target} нет {missing} точек из {source}: {source} оставлена, "
+            "проверьте их и удалите её вручную"
+        )
+    elif not keep_old:
+        client.delete_collection(source)
+    return copied
+
+
+def migrate(
+    profile_name: str,
+    batch_size: int = 256,
+    keep_old: bool = False,
+    offline: bool = False,
+) -> str:
+    """
+    Migrate config.QDRANT_COLLECTION into a fresh collection with the given
+    profile. offline confirms the bot is stopped, which the legacy layout needs.
+    """
+    client = db.get_qdrant_client()
+    alias_name = config.QDRANT_COLLECTION
+    profile = db.get_profile(profile_name)
+
+    source = db.resolve_collection(client, alias_name)
+    if source is None:
+        raise SystemExit(f"Коллекция {alias_name} не найдена")
+    if source == alias_name and not offline:
+        raise SystemExit(
+            f"{alias_name} — коллекция, а не алиас: чтобы освободить имя, её "
+            "придётся удалить, и записи бота в этот момент пропадут. "
+            "Остановите бота и запустите с --offline"
+        )
+    target = db.versioned_collection_name(alias_name, profile)
+
+    logging.info(f"Миграция {source} -> {target} (профиль {profile['name']})")
+    db.create_collection(client, target, profile)
+    db.ensure_payload_indexes(client, target)
+    # Compaction pauses: its deletes in either collection would be lost
+    _mark_migrating(client, source, target)
+    _mark_migrating(client, target, target)
+    try:
+        copied = _copy_and_swap(
+            client, alias_name, source, target, batch_size, keep_old
+        )
+    finally:
+        _mark_migrating(client, source, "")
+        _mark_migrating(client, target, "")
+
+    logging.info(f"Готово: {alias_name} -> {target}, скопировано {copied} точек")
+    logging.info(
+        "Запущенный бот проверит BM25-векторы новой коллекции в течение "
+        f"{config.HYBRID_RECHECK_INTERVAL:g}с (HYBRID_RECHECK_INTERVAL)"
+    )
+    return target
+
+
+def main():
+    """CLI entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--profile",
+        default=config.QDRANT_PROFILE,
+        choices=sorted(config.COLLECTION_PROFILES),
+        help="профиль хранения новой коллекции",
+    )
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument(
+        "--keep-old",
+        action="store_true",
+        help="не удалять старую коллекцию (без алиаса: сохранить её снимок)",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="бот остановлен (нужно для коллекции без алиаса)",
+    )
+    args = parser.parse_args()
+    migrate(args.profile, args.batch_size, args.keep_old, args.offline)
+
+
+if __name__ == "__main__":
+    main()
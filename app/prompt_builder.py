@@ -0,0 +1,294 @@
+"""
+Prompt assembly under a token budget.
+
+The context window minus the space kept for the answer and the fixed part of
+the template is split between chat history and the retrieved context (memory
+or search results); whatever one side leaves unused goes to the other.
+History keeps the newest messages. Retrieved text is deduplicated, compressed
+to the lines that share words with the question and added best-first.
+"""
+
+import logging
+import re
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import backends as backends
+import config as config
+import metrics as metrics
+from bm25 import BM25Encoder
+from prompt_templates import std_template, web_search_template
+
+PROMPT_TOKENS = metrics.REGISTRY.histogram(
+    "ragbot_prompt_tokens",
+    "Prompt tokens per request by section",
+    ["kind", "section"],
+    buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384),
+)
+
+NO_MEMORY = "Пока ничего не помнишь."
+NO_RESULTS = "Ничего не нашлось."
+
+
+class PromptBuilder:
+    """
+    Fills std_template / web_search_template within a token budget.
+
+    Args:
+        context_window: Model context size in tokens.
+        reserved_output: Tokens left free for the answer.
+        history_share: Part of the free budget given to chat history first.
+        max_snippet_tokens: Cap for one memory document.
+        max_result_tokens: Cap for one search result.
+        tokenizer: Text -> tokens; llama_index's Settings.tokenizer by default.
+    """
+
+    def __init__(
+        self,
+        context_window: int = 8000,
+        reserved_output: int = 512,
+        history_share: float = 0.35,
+        max_snippet_tokens: int = 300,
+        max_result_tokens: int = 150,
+        tokenizer: Optional[Callable[[str], Sequence]] = None,
+    ):
+        self.context_window = context_window
+        self.reserved_output = reserved_output
+        self.history_share = history_share
+        self.max_snippet_tokens = max_snippet_tokens
+        self.max_result_tokens = max_result_tokens
+        self._tokenizer = tokenizer
+        self._terms = BM25Encoder()
+        self._skeleton_tokens: Dict[Tuple[str, str], int] = {}
+
+    def count(self, text: str) -> int:
+        tokenizer = self._tokenizer or backends.get_tokenizer()
+        return len(tokenizer(text))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Cut text to at most max_tokens, on a word boundary where possible"""
+        if max_tokens <= 0:
+            return ""
+        tokens = self.count(text)
+        if tokens <= max_tokens:
+            return text
+        kept = text
+        while tokens > max_tokens:
+            keep = max(1, int(len(kept) * max_tokens / tokens * 0.95))
+            cut = kept[:keep]
+            if " " in cut[keep // 2 :]:
+                cut = cut.rsplit(" ", 1)[0]
+            cut = cut.rstrip()
+            if not cut or len(cut) >= len(kept):
+                # No longer shrinking: the ellipsis itself does not fit
+                return self._hard_cut(text, max_tokens)
+            kept = cut
+            tokens = self.count(kept + "…")
+        return kept + "…"
+
+    def _hard_cut(self, text: str, max_tokens: int) -> str:
+        """Longest prefix within max_tokens; the ellipsis only if it still fits"""
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count(text[:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        prefix = text[:low]
+        if low > 1 and self.count(prefix[:-1] + "…") <= max_tokens:
+            return prefix[:-1] + "…"
+        return prefix
+
+    def _fit_history(self, history: List[str], budget: int) -> Tuple[List[str], int]:
+        """Newest messages that fit the budget, in chronological order"""
+        kept: List[str] = []
+        used = 0
+        for message in reversed(history):
+            tokens = self.count(message) + 1
+            if used + tokens > budget:
+                break
+            kept.append(message)
+            used += tokens
+        return kept[::-1], used
+
+    def _compress(self, text: str, query_terms: set, max_tokens: int) -> str:
+        """Keep the lines that share the most words with the query, in order"""
+        if self.count(text) <= max_tokens:
+            return text
+        lines = [line for line in text.splitlines() if line.strip()]
+        ranked = sorted(
+            range(len(lines)),
+            key=lambda i: (len(query_terms & set(self._terms.tokenize(lines[i]))), i),
+            reverse=True,
+        )
+        chosen, used = [], 0
+        for i in ranked:
+            tokens = self.count(lines[i]) + 1
+            if used + tokens > max_tokens:
+                continue
+            chosen.append(i)
+            used += tokens
+        if not chosen:
+            return self.truncate(lines[ranked[0]], max_tokens)
+        return "\n".join(lines[i] for i in sorted(chosen))
+
+    def _fit_snippets(self, snippets: List[str], budget: int) -> Tuple[List[str], int]:
+        """Add snippets best-first; the last one is trimmed into what is left"""
+        kept, used = [], 0
+        for snippet in snippets:
+            remaining = budget - used
+            if remaining < 32:
+                break
+            tokens = self.count(snippet) + 1
+            if tokens > remaining:
+                snippet = self.truncate(snippet, remaining - 1)
+                tokens = self.count(snippet) + 1
+            if snippet:
+                kept.append(snippet)
+                used += tokens
+        return kept, used
+
+    def _memory_snippets(self, nodes: list, history: List[str], query_text: str):
+        """Retrieved documents best-first, without lines already in the history"""
+        query_terms = set(self._terms.tokenize(query_text))
+        seen_lines = {
+            line.strip() for message in history for line in message.splitlines()
+        }
+        snippets, seen = [], set()
+        for node in sorted(nodes, key=lambda n: n.score or 0.0, reverse=True):
+            lines = [
+                line
+                for line in node.text.splitlines()
+                if line.strip() and line.strip() not in seen_lines
+            ]
+            text = "\n".join(lines)
+            key = re.sub(r"\s+", " ", text).strip().lower()
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            snippets.append(self._compress(text, query_terms, self.max_snippet_tokens))
+        return snippets
+
+    def _result_snippets(self, results) -> List[str]:
+        """Search results in rank order, one compact line each, duplicates dropped"""
+        if not isinstance(results, list):
+            return [self.truncate(str(results), self.max_result_tokens)]
+        snippets, seen = [], set()
+        for result in results:
+            if not isinstance(result, dict):
+                result = {"body": str(result)}
+            key = result.get("href") or result.get("body")
+            if key in seen:
+                continue
+            seen.add(key)
+            parts = [result.get("title", ""), result.get("body", "")]
+            line = " — ".join(p.strip() for p in parts if p and p.strip())
+            # The link survives trimming: the model may want to cite it
+            link = f" ({result['href']})" if result.get("href") else ""
+            line = self.truncate(line, self.max_result_tokens - self.count(link))
+            snippets.append(line + link)
+        return snippets
+
+    def _assemble(
+        self,
+        kind: str,
+        template,
+        context_key: str,
+        query_text: str,
+        from_username: str,
+        mood: str,
+        history: List[str],
+        snippets: List[str],
+        empty_context: str,
+    ) -> str:
+        """Split the budget, fill both sections and report token counts"""
+
+        def render(chat_history: str, context: str, query: str, username: str):
+            return template.format(
+                dan_username=config.DAN_USERNAME,
+                alex_username=config.ALEX_USERNAME,
+                artem_username=config.ARTEM_USERNAME,
+                chat_history=chat_history,
+                from_username=username,
+                query_text=query,
+                mood=config.MOODS[mood],
+                **{context_key: context},
+            )
+
+        # Rendering compiles the template, so the skeleton is counted once per mood
+        if (kind, mood) not in self._skeleton_tokens:
+            self._skeleton_tokens[(kind, mood)] = self.count(render("", "", "", ""))
+        fixed = (
+            self._skeleton_tokens[(kind, mood)]
+            + self.count(query_text)
+            + self.count(from_username)
+        )
+        free = max(0, self.context_window - self.reserved_output - fixed)
+        history_budget = int(free * self.history_share)
+        context_tokens = sum(self.count(s) + 1 for s in snippets)
+        # Whatever the context does not need goes to history, and back
+        history_budget = max(history_budget, free - context_tokens)
+        kept_history, history_used = self._fit_history(history, history_budget)
+        kept_snippets, context_used = self._fit_snippets(snippets, free - history_used)
+        prompt = render(
+            "\n".join(kept_history),
+            "\n".join(kept_snippets) or empty_context,
+            query_text,
+            from_username,
+        )
+        counts: Dict[str, int] = {
+            "fixed": fixed,
+            "history": history_used,
+            "context": context_used,
+            "total": self.count(prompt),
+        }
+        for section, tokens in counts.items():
+            PROMPT_TOKENS.observe(tokens, kind=kind, section=section)
+        logging.info(
+            f"Промпт {kind}: {counts['total']} токенов (история {history_used}, "
+            f"контекст {context_used}; сообщений {len(kept_history)}/{len(history)}, "
+            f"фрагментов {len(kept_snippets)}/{len(snippets)})"
+        )
+        return prompt
+
+    def build_query_prompt(
+        self,
+        query_text: str,
+        from_username: str,
+        history: List[str],
+        nodes: list,
+        mood: str,
+    ) -> str:
+        snippets = self._memory_snippets(nodes or [], history, query_text)
+        return self._assemble(
+            "query",
+            std_template,
+            "found_nodes",
+            query_text,
+            from_username,
+            mood,
+            history,
+            snippets,
+            NO_MEMORY,
+        )
+
+    def build_search_prompt(
+        self,
+        query_text: str,
+        from_username: str,
+        history: List[str],
+        results,
+        mood: str,
+    ) -> str:
+        snippets = self._result_snippets(results)
+        return self._assemble(
+            "search",
+            web_search_template,
+            "results",
+            query_text,
+            from_username,
+            mood,
+            history,
+            snippets,
+            NO_RESULTS,
+        )
@@ -50,3 +50,16 @@ web_search_template = RichPromptTemplate(
 <SEARCH>{{ results }}</SEARCH>
 """
 )
+
+summary_template = RichPromptTemplate(
+    """Ты ведёшь краткий конспект группового чата. В чате: Даня {{ dan_username }}, Лёша {{ alex_username }} и Тёма {{ artem_username }}.
+
+## Конспект до сих пор:
+<SUMMARY>{{ summary }}</SUMMARY>
+
+## Новые сообщения:
+<DIALOG>{{ messages }}</DIALOG>
+
+Перепиши конспект так, чтобы он включал новые сообщения. Сохрани кто что говорил, о чём договорились, обещания, планы и смешные моменты; мелочи и приветствия выкинь. Пиши сжато, одним абзацем, не больше {{ max_words }} слов. Выведи только новый конспект.
+"""
+)
@@ -1,94 +1,799 @@
-from llm_interface import SentenceTransformerEmbeddings
+import asyncio
 import logging
+import time
+import uuid
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Tuple
 from llama_index.vector_stores.qdrant import QdrantVectorStore
+import backends as backends
 import config as config
 import db as db
+import metrics as metrics
+import threading
 from llama_index.core import Settings, VectorStoreIndex, Document
 from llama_index.vector_stores.qdrant import QdrantVectorStore
-from llama_index.llms.together import TogetherLLM
 from qdrant_client import models
 from llama_index.core.tools.tool_spec.load_and_search.base import LoadAndSearchToolSpec
-from llama_index.tools.duckduckgo.base import DuckDuckGoSearchToolSpec
 from llama_index.core.prompts import RichPromptTemplate
-from prompt_templates import web_search_template, std_template
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.vector_stores import (
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+)
+from llama_index.core.vector_stores.utils import (
+    metadata_dict_to_node,
+    node_to_metadata_dict,
+)
+from bm25 import BM25Encoder
+from llm_router import REMOTE, chunk_route, create_llm_router
+from prompt_builder import PromptBuilder
+from rerank import create_reranker
+from response_cache import SemanticResponseCache
 
-Settings.embed_model = SentenceTransformerEmbeddings()
+# Эмбеддер, LLM и поиск грузятся лениво (см. backends.get_*), не при импорте
 
-Settings.llm = TogetherLLM(
-    model=config.LLM_MODEL, api_key=config.TOGETHER_API_KEY, context_window=8000
-)
+# Payload-поля, которые нужны только для фильтрации в Qdrant
+FILTER_ONLY_METADATA = ["chat_id", "timestamp", "type"]
 
 
 class RagEngine:
     def __init__(self):
         # Инициализируем Qdrant клиент и векторное хранилище
         self.client = db.get_qdrant_client()
-        self.web_search_spec = DuckDuckGoSearchToolSpec()
-        if not self.client.collection_exists(config.QDRANT_COLLECTION):
-            self.client.create_collection(
-                collection_name=config.QDRANT_COLLECTION,
-                vectors_config=models.VectorParams(
-                    size=1024, distance=models.Distance.COSINE
-                ),
+        self.aclient = db.get_async_qdrant_client()
+        db.ensure_collection(self.client, config.QDRANT_COLLECTION)
+        db.backfill_chat_payload(self.client, config.QDRANT_COLLECTION)
+        # Гибридный поиск (BM25 + эмбеддинги), если у коллекции есть sparse-векторы
+        self.bm25 = BM25Encoder(
+            k1=config.BM25_K1,
+            b=config.BM25_B,
+            avg_doc_length=config.BM25_AVG_DOC_LENGTH,
+        )
+        self.hybrid = config.HYBRID_SEARCH and db.has_sparse_vectors(
+            self.client, config.QDRANT_COLLECTION
+        )
+        # Досчёт кандидатов по исходным векторам для квантованных профилей
+        self.search_params = db.search_params(
+            db.collection_profile(self.client, config.QDRANT_COLLECTION)
+        )
+        # migrate.py может перевесить алиас на коллекцию с BM25 или другим
+        # профилем на ходу: перепроверяем раз в HYBRID_RECHECK_INTERVAL и после
+        # ошибок Qdrant
+        self._collection_checked = time.monotonic()
+        if config.HYBRID_SEARCH and not self.hybrid:
+            logging.warning(
+                "В коллекции нет BM25-векторов, ищу только по эмбеддингам. "
+                "Чтобы включить гибридный поиск, запустите python migrate.py"
             )
         self.vector_store = QdrantVectorStore(
-            client=self.client, collection_name=config.QDRANT_COLLECTION
+            client=self.client,
+            aclient=self.aclient,
+            collection_name=config.QDRANT_COLLECTION,
+        )
+        # Индекс создаётся при первом ретриве, когда понадобится эмбеддер
+        self._index: Optional[VectorStoreIndex] = None
+        self._index_lock = threading.Lock()
+        # Реранкинг кандидатов: затухание по времени, кросс-энкодер, MMR
+        self.reranker = create_reranker()
+        # Промпты собираются в пределах бюджета токенов окна модели
+        self.prompt_builder = PromptBuilder(
+            context_window=config.LLM_CONTEXT_WINDOW,
+            reserved_output=config.PROMPT_RESERVED_OUTPUT_TOKENS,
+            history_share=config.PROMPT_HISTORY_SHARE,
+            max_snippet_tokens=config.PROMPT_MAX_SNIPPET_TOKENS,
+            max_result_tokens=config.PROMPT_MAX_RESULT_TOKENS,
+        )
+        # Локальная модель на CPU: короткие вопросы и запасной вариант, когда
+        # удалённая тормозит или лежит. Промпты для неё режутся под её окно
+        self.router = create_llm_router()
+        self.local_prompt_builder: Optional[PromptBuilder] = None
+        if self.router is not None:
+            self.local_prompt_builder = PromptBuilder(
+                context_window=config.LOCAL_LLM_CONTEXT_WINDOW,
+                reserved_output=config.LOCAL_LLM_MAX_TOKENS,
+                history_share=config.PROMPT_HISTORY_SHARE,
+                max_snippet_tokens=config.PROMPT_MAX_SNIPPET_TOKENS,
+                max_result_tokens=config.PROMPT_MAX_RESULT_TOKENS,
+            )
+        # Семантический кэш ответов (по чату, команде и настроению)
+        self.response_cache: Optional[SemanticResponseCache] = None
+        if config.RESPONSE_CACHE_ENABLED:
+            self.response_cache = SemanticResponseCache(
+                threshold=config.RESPONSE_CACHE_THRESHOLD,
+                ttl=config.RESPONSE_CACHE_TTL,
+                max_entries=config.RESPONSE_CACHE_MAX_ENTRIES,
+            )
+            cache_gauge = metrics.REGISTRY.gauge(
+                "ragbot_response_cache", "Semantic answer cache counters", ["field"]
+            )
+            for field in ("entries", "hits", "misses"):
+                cache_gauge.set_function(
+                    lambda field=field: self.response_cache.stats()[field], field=field
+                )
+
+    def _collection_check_due(self) -> bool:
+        return (
+            time.monotonic() - self._collection_checked
+            >= config.HYBRID_RECHECK_INTERVAL
+        )
+
+    def _recheck_collection(self) -> None:
+        """Перечитывает профиль коллекции за алиасом и есть ли у неё BM25-векторы"""
+        self._collection_checked = time.monotonic()
+        try:
+            profile = db.collection_profile(self.client, config.QDRANT_COLLECTION)
+            hybrid = config.HYBRID_SEARCH and db.has_sparse_vectors(
+                self.client, config.QDRANT_COLLECTION
+            )
+        except Exception:
+            logging.exception("Не удалось проверить коллекцию за алиасом")
+            return
+        if hybrid != self.hybrid:
+            logging.info(
+                "Коллекция сменилась: гибридный поиск "
+                + ("включён" if hybrid else "выключен")
+            )
+            self.hybrid = hybrid
+        self.search_params = db.search_params(profile)
+
+    def _qdrant_failed(self) -> None:
+        # Возможно, алиас перевесили: проверим коллекцию при следующем запросе
+        self._collection_checked = float("-inf")
+
+    @property
+    def index(self) -> VectorStoreIndex:
+        if self._index is None:
+            with self._index_lock:
+                if self._index is None:
+                    self._index = VectorStoreIndex.from_vector_store(
+                        vector_store=self.vector_store,
+                        embed_model=backends.get_embed_model(),
+                    )
+        return self._index
+
+    def _cache_lookup(
+        self,
+        kind: str,
+        chat_id: Optional[int],
+        user: str,
+        query_text: str,
+        mood: str,
+    ) -> Tuple[Optional[str], Optional[list]]:
+        """Возвращает (ответ из кэша или None, эмбеддинг запроса или None)"""
+        if self.response_cache is None or chat_id is None:
+            return None, None
+        with metrics.span("response_cache"):
+            embedding = backends.get_embed_model().get_query_embedding(query_text)
+            return (
+                self.response_cache.get(chat_id, kind, mood, user, embedding),
+                embedding,
+            )
+
+    async def _acache_lookup(
+        self,
+        kind: str,
+        chat_id: Optional[int],
+        user: str,
+        query_text: str,
+        mood: str,
+    ) -> Tuple[Optional[str], Optional[list]]:
+        if self.response_cache is None or chat_id is None:
+            return None, None
+        with metrics.span("response_cache"):
+            embed_model = await backends.aget_embed_model()
+            embedding = await embed_model.aget_query_embedding(query_text)
+            return (
+                self.response_cache.get(chat_id, kind, mood, user, embedding),
+                embedding,
+            )
+
+    def _cache_store(
+        self,
+        kind: str,
+        chat_id: Optional[int],
+        user: str,
+        mood: str,
+        embedding: Optional[list],
+        answer: str,
+        route: str,
+    ) -> None:
+        # Ответы локальной модели (в т.ч. фолбэк) хуже — их не кэшируем
+        if route != REMOTE:
+            return
+        if self.response_cache is not None and embedding is not None and answer:
+            self.response_cache.put(chat_id, kind, mood, user, embedding, answer)
+
+    @staticmethod
+    def _query_bundle(query_text: str, embedding: Optional[list]):
+        # Эмбеддинг уже посчитан для кэша — не считаем его второй раз при ретриве
+        if embedding is None:
+            return query_text
+        return QueryBundle(query_str=query_text, embedding=embedding)
+
+    def retriever(
+        self,
+        chat_id: Optional[int] = None,
+        author: Optional[str] = None,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        top_k: int = 3,
+    ):
+        """
+        Retriever по памяти одного чата; опционально фильтрует по автору
+        и по окну времени (unix timestamp). Фильтры идут в Qdrant по payload-индексам.
+        """
+        filters = []
+        if chat_id is not None:
+            filters.append(MetadataFilter(key="chat_id", value=chat_id))
+        if author is not None:
+            filters.append(MetadataFilter(key="author", value=author))
+        if since is not None:
+            filters.append(
+                MetadataFilter(
+                    key="timestamp", value=since, operator=FilterOperator.GTE
+                )
+            )
+        if until is not None:
+            filters.append(
+                MetadataFilter(
+                    key="timestamp", value=until, operator=FilterOperator.LTE
+                )
+            )
+        return self.index.as_retriever(
+            similarity_top_k=top_k,
+            filters=MetadataFilters(filters=filters) if filters else None,
+        )
+
+    @staticmethod
+    def _chat_filter(chat_id: Optional[int]) -> Optional[models.Filter]:
+        if chat_id is None:
+            return None
+        return models.Filter(
+            must=[
+                models.FieldCondition(
+                    key="chat_id", match=models.MatchValue(value=chat_id)
+                )
+            ]
+        )
+
+    def _hybrid_request(
+        self, query_text: str, embedding: list, chat_id: Optional[int], top_k: int
+    ) -> dict:
+        """Один запрос в Qdrant: кандидаты dense и BM25, слитые через RRF"""
+        query_filter = self._chat_filter(chat_id)
+        prefetch = [
+            models.Prefetch(
+                query=embedding,
+                filter=query_filter,
+                params=self.search_params,
+                limit=config.HYBRID_PREFETCH_LIMIT,
+            )
+        ]
+        sparse = self.bm25.encode_query(query_text)
+        if sparse.indices:
+            prefetch.append(
+                models.Prefetch(
+                    query=sparse,
+                    using=config.SPARSE_VECTOR_NAME,
+                    filter=query_filter,
+                    limit=config.HYBRID_PREFETCH_LIMIT,
+                )
+            )
+        return dict(
+            collection_name=config.QDRANT_COLLECTION,
+            prefetch=prefetch,
+            query=models.FusionQuery(fusion=models.Fusion.RRF),
+            limit=top_k,
+            with_payload=True,
+        )
+
+    def _plain_dense_search(self) -> bool:
+        # llama_index не передаёт параметры поиска: квантованные коллекции
+        # ищем своим запросом, с досчётом по исходным векторам
+        return not self.hybrid and self.reranker is None and self.search_params is None
+
+    def _search_request(
+        self, query_text: str, embedding: list, chat_id: Optional[int], top_k: int
+    ) -> dict:
+        """
+        Запрос в Qdrant мимо llama_index: гибридный, и/или с запасом кандидатов
+        и их векторами для реранкинга
+        """
+        limit = top_k if self.reranker is None else self.reranker.candidates(top_k)
+        if self.hybrid:
+            request = self._hybrid_request(query_text, embedding, chat_id, limit)
+        else:
+            request = dict(
+                collection_name=config.QDRANT_COLLECTION,
+                query=embedding,
+                query_filter=self._chat_filter(chat_id),
+                search_params=self.search_params,
+                limit=limit,
+                with_payload=True,
+            )
+        # Сохранённые векторы нужны MMR, чтобы не считать эмбеддинги заново
+        request["with_vectors"] = self.reranker is not None
+        return request
+
+    @staticmethod
+    def _points_to_nodes(points) -> List[NodeWithScore]:
+        return [
+            NodeWithScore(node=metadata_dict_to_node(point.payload), score=point.score)
+            for point in points
+        ]
+
+    @staticmethod
+    def _dense_vector(point) -> Optional[list]:
+        # В гибридной коллекции векторы именованные: dense без имени, BM25 отдельно
+        if isinstance(point.vector, dict):
+            return point.vector.get("")
+        return point.vector
+
+    def _rank(self, query_text: str, points, top_k: int) -> List[NodeWithScore]:
+        nodes = self._points_to_nodes(points)
+        if self.reranker is None:
+            return nodes
+        vectors = [self._dense_vector(point) for point in points]
+        return self.reranker.rerank(query_text, nodes, vectors, top_k)
+
+    def retrieve(
+        self,
+        query_text: str,
+        embedding: Optional[list] = None,
+        chat_id: Optional[int] = None,
+        top_k: int = 3,
+    ) -> List[NodeWithScore]:
+        """
+        Ищет по памяти чата. embedding — уже посчитанный эмбеддинг запроса
+        (например, для кэша ответов), чтобы не считать его второй раз.
+        """
+        if embedding is None:
+            embedding = backends.get_embed_model().get_query_embedding(query_text)
+        if self._collection_check_due():
+            self._recheck_collection()
+        with metrics.span("retrieve", hybrid=self.hybrid):
+            try:
+                if self._plain_dense_search():
+                    return self.retriever(chat_id, top_k=top_k).retrieve(
+                        self._query_bundle(query_text, embedding)
+                    )
+                response = self.client.query_points(
+                    **self._search_request(query_text, embedding, chat_id, top_k)
+                )
+            except Exception:
+                self._qdrant_failed()
+                raise
+        return self._rank(query_text, response.points, top_k)
+
+    async def aretrieve(
+        self,
+        query_text: str,
+        embedding: Optional[list] = None,
+        chat_id: Optional[int] = None,
+        top_k: int = 3,
+    ) -> List[NodeWithScore]:
+        # Эмбеддинг запроса считается в пуле потоков, поиск идёт через async Qdrant
+        if embedding is None:
+            embed_model = await backends.aget_embed_model()
+            embedding = await embed_model.aget_query_embedding(query_text)
+        if self.aclient is None:
+            # Без async клиента (QDRANT_BACKEND=memory) ищем синхронно в пуле потоков
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.retrieve, query_text, embedding, chat_id, top_k
+            )
+        if self._collection_check_due():
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._recheck_collection
+            )
+        with metrics.span("retrieve", hybrid=self.hybrid):
+            try:
+                if self._plain_dense_search():
+                    return await self.retriever(chat_id, top_k=top_k).aretrieve(
+                        self._query_bundle(query_text, embedding)
+                    )
+                response = await self.aclient.query_points(
+                    **self._search_request(query_text, embedding, chat_id, top_k)
+                )
+            except Exception:
+                self._qdrant_failed()
+                raise
+        if self.reranker is not None and self.reranker.cross_encoder is not None:
+            # Кросс-энкодер считает на CPU — не в event loop
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self._rank, query_text, response.points, top_k
+            )
+        return self._rank(query_text, response.points, top_k)
+
+    def _generate(
+        self, kind: str, query_text: str, prompt_for: Callable[[bool], str]
+    ) -> Tuple[str, str]:
+        """(модель, ответ LLM); prompt_for(local) собирает промпт под нужную модель"""
+        if self.router is None:
+            prompt = prompt_for(False)
+            with metrics.span("llm"):
+                return REMOTE, backends.get_llm().complete(prompt).text
+        with metrics.span("llm"):
+            return self.router.complete(kind, query_text, prompt_for)
+
+    def _generate_stream(
+        self, kind: str, query_text: str, prompt_for: Callable[[bool], str]
+    ) -> Iterator:
+        if self.router is None:
+            stream = backends.get_llm().stream_complete(prompt_for(False))
+        else:
+            stream = self.router.stream(kind, query_text, prompt_for)
+        return metrics.timed_stream("llm", "llm_first_token", stream)
+
+    async def _agenerate(
+        self, kind: str, query_text: str, prompt_for: Callable[[bool], str]
+    ) -> Tuple[str, str]:
+        # Удалённая LLM грузится в пуле потоков, не в event loop
+        llm = await backends.aget_llm()
+        if self.router is None:
+            prompt = prompt_for(False)
+            with metrics.span("llm"):
+                return REMOTE, (await llm.acomplete(prompt)).text
+        with metrics.span("llm"):
+            return await self.router.acomplete(kind, query_text, prompt_for)
+
+    async def _agenerate_stream(
+        self, kind: str, query_text: str, prompt_for: Callable[[bool], str]
+    ) -> AsyncIterator:
+        llm = await backends.aget_llm()
+        if self.router is None:
+            stream = await llm.astream_complete(prompt_for(False))
+        else:
+            stream = self.router.astream(kind, query_text, prompt_for)
+        return metrics.atimed_stream("llm", "llm_first_token", stream)
+
+    def _build_search_prompt(
+        self,
+        query_text: str,
+        from_username: str,
+        history: list,
+        results,
+        mood: str,
+        local: bool = False,
+    ) -> str:
+        builder = self.local_prompt_builder if local else self.prompt_builder
+        with metrics.span("prompt_build"):
+            prompt = builder.build_search_prompt(
+                query_text, from_username, history, results, mood
+            )
+        metrics.log_prompt(prompt)
+        return prompt
+
+    def search_web(
+        self,
+        query_text: str,
+        from_username: str,
+        history: list,
+        chat_id: Optional[int] = None,
+    ) -> str:
+        query_text = query_text.replace("Загугли", "")
+        mood = config.get_mood_bucket()
+        # Поиск идёт в фоне, пока мы проверяем кэш ответов
+        search = backends.get_search_tool().submit(query_text, "ru-ru")
+        cached, embedding = self._cache_lookup(
+            "search", chat_id, from_username, query_text, mood
+        )
+        if cached is not None:
+            return cached
+
+        with metrics.span("web_search"):
+            results = search.result()
+
+        route, text = self._generate(
+            "search",
+            query_text,
+            lambda local: self._build_search_prompt(
+                query_text, from_username, history, results, mood, local
+            ),
+        )
+
+        self._cache_store(
+            "search", chat_id, from_username, mood, embedding, text, route
+        )
+        return text
+
+    def stream_search_web(
+        self,
+        query_text: str,
+        from_username: str,
+        history: list,
+        chat_id: Optional[int] = None,
+    ) -> Iterator[str]:
+        """Как search_web, но отдаёт накопленный текст ответа по мере генерации"""
+        query_text = query_text.replace("Загугли", "")
+        mood = config.get_mood_bucket()
+        # Поиск идёт в фоне, пока мы проверяем кэш ответов
+        search = backends.get_search_tool().submit(query_text, "ru-ru")
+        cached, embedding = self._cache_lookup(
+            "search", chat_id, from_username, query_text, mood
+        )
+        if cached is not None:
+            yield cached
+            return
+
+        with metrics.span("web_search"):
+            results = search.result()
+
+        text, route = "", REMOTE
+        for chunk in self._generate_stream(
+            "search",
+            query_text,
+            lambda local: self._build_search_prompt(
+                query_text, from_username, history, results, mood, local
+            ),
+        ):
+            text, route = chunk.text, chunk_route(chunk)
+            yield text
+        self._cache_store(
+            "search", chat_id, from_username, mood, embedding, text, route
+        )
+
+    async def asearch_web(
+        self,
+        query_text: str,
+        from_username: str,
+        history: list,
+        chat_id: Optional[int] = None,
+    ) -> str:
+        query_text = query_text.replace("Загугли", "")
+        mood = config.get_mood_bucket()
+        # Поиск идёт в фоне, пока мы проверяем кэш ответов
+        search_tool = await backends.aget_search_tool()
+        search = search_tool.submit(query_text, "ru-ru")
+        cached, embedding = await self._acache_lookup(
+            "search", chat_id, from_username, query_text, mood
         )
-        # Создаём пустой индекс; embed_model и llm будут подхвачены из Settings
-        self.index = VectorStoreIndex.from_vector_store(
-            vector_store=self.vector_store, embed_model=Settings.embed_model
+        if cached is not None:
+            return cached
+
+        with metrics.span("web_search"):
+            results = await asyncio.wrap_future(search)
+
+        route, text = await self._agenerate(
+            "search",
+            query_text,
+            lambda local: self._build_search_prompt(
+                query_text, from_username, history, results, mood, local
+            ),
+        )
+
+        self._cache_store(
+            "search", chat_id, from_username, mood, embedding, text, route
         )
+        return text
 
-    def search_web(self, query_text: str, from_username: str, history: list) -> str:
+    async def astream_search_web(
+        self,
+        query_text: str,
+        from_username: str,
+        history: list,
+        chat_id: Optional[int] = None,
+    ) -> AsyncIterator[str]:
         query_text = query_text.replace("Загугли", "")
+        mood = config.get_mood_bucket()
+        # Поиск идёт в фоне, пока мы проверяем кэш ответов
+        search_tool = await backends.aget_search_tool()
+        search = search_tool.submit(query_text, "ru-ru")
+        cached, embedding = await self._acache_lookup(
+            "search", chat_id, from_username, query_text, mood
+        )
+        if cached is not None:
+            yield cached
+            return
 
-        results = self.web_search_spec.duckduckgo_full_search(query_text, "ru-ru")
+        with metrics.span("web_search"):
+            results = await asyncio.wrap_future(search)
 
-        prompt = web_search_template.format(
-            dan_username=config.DAN_USERNAME,
-            alex_username=config.ALEX_USERNAME,
-            artem_username=config.ARTEM_USERNAME,
-            chat_history=chr(10).join(history),
-            from_username=from_username,
-            query_text=query_text,
-            results=results,
-            mood=config.get_mood(),
+        text, route = "", REMOTE
+        async for chunk in await self._agenerate_stream(
+            "search",
+            query_text,
+            lambda local: self._build_search_prompt(
+                query_text, from_username, history, results, mood, local
+            ),
+        ):
+            text, route = chunk.text, chunk_route(chunk)
+            yield text
+        self._cache_store(
+            "search", chat_id, from_username, mood, embedding, text, route
         )
-        logging.info(f"{prompt}\n\n")
-        llm_response = Settings.llm.complete(prompt)
 
-        return llm_response.text
+    def _point_vectors(self, content: str, embedding: list):
+        """Dense-вектор точки и, для гибридной коллекции, её BM25-вектор"""
+        if not self.hybrid:
+            return embedding
+        return {
+            "": embedding,
+            config.SPARSE_VECTOR_NAME: self.bm25.encode_document(content),
+        }
 
     def index_documents(self, docs: list):
         """
-        Индексируем список документов.
+        Индексируем список документов одной пачкой:
+        один вызов энкодера на все чанки и один bulk upsert в Qdrant.
         При совпадении doc_id в Qdrant будет upsert.
         """
-        for doc in docs:
-            self.index.insert(
-                Document(text=doc["text"], doc_id=doc["id"], metadata=doc["metadata"])
+        if not docs:
+            return
+        points = self.build_points(docs)
+        with metrics.span("index_upsert", points=len(points)):
+            try:
+                self.client.upsert(
+                    collection_name=config.QDRANT_COLLECTION, points=points
+                )
+            except Exception:
+                self._qdrant_failed()
+                raise
+
+    def build_points(self, docs: list) -> list:
+        """Режем документы на чанки и считаем их векторы, без записи в Qdrant"""
+        if self._collection_check_due():
+            self._recheck_collection()
+        documents = [
+            Document(
+                text=doc["text"],
+                doc_id=doc["id"],
+                metadata=doc["metadata"],
+                # Служебные поля для фильтрации не попадают в эмбеддинг и промпт
+                excluded_embed_metadata_keys=FILTER_ONLY_METADATA,
+                excluded_llm_metadata_keys=FILTER_ONLY_METADATA,
             )
+            for doc in docs
+        ]
+        nodes = Settings.node_parser.get_nodes_from_documents(documents)
+        # Детерминированные id точек, чтобы повторная индексация перезаписывала чанки
+        chunk_numbers = {}
+        for node in nodes:
+            n = chunk_numbers.get(node.ref_doc_id, 0)
+            chunk_numbers[node.ref_doc_id] = n + 1
+            node.id_ = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{node.ref_doc_id}#{n}"))
 
-    def query(self, query_text: str, from_username: str, history: list) -> str:
-        # Получаем retriever и делаем явный ретрив документов
-        retriever = self.index.as_retriever(similarity_top_k=3)
-        nodes = retriever.retrieve(query_text)
-        if nodes:
-            nodes = [i.text for i in nodes]
-        else:
-            nodes = ["Пока ничего не помнишь."]
-        prompt = std_template.format(
-            dan_username=config.DAN_USERNAME,
-            alex_username=config.ALEX_USERNAME,
-            artem_username=config.ARTEM_USERNAME,
-            chat_history=chr(10).join(history),
-            from_username=from_username,
-            query_text=query_text,
-            found_nodes=chr(10).join(nodes),
-            mood=config.get_mood(),
-        )
-
-        logging.info(f"{prompt}\n\n")
-        llm_response = Settings.llm.complete(prompt)
-
-        return llm_response.text
+        contents = [
+            node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes
+        ]
+        with metrics.span("index_embed", chunks=len(nodes)):
+            embeddings = backends.get_embed_model().get_text_embedding_batch(contents)
+        # Время записи (timestamp — время сообщения): по нему migrate.py
+        # докопирует точки, записанные во время копирования
+        indexed_at = int(time.time())
+        return [
+            models.PointStruct(
+                id=node.node_id,
+                vector=self._point_vectors(content, embedding),
+                payload={
+                    **node_to_metadata_dict(node, remove_text=False),
+                    "indexed_at": indexed_at,
+                },
+            )
+            for node, content, embedding in zip(nodes, contents, embeddings)
+        ]
+
+    def _build_query_prompt(
+        self,
+        query_text: str,
+        from_username: str,
+        history: list,
+        nodes: list,
+        mood: str,
+        local: bool = False,
+    ) -> str:
+        builder = self.local_prompt_builder if local else self.prompt_builder
+        with metrics.span("prompt_build"):
+            prompt = builder.build_query_prompt(
+                query_text, from_username, history, nodes, mood
+            )
+        metrics.log_prompt(prompt)
+        return prompt
+
+    def query(
+        self,
+        query_text: str,
+        from_username: str,
+        history: list,
+        chat_id: Optional[int] = None,
+    ) -> str:
+        mood = config.get_mood_bucket()
+        cached, embedding = self._cache_lookup(
+            "query", chat_id, from_username, query_text, mood
+        )
+        if cached is not None:
+            return cached
+
+        nodes = self.retrieve(query_text, embedding, chat_id)
+        route, text = self._generate(
+            "query",
+            query_text,
+            lambda local: self._build_query_prompt(
+                query_text, from_username, history, nodes, mood, local
+            ),
+        )
+
+        self._cache_store("query", chat_id, from_username, mood, embedding, text, route)
+        return text
+
+    async def aquery(
+        self,
+        query_text: str,
+        from_username: str,
+        history: list,
+        chat_id: Optional[int] = None,
+    ) -> str:
+        mood = config.get_mood_bucket()
+        cached, embedding = await self._acache_lookup(
+            "query", chat_id, from_username, query_text, mood
+        )
+        if cached is not None:
+            return cached
+
+        nodes = await self.aretrieve(query_text, embedding, chat_id)
+        route, text = await self._agenerate(
+            "query",
+            query_text,
+            lambda local: self._build_query_prompt(
+                query_text, from_username, history, nodes, mood, local
+            ),
+        )
+
+        self._cache_store("query", chat_id, from_username, mood, embedding, text, route)
+        return text
+
+    def stream_query(
+        self,
+        query_text: str,
+        from_username: str,
+        history: list,
+        chat_id: Optional[int] = None,
+    ) -> Iterator[str]:
+        """Как query, но отдаёт накопленный текст ответа по мере генерации"""
+        mood = config.get_mood_bucket()
+        cached, embedding = self._cache_lookup(
+            "query", chat_id, from_username, query_text, mood
+        )
+        if cached is not None:
+            yield cached
+            return
+
+        nodes = self.retrieve(query_text, embedding, chat_id)
+        text, route = "", REMOTE
+        for chunk in self._generate_stream(
+            "query",
+            query_text,
+            lambda local: self._build_query_prompt(
+                query_text, from_username, history, nodes, mood, local
+            ),
+        ):
+            text, route = chunk.text, chunk_route(chunk)
+            yield text
+        self._cache_store("query", chat_id, from_username, mood, embedding, text, route)
+
+    async def astream_query(
+        self,
+        query_text: str,
+        from_username: str,
+        history: list,
+        chat_id: Optional[int] = None,
+    ) -> AsyncIterator[str]:
+        mood = config.get_mood_bucket()
+        cached, embedding = await self._acache_lookup(
+            "query", chat_id, from_username, query_text, mood
+        )
+        if cached is not None:
+            yield cached
+            return
+
+        nodes = await self.aretrieve(query_text, embedding, chat_id)
+        text, route = "", REMOTE
+        async for chunk in await self._agenerate_stream(
+            "query",
+            query_text,
+            lambda local: self._build_query_prompt(
+                query_text, from_username, history, nodes, mood, local
+            ),
+        ):
+            text, route = chunk.text, chunk_route(chunk)
+            yield text
+        self._cache_store("query", chat_id, from_username, mood, embedding, text, route)
@@ -0,0 +1,209 @@
+"""
+Post-retrieval stage: time decay, optional cross-encoder and MMR.
+
+Retrieval over-fetches candidates together with their stored dense vectors,
+so diversity is measured without embedding anything again. Relevance is the
+retrieval score or, with a cross-encoder, its score for (query, chunk),
+blended with an exponential decay of the chunk's age. Maximal marginal
+relevance then picks top_k chunks that are relevant and unlike the ones
+already picked, so near-identical author groups do not fill the prompt.
+
+Every step is timed as its own metrics stage. The whole stage has a latency
+budget: the cross-encoder only scores as many candidates as its recent speed
+fits into what is left, or none.
+"""
+
+import logging
+import threading
+import time
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+from llama_index.core.schema import MetadataMode, NodeWithScore
+
+import backends as backends
+import config as config
+import metrics as metrics
+
+RERANK_RESULTS = metrics.REGISTRY.counter(
+    "ragbot_rerank_total", "Re-ranking runs by cross-encoder outcome", ["outcome"]
+)
+
+SECONDS_PER_DAY = 86400
+
+
+def normalize(scores: np.ndarray) -> np.ndarray:
+    """Min-max to [0, 1]; retrieval, fusion and cross-encoder scales differ"""
+    low, high = float(scores.min()), float(scores.max())
+    if high - low < 1e-9:
+        return np.ones_like(scores)
+    return (scores - low) / (high - low)
+
+
+def mmr(
+    relevance: np.ndarray, vectors: np.ndarray, top_k: int, lambda_: float
+) -> List[int]:
+    """
+    Indices of top_k rows chosen by maximal marginal relevance.
+
+    relevance is in [0, 1]; vectors are one row per candidate. lambda_ = 1
+    is plain relevance order, lower values trade relevance for diversity.
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit = vectors / np.where(norms == 0, 1, norms)
+    similarity = unit @ unit.T
+    # Highest similarity of every candidate to anything already picked
+    closest = np.zeros(len(relevance), dtype=np.float32)
+    available = np.ones(len(relevance), dtype=bool)
+    picked: List[int] = []
+    for _ in range(min(top_k, len(relevance))):
+        scores = lambda_ * relevance - (1 - lambda_) * closest
+        best = int(np.argmax(np.where(available, scores, -np.inf)))
+        picked.append(best)
+        available[best] = False
+        np.maximum(closest, similarity[best], out=closest)
+    return picked
+
+
+class Reranker:
+    """
+    Re-orders over-fetched retrieval candidates.
+
+    Args:
+        fetch_k: Candidates to retrieve for the stage.
+        mmr_lambda: Relevance vs diversity, see mmr().
+        decay_half_life_days: Age at which the recency bonus halves; 0 turns
+            time decay off.
+        decay_weight: Share of the recency bonus in the relevance.
+        cross_encoder: Returns the loaded model (predict(pairs) -> scores),
+            or None to skip this step.
+        budget_ms: Latency budget of the whole stage.
+    """
+
+    def __init__(
+        self,
+        fetch_k: int = 12,
+        mmr_lambda: float = 0.5,
+        decay_half_life_days: float = 180,
+        decay_weight: float = 0.2,
+        cross_encoder: Optional[Callable[[], object]] = None,
+        budget_ms: float = 50,
+    ):
+        self.fetch_k = fetch_k
+        self.mmr_lambda = mmr_lambda
+        self.decay_half_life_days = decay_half_life_days
+        self.decay_weight = decay_weight
+        self.cross_encoder = cross_encoder
+        self.budget = budget_ms / 1000
+        # Moving average of the cross-encoder's cost per candidate
+        self._pair_seconds: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def candidates(self, top_k: int) -> int:
+        """How many candidates to retrieve for top_k results"""
+        return max(top_k, self.fetch_k)
+
+    def rerank(
+        self,
+        query_text: str,
+        nodes: List[NodeWithScore],
+        vectors: Sequence[Optional[Sequence[float]]],
+        top_k: int,
+    ) -> List[NodeWithScore]:
+        """top_k of nodes; vectors are their stored dense vectors"""
+        if len(nodes) <= 1:
+            return nodes[:top_k]
+        deadline = time.perf_counter() + self.budget
+        with metrics.span("rerank", candidates=len(nodes)):
+            relevance = normalize(
+                np.array([node.score or 0.0 for node in nodes], dtype=np.float32)
+            )
+            if self.cross_encoder is not None:
+                nodes, relevance, vectors = self._cross_encode(
+                    query_text, nodes, relevance, vectors, top_k, deadline
+                )
+            if self.decay_half_life_days > 0:
+                with metrics.span("rerank_decay"):
+                    relevance = self._decay(nodes, relevance)
+            with metrics.span("rerank_mmr"):
+                if any(vector is None for vector in vectors):
+                    # Points written without vectors: relevance order only
+                    order = np.argsort(-relevance, kind="stable")[:top_k].tolist()
+                else:
+                    order = mmr(
+                        relevance,
+                        np.asarray(vectors, dtype=np.float32),
+                        top_k,
+                        self.mmr_lambda,
+                    )
+        return [
+            NodeWithScore(node=nodes[i].node, score=float(relevance[i])) for i in order
+        ]
+
+    def _decay(self, nodes: List[NodeWithScore], relevance: np.ndarray) -> np.ndarray:
+        now = time.time()
+        timestamps = np.array(
+            [node.node.metadata.get("timestamp", now) for node in nodes],
+            dtype=np.float64,
+        )
+        age_days = np.maximum(now - timestamps, 0) / SECONDS_PER_DAY
+        recency = np.power(0.5, age_days / self.decay_half_life_days)
+        return (
+            (1 - self.decay_weight) * relevance + self.decay_weight * recency
+        ).astype(np.float32)
+
+    def _cross_encode(self, query_text, nodes, relevance, vectors, top_k, deadline):
+        """Cross-encoder scores for as many of the best candidates as fit"""
+        left = deadline - time.perf_counter()
+        count = len(nodes)
+        if self._pair_seconds is not None:
+            count = min(count, int(max(left, 0) / self._pair_seconds))
+        if count < min(top_k, len(nodes)):
+            RERANK_RESULTS.inc(outcome="skipped")
+            with self._lock:
+                # One slow call (a cold model) must not turn the step off for good
+                self._pair_seconds *= 0.9
+            return nodes, relevance, vectors
+        model = self.cross_encoder()
+        # Candidates the model has no time for are dropped: their retrieval
+        # scores are not comparable with the cross-encoder's
+        keep = np.argsort(-relevance, kind="stable")[:count]
+        pairs = [
+            (query_text, nodes[i].node.get_content(metadata_mode=MetadataMode.NONE))
+            for i in keep
+        ]
+        started = time.perf_counter()
+        with metrics.span("rerank_cross_encoder", pairs=len(pairs)):
+            scores = np.asarray(model.predict(pairs), dtype=np.float32)
+        seconds = (time.perf_counter() - started) / len(pairs)
+        with self._lock:
+            if self._pair_seconds is None:
+                self._pair_seconds = seconds
+            else:
+                self._pair_seconds = 0.8 * self._pair_seconds + 0.2 * seconds
+        if time.perf_counter() > deadline:
+            logging.debug("Кросс-энкодер вышел за бюджет реранкинга")
+            RERANK_RESULTS.inc(outcome="over_budget")
+        else:
+            RERANK_RESULTS.inc(outcome="full" if count == len(nodes) else "partial")
+        return (
+            [nodes[i] for i in keep],
+            normalize(scores),
+            [vectors[i] for i in keep],
+        )
+
+
+def create_reranker() -> Optional[Reranker]:
+    """Reranker configured from config.py; None when the stage is off"""
+    if config.RERANK_FETCH_K <= 0:
+        return None
+    return Reranker(
+        fetch_k=config.RERANK_FETCH_K,
+        mmr_lambda=config.RERANK_MMR_LAMBDA,
+        decay_half_life_days=config.RERANK_DECAY_HALF_LIFE_DAYS,
+        decay_weight=config.RERANK_DECAY_WEIGHT,
+        cross_encoder=(
+            backends.get_cross_encoder if config.RERANK_CROSS_ENCODER_MODEL else None
+        ),
+        budget_ms=config.RERANK_BUDGET_MS,
+    )
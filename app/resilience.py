@@ -0,0 +1,501 @@
+"""
+Failure handling shared by the Qdrant, LLM and Telegram clients.
+
+Retry repeats a call on transient errors (timeouts, dropped connections,
+429 and 5xx) with jittered exponential backoff, and never sleeps past the
+call's deadline. CircuitBreaker stops calls to a service after several
+failures in a row, so while it is down requests fail at once instead of
+each waiting out its timeouts; after reset_timeout one probe call is let
+through. ResilientLLM puts both around an LLM, gives every attempt its own
+timeout and hedges slow attempts with a second identical request.
+"""
+
+import asyncio
+import functools
+import inspect
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Optional
+
+import config as config
+import metrics as metrics
+
+RETRIES = metrics.REGISTRY.counter(
+    "ragbot_retries_total", "Calls retried after a transient error", ["client"]
+)
+LLM_CALLS = metrics.REGISTRY.counter(
+    "ragbot_llm_calls_total", "LLM calls by outcome", ["outcome"]
+)
+CIRCUIT_STATE = metrics.REGISTRY.gauge(
+    "ragbot_circuit_state", "0 closed, 1 half-open, 2 open", ["name"]
+)
+
+# HTTP statuses worth another try: timeouts, rate limits, overloaded upstreams
+TRANSIENT_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+# Network errors of requests, httpx, aiohttp, openai and qdrant-client, by
+# class name, so none of them has to be imported here
+TRANSIENT_ERRORS = {
+    "APIConnectionError",
+    "APITimeoutError",
+    "ClientConnectionError",
+    "ConnectionError",
+    "ConnectTimeout",
+    "NetworkError",
+    "ReadTimeout",
+    "RemoteProtocolError",
+    "ResponseHandlingException",
+    "ServerDisconnectedError",
+    "Timeout",
+    "TimeoutException",
+    "TransportError",
+}
+# gRPC status codes of the same kinds
+TRANSIENT_GRPC_CODES = {"UNAVAILABLE", "DEADLINE_EXCEEDED", "RESOURCE_EXHAUSTED"}
+
+
+class CircuitOpenError(RuntimeError):
+    """The service failed too often recently; the call was not made"""
+
+
+class DeadlineExceeded(TimeoutError):
+    """An attempt did not finish in its timeout"""
+
+
+def _status(error: Exception) -> Optional[int]:
+    for attribute in ("status_code", "error_code", "status"):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def is_transient(error: Exception) -> bool:
+    """True for errors a repeated call may not hit"""
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    status = _status(error)
+    if status is not None:
+        return status in TRANSIENT_STATUSES
+    code = getattr(error, "code", None)
+    if callable(code):
+        try:
+            return getattr(code(), "name", "") in TRANSIENT_GRPC_CODES
+        except Exception:
+            return False
+    return any(cls.__name__ in TRANSIENT_ERRORS for cls in type(error).__mro__)
+
+
+def is_telegram_retryable(error: Exception, idempotent: bool) -> bool:
+    """
+    Telegram errors worth another try. 429 is left to the rate limiter and the
+    stream editor, and a request that timed out while waiting for the answer
+    may have been delivered: only idempotent ones are sent again.
+    """
+    status = _status(error)
+    if status is not None:
+        return status >= 500 and status in TRANSIENT_STATUSES
+    names = {cls.__name__ for cls in type(error).__mro__}
+    if names & {"ReadTimeout", "RequestTimeout", "ServerTimeoutError"} or isinstance(
+        error, TimeoutError
+    ):
+        return idempotent
+    return is_transient(error)
+
+
+class Retry:
+    """
+    Repeats calls that fail with transient errors.
+
+    Args:
+        name: Client label of ragbot_retries_total.
+        attempts: Calls made at most, the first one included.
+        base_delay: Backoff before the second attempt, doubled for each next.
+        max_delay: Longest backoff.
+        retry_on: Which errors are retried; is_transient by default.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        attempts: int = 3,
+        base_delay: float = 0.2,
+        max_delay: float = 2.0,
+        retry_on: Callable[[Exception], bool] = is_transient,
+    ):
+        self.name = name
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+
+    def _backoff(self, attempt: int, error: Exception, deadline: Optional[float]):
+        """Seconds to wait before the next attempt, or None to give up"""
+        if attempt + 1 >= self.attempts or not self.retry_on(error):
+            return None
+        # Full jitter: clients that failed together do not retry together
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+        RETRIES.inc(client=self.name)
+        logging.warning(
+            f"{self.name}: {type(error).__name__} {error}, "
+            f"повтор через {delay:.2f}с (попытка {attempt + 2}/{self.attempts})"
+        )
+        return delay
+
+    def call(self, fn: Callable[[], Any], deadline: Optional[float] = None):
+        """fn() with retries; deadline is a time.monotonic() value"""
+        for attempt in range(self.attempts):
+            try:
+                return fn()
+            except Exception as error:
+                delay = self._backoff(attempt, error, deadline)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+
+    async def acall(
+        self, fn: Callable[[], Awaitable[Any]], deadline: Optional[float] = None
+    ):
+        """Like call(), for a coroutine function"""
+        for attempt in range(self.attempts):
+            try:
+                return await fn()
+            except Exception as error:
+                delay = self._backoff(attempt, error, deadline)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+
+    def wrap(self, fn: Callable) -> Callable:
+        """fn with retries; coroutine functions stay coroutine functions"""
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                return await self.acall(lambda: fn(*args, **kwargs))
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return self.call(lambda: fn(*args, **kwargs))
+
+        return wrapper
+
+
+class CircuitBreaker:
+    """
+    Closed, open after failure_threshold failures in a row, half-open after
+    reset_timeout: one probe call decides whether it closes or opens again.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        CIRCUIT_STATE.set_function(lambda: self.state, name=name)
+
+    @property
+    def state(self) -> int:
+        with self._lock:
+            if self._failures < self.failure_threshold:
+                return self.CLOSED
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self.OPEN
+
+    def before(self) -> None:
+        """Raise CircuitOpenError unless a call may be made now"""
+        with self._lock:
+            if self._failures < self.failure_threshold:
+                return
+            if (
+                time.monotonic() - self._opened_at >= self.reset_timeout
+                and not self._probing
+            ):
+                self._probing = True
+                return
+        raise CircuitOpenError(f"{self.name} недоступен, пропускаю вызов")
+
+    def success(self) -> None:
+        with self._lock:
+            if self._failures >= self.failure_threshold:
+                logging.info(f"{self.name} снова отвечает")
+            self._failures = 0
+            self._probing = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._failures >= self.failure_threshold:
+                if self._failures == self.failure_threshold:
+                    logging.error(
+                        f"{self.name}: {self._failures} ошибок подряд, "
+                        f"пауза {self.reset_timeout:g}с"
+                    )
+                self._opened_at = time.monotonic()
+
+    def record(self, error: Optional[Exception]) -> None:
+        """Count an outcome; errors of the request itself do not open it"""
+        if error is None:
+            self.success()
+        elif is_transient(error):
+            self.failure()
+        else:
+            # A bad request says nothing about the service
+            self.success()
+
+
+class ResilientLLM:
+    """
+    LLM wrapper with deadlines, retries, a circuit breaker and hedging.
+
+    Exposes complete/stream_complete and their async variants like the
+    wrapped llama_index LLM; anything else is delegated to it.
+
+    Args:
+        llm: The wrapped LLM.
+        retry: Retry policy between attempts.
+        breaker: Breaker shared by all calls.
+        deadline: Seconds for a whole call, retries included.
+        attempt_timeout: Seconds for one attempt of complete().
+        first_token_timeout: Seconds until a stream's first chunk.
+        hedge_after: Seconds after which a still running complete() attempt
+            gets a twin request; 0 turns hedging off.
+        max_workers: Threads for the blocking calls of the sync API.
+    """
+
+    def __init__(
+        self,
+        llm,
+        retry: Retry,
+        breaker: CircuitBreaker,
+        deadline: float = 45,
+        attempt_timeout: float = 20,
+        first_token_timeout: float = 15,
+        hedge_after: float = 0,
+        max_workers: int = 16,
+    ):
+        self.llm = llm
+        self.retry = retry
+        self.breaker = breaker
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.first_token_timeout = first_token_timeout
+        self.hedge_after = hedge_after
+        # Timed-out attempts are abandoned, not killed: they finish here
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="llm-call"
+        )
+
+    def __getattr__(self, name: str):
+        return getattr(self.llm, name)
+
+    def _attempt(self, fn: Callable[[], Any], deadline: float, timeout: float, hedge):
+        self.breaker.before()
+        timeout = min(timeout, deadline - time.monotonic())
+        error = None
+        try:
+            return self._race(fn, timeout, hedge)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.breaker.record(error)
+
+    def _race(self, fn: Callable[[], Any], timeout: float, hedge: bool):
+        """fn() in the pool; with hedge, a twin after hedge_after and first wins"""
+        end = time.monotonic() + timeout
+        first = self._executor.submit(fn)
+        pending = {first}
+        if hedge and 0 < self.hedge_after < timeout:
+            done, _ = wait(pending, timeout=self.hedge_after)
+            if not done:
+                LLM_CALLS.inc(outcome="hedged")
+                pending.add(self._executor.submit(fn))
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(
+                pending,
+                timeout=max(end - time.monotonic(), 0),
+                return_when=FIRST_COMPLETED,
+            )
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is not first:
+                        LLM_CALLS.inc(outcome="hedge_won")
+                    return future.result()
+                error = future.exception()
+        if pending or error is None:
+            raise DeadlineExceeded(f"LLM не ответила за {timeout:.1f}с")
+        raise error
+
+    def _call(self, fn: Callable[[], Any], timeout: float, hedge: bool):
+        deadline = time.monotonic() + self.deadline
+        try:
+            result = self.retry.call(
+                lambda: self._attempt(fn, deadline, timeout, hedge), deadline
+            )
+        except CircuitOpenError:
+            LLM_CALLS.inc(outcome="rejected")
+            raise
+        except Exception:
+            LLM_CALLS.inc(outcome="failed")
+            raise
+        LLM_CALLS.inc(outcome="ok")
+        return result
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        return self._call(
+            lambda: self.llm.complete(prompt, formatted=formatted, **kwargs),
+            self.attempt_timeout,
+            hedge=True,
+        )
+
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        """Retried until the first chunk arrives; the rest streams as is"""
+
+        def open_stream():
+            stream = iter(
+                self.llm.stream_complete(prompt, formatted=formatted, **kwargs)
+            )
+            return next(stream, None), stream
+
+        first, stream = self._call(open_stream, self.first_token_timeout, hedge=False)
+
+        def gen():
+            if first is not None:
+                yield first
+            yield from stream
+
+        return gen()
+
+    async def _arace(self, fn: Callable[[], Awaitable[Any]], timeout: float, hedge):
+        first = asyncio.ensure_future(fn())
+        pending = {first}
+        try:
+            if hedge and 0 < self.hedge_after < timeout:
+                done, _ = await asyncio.wait(pending, timeout=self.hedge_after)
+                if not done:
+                    LLM_CALLS.inc(outcome="hedged")
+                    pending.add(asyncio.ensure_future(fn()))
+            end = time.monotonic() + timeout
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=max(end - time.monotonic(), 0),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            LLM_CALLS.inc(outcome="hedge_won")
+                        return task.result()
+                    error = task.exception()
+            if pending or error is None:
+                raise DeadlineExceeded(f"LLM не ответила за {timeout:.1f}с")
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _acall(self, fn: Callable[[], Awaitable[Any]], timeout: float, hedge):
+        deadline = time.monotonic() + self.deadline
+
+        async def attempt():
+            self.breaker.before()
+            error = None
+            try:
+                return await self._arace(
+                    fn, min(timeout, deadline - time.monotonic()), hedge
+                )
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                self.breaker.record(error)
+
+        try:
+            result = await self.retry.acall(attempt, deadline)
+        except CircuitOpenError:
+            LLM_CALLS.inc(outcome="rejected")
+            raise
+        except Exception:
+            LLM_CALLS.inc(outcome="failed")
+            raise
+        LLM_CALLS.inc(outcome="ok")
+        return result
+
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        return await self._acall(
+            lambda: self.llm.acomplete(prompt, formatted=formatted, **kwargs),
+            self.attempt_timeout,
+            hedge=True,
+        )
+
+    async def astream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ):
+        """Retried until the first chunk arrives; the rest streams as is"""
+
+        async def open_stream():
+            stream = await self.llm.astream_complete(
+                prompt, formatted=formatted, **kwargs
+            )
+            return await anext(stream, None), stream
+
+        first, stream = await self._acall(
+            open_stream, self.first_token_timeout, hedge=False
+        )
+
+        async def gen():
+            if first is not None:
+                yield first
+            async for chunk in stream:
+                yield chunk
+
+        return gen()
+
+
+def create_retry(name: str, attempts: int, **kwargs) -> Retry:
+    """Retry policy with the backoff from config.py"""
+    return Retry(
+        name,
+        attempts,
+        base_delay=config.RETRY_BASE_DELAY,
+        max_delay=config.RETRY_MAX_DELAY,
+        **kwargs,
+    )
+
+
+def create_resilient_llm(llm, name: str = "llm") -> ResilientLLM:
+    """Wrap an LLM with the policies configured in config.py"""
+    return ResilientLLM(
+        llm,
+        create_retry(name, config.LLM_MAX_ATTEMPTS),
+        CircuitBreaker(name, config.LLM_BREAKER_FAILURES, config.LLM_BREAKER_RESET),
+        deadline=config.LLM_DEADLINE,
+        attempt_timeout=config.LLM_ATTEMPT_TIMEOUT,
+        first_token_timeout=config.LLM_FIRST_TOKEN_TIMEOUT,
+        hedge_after=config.LLM_HEDGE_AFTER,
+        # Hedged calls may double the answers in flight
+        max_workers=2 * config.LLM_CONCURRENCY + 4,
+    )
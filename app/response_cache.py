@@ -0,0 +1,118 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class SemanticResponseCache:
+    """
+    Answer cache keyed on query embeddings.
+
+    Entries are scoped by (chat_id, kind, mood bucket, user), so an answer is
+    only reused in the same chat, for the same command, in the same mood and
+    for the same asker (answers address the asker by name).
+    A lookup hits when the cosine similarity to a cached query reaches the
+    threshold and the entry is younger than the TTL.
+    """
+
+    def __init__(
+        self, threshold: float = 0.95, ttl: float = 3600, max_entries: int = 500
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # scope -> entry_id -> (created_at, unit vector, answer); insertion order = age
+        self._scopes: Dict[Tuple, "OrderedDict[int, Tuple[float, np.ndarray, str]]"] = (
+            {}
+        )
+        # Global insertion order for max_entries eviction
+        self._order: "OrderedDict[int, Tuple]" = OrderedDict()
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _unit(embedding: Sequence[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(
+        self,
+        chat_id: int,
+        kind: str,
+        mood: str,
+        user: str,
+        embedding: Sequence[float],
+    ) -> Optional[str]:
+        """Return a cached answer for a near-duplicate query, if any"""
+        scope = (chat_id, kind, mood, user)
+        query = self._unit(embedding)
+        with self._lock:
+            self._expire(time.monotonic())
+            entries = self._scopes.get(scope)
+            if not entries:
+                self.misses += 1
+                return None
+            ids: List[int] = list(entries)
+            matrix = np.stack([entries[i][1] for i in ids])
+            scores = matrix @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entries[ids[best]][2]
+
+    def put(
+        self,
+        chat_id: int,
+        kind: str,
+        mood: str,
+        user: str,
+        embedding: Sequence[float],
+        answer: str,
+    ) -> None:
+        """Store an answer for the query embedding"""
+        scope = (chat_id, kind, mood, user)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._scopes.setdefault(scope, OrderedDict())[entry_id] = (
+                time.monotonic(),
+                self._unit(embedding),
+                answer,
+            )
+            self._order[entry_id] = scope
+            while len(self._order) > self.max_entries:
+                old_id, old_scope = self._order.popitem(last=False)
+                self._remove(old_scope, old_id)
+
+    def _expire(self, now: float) -> None:
+        """Drop entries older than the TTL (oldest first)"""
+        while self._order:
+            entry_id, scope = next(iter(self._order.items()))
+            created_at = self._scopes[scope][entry_id][0]
+            if now - created_at < self.ttl:
+                return
+            self._order.popitem(last=False)
+            self._remove(scope, entry_id)
+
+    def _remove(self, scope: Tuple, entry_id: int) -> None:
+        entries = self._scopes.get(scope)
+        if entries is None:
+            return
+        entries.pop(entry_id, None)
+        if not entries:
+            del self._scopes[scope]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._order),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,396 @@
+"""
+Scheduling between the Telegram handlers and MessageProcessor.
+
+Handlers submit jobs instead of running them. Each chat has its own queue and
+runs one job at a time; at most max_llm LLM jobs run at once across chats, and
+cheap jobs (canned replies, @all, "запомни") are picked before LLM work. A new
+LLM job from a user who already has one waiting replaces the waiting one, so
+rapid repeated mentions get a single answer to the latest message.
+
+Outgoing Telegram calls go through token buckets for the whole bot and for
+every chat, which keeps the bot under the Bot API flood limits.
+"""
+
+import asyncio
+import functools
+import heapq
+import inspect
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import config as config
+import metrics as metrics
+
+# Job priorities, lower runs first
+CHEAP = 0
+LLM = 1
+PRIORITY_NAMES = {CHEAP: "cheap", LLM: "llm"}
+
+SCHEDULER_JOBS = metrics.REGISTRY.counter(
+    "ragbot_scheduler_jobs_total", "Scheduled jobs by outcome", ["priority", "outcome"]
+)
+TELEGRAM_THROTTLE = metrics.REGISTRY.histogram(
+    "ragbot_telegram_throttle_seconds",
+    "Delay added to outgoing Telegram calls by the rate limiter",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+
+class TokenBucket:
+    """Classic token bucket; reserve() takes a token, possibly on credit"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: float) -> float:
+        """Take a token; returns how long to wait before using it"""
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def has_token(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class TelegramRateLimiter:
+    """
+    Token buckets for outgoing Telegram calls.
+
+    Args:
+        rate: Calls per second for the whole bot.
+        chat_rate: Messages per second to one private chat.
+        group_rate: Messages per second to one group (chat id < 0).
+        chat_burst: Messages a chat may receive back to back.
+    """
+
+    # Chat buckets are pruned once there are this many
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(
+        self,
+        rate: float = 30,
+        chat_rate: float = 1,
+        group_rate: float = 20 / 60,
+        chat_burst: float = 3,
+    ):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(rate, rate)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, chat_id: Optional[int]) -> float:
+        """Seconds the caller has to wait before its call to chat_id"""
+        now = time.monotonic()
+        with self._lock:
+            delay = self._global.reserve(now)
+            if chat_id is None:
+                return delay
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                    self._prune(now)
+                rate = self.group_rate if chat_id < 0 else self.chat_rate
+                bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+            return max(delay, bucket.reserve(now))
+
+    def is_ready(self, chat_id: int) -> bool:
+        """True if a message to chat_id could go out without waiting"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._chats.get(chat_id)
+            return self._global.has_token(now) and (
+                bucket is None or bucket.has_token(now)
+            )
+
+    def _prune(self, now: float) -> None:
+        """Drop buckets of idle chats: a full bucket is the same as a new one"""
+        for chat_id in [c for c, b in self._chats.items() if b.is_full(now)]:
+            del self._chats[chat_id]
+
+    def wrap(self, fn: Callable, per_chat: bool = True) -> Callable:
+        """Wrap a bot method so every call waits for its turn"""
+
+        def delay_for(args, kwargs) -> float:
+            delay = self.reserve(_target_chat(args, kwargs) if per_chat else None)
+            if delay:
+                TELEGRAM_THROTTLE.observe(delay)
+            return delay
+
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                delay = delay_for(args, kwargs)
+                if delay:
+                    await asyncio.sleep(delay)
+                return await fn(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            delay = delay_for(args, kwargs)
+            if delay:
+                time.sleep(delay)
+            return fn(*args, **kwargs)
+
+        return wrapper
+
+
+def _target_chat(args: tuple, kwargs: dict) -> Optional[int]:
+    """Chat of a reply_to(message, ...), send_message(chat_id, ...) or edit call"""
+    if "chat_id" in kwargs:
+        return kwargs["chat_id"]
+    first = args[0] if args else None
+    chat = getattr(first, "chat", None)
+    if chat is not None:
+        return chat.id
+    return first if isinstance(first, int) else None
+
+
+class _Job:
+    __slots__ = ("priority", "seq", "chat_id", "key", "fn", "args", "enqueued_at")
+
+    def __init__(self, priority, seq, chat_id, key, fn, args):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.enqueued_at = time.monotonic()
+
+
+class _ChatQueues:
+    """Queue bookkeeping shared by the thread and asyncio schedulers"""
+
+    def __init__(self, max_llm: int):
+        self.max_llm = max_llm
+        self._seq = itertools.count()
+        # chat_id -> heap of (priority, seq, job)
+        self._chats: Dict[int, List[Tuple[int, int, _Job]]] = {}
+        # Waiting jobs that a newer one from the same user may replace
+        self._by_key: Dict[Tuple[int, str], _Job] = {}
+        self._running: Set[int] = set()
+        self.llm_running = 0
+        self.queued = 0
+
+    def push(self, chat_id: int, priority: int, key: Optional[str], fn, args) -> bool:
+        """Queue a job; returns False if it replaced a waiting one instead"""
+        if key is not None:
+            waiting = self._by_key.get((chat_id, key))
+            if waiting is not None:
+                waiting.fn, waiting.args = fn, args
+                SCHEDULER_JOBS.inc(
+                    priority=PRIORITY_NAMES[priority], outcome="coalesced"
+                )
+                return False
+        job = _Job(priority, next(self._seq), chat_id, key, fn, args)
+        heapq.heappush(self._chats.setdefault(chat_id, []), (priority, job.seq, job))
+        if key is not None:
+            self._by_key[(chat_id, key)] = job
+        self.queued += 1
+        return True
+
+    def pop(self) -> Optional[_Job]:
+        """Best job of an idle chat that may start now, if any"""
+        best = None
+        for chat_id, heap in self._chats.items():
+            if chat_id in self._running:
+                continue
+            job = heap[0][2]
+            if job.priority == LLM and self.llm_running >= self.max_llm:
+                continue
+            if best is None or (job.priority, job.seq) < (best.priority, best.seq):
+                best = job
+        if best is None:
+            return None
+        heap = self._chats[best.chat_id]
+        heapq.heappop(heap)
+        if not heap:
+            del self._chats[best.chat_id]
+        if best.key is not None:
+            del self._by_key[(best.chat_id, best.key)]
+        self._running.add(best.chat_id)
+        if best.priority == LLM:
+            self.llm_running += 1
+        self.queued -= 1
+        metrics.observe("queue_wait", time.monotonic() - best.enqueued_at)
+        return best
+
+    def done(self, job: _Job) -> None:
+        self._running.discard(job.chat_id)
+        if job.priority == LLM:
+            self.llm_running -= 1
+
+    def is_idle(self) -> bool:
+        return not self.queued and not self._running
+
+
+def _count(job: _Job, outcome: str) -> None:
+    SCHEDULER_JOBS.inc(priority=PRIORITY_NAMES[job.priority], outcome=outcome)
+
+
+class ChatScheduler:
+    """
+    Thread pool scheduler for the polling bot.
+
+    Args:
+        max_llm: LLM jobs running at once across all chats.
+        cheap_workers: Extra threads, so cheap jobs never wait for LLM ones.
+    """
+
+    def __init__(self, max_llm: int = 4, cheap_workers: int = 2):
+        self._queues = _ChatQueues(max_llm)
+        self._cond = threading.Condition()
+        self._closing = False
+        self._threads = [
+            threading.Thread(target=self._work, name=f"scheduler-{i}", daemon=True)
+            for i in range(max_llm + cheap_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(
+        self,
+        chat_id: int,
+        fn: Callable,
+        *args,
+        priority: int = LLM,
+        coalesce_key: Optional[str] = None,
+    ) -> None:
+        """Queue fn(*args) for the chat"""
+        with self._cond:
+            if self._queues.push(chat_id, priority, coalesce_key, fn, args):
+                self._cond.notify()
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                job = self._queues.pop()
+                while job is None:
+                    if self._closing and self._queues.is_idle():
+                        self._cond.notify_all()
+                        return
+                    self._cond.wait()
+                    job = self._queues.pop()
+            try:
+                job.fn(*job.args)
+                _count(job, "done")
+            except Exception:
+                _count(job, "error")
+                logging.exception(f"Задача чата {job.chat_id} упала")
+            with self._cond:
+                self._queues.done(job)
+                # A finished job can unblock its chat and an LLM slot
+                self._cond.notify_all()
+
+    def queued(self) -> int:
+        with self._cond:
+            return self._queues.queued
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Run everything already queued, then stop the workers"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+
+class AsyncChatScheduler:
+    """Asyncio scheduler for the async bot: jobs are coroutine functions"""
+
+    def __init__(self, max_llm: int = 4):
+        self._queues = _ChatQueues(max_llm)
+        self._tasks: Set[asyncio.Task] = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def submit(
+        self,
+        chat_id: int,
+        fn: Callable,
+        *args,
+        priority: int = LLM,
+        coalesce_key: Optional[str] = None,
+    ) -> None:
+        """Queue fn(*args) for the chat; call from the event loop"""
+        if self._queues.push(chat_id, priority, coalesce_key, fn, args):
+            self._idle.clear()
+            self._dispatch()
+
+    def _dispatch(self) -> None:
+        job = self._queues.pop()
+        while job is not None:
+            task = asyncio.ensure_future(self._run(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            job = self._queues.pop()
+
+    async def _run(self, job: _Job) -> None:
+        try:
+            await job.fn(*job.args)
+            _count(job, "done")
+        except Exception:
+            _count(job, "error")
+            logging.exception(f"Задача чата {job.chat_id} упала")
+        self._queues.done(job)
+        self._dispatch()
+        if self._queues.is_idle():
+            self._idle.set()
+
+    def queued(self) -> int:
+        return self._queues.queued
+
+    async def close(self) -> None:
+        """Wait until everything already queued has run"""
+        await self._idle.wait()
+
+
+def create_rate_limiter() -> TelegramRateLimiter:
+    """Rate limiter configured from config.py"""
+    return TelegramRateLimiter(
+        rate=config.TELEGRAM_RATE,
+        chat_rate=config.TELEGRAM_CHAT_RATE,
+        group_rate=config.TELEGRAM_GROUP_RATE,
+        chat_burst=config.TELEGRAM_CHAT_BURST,
+    )
+
+
+def _register_queue_gauge(scheduler) -> None:
+    gauge = metrics.REGISTRY.gauge("ragbot_scheduler_queued", "Jobs waiting to run")
+    gauge.set_function(scheduler.queued)
+
+
+def create_scheduler() -> ChatScheduler:
+    """Thread scheduler configured from config.py"""
+    scheduler = ChatScheduler(
+        max_llm=config.LLM_CONCURRENCY, cheap_workers=config.SCHEDULER_CHEAP_WORKERS
+    )
+    _register_queue_gauge(scheduler)
+    return scheduler
+
+
+def create_async_scheduler() -> AsyncChatScheduler:
+    """Asyncio scheduler configured from config.py"""
+    scheduler = AsyncChatScheduler(max_llm=config.LLM_CONCURRENCY)
+    _register_queue_gauge(scheduler)
+    return scheduler
@@ -0,0 +1,276 @@
+"""
+Web search layer: providers, a TTL result cache and hard timeouts.
+
+A provider is anything with ``search(query, region) -> list`` of dicts with
+title/href/body. WebSearch asks the providers in order, each under its own
+timeout, and caches the first non-empty answer under the normalized query.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+import metrics as metrics
+
+SEARCH_RESULTS = metrics.REGISTRY.counter(
+    "ragbot_search_total", "Web searches by outcome", ["provider", "outcome"]
+)
+
+
+def normalize_query(query: str) -> str:
+    """Case, punctuation and spacing do not change what a search returns"""
+    query = query.lower().replace("ё", "е").replace("загугли", " ")
+    return " ".join(re.findall(r"[@#]?\w+", query))
+
+
+class DuckDuckGoProvider:
+    """
+    DuckDuckGo through duckduckgo_search, the client the llama_index tool
+    spec wraps; called directly because the spec cannot pass a timeout.
+    """
+
+    name = "duckduckgo"
+
+    def __init__(self, max_results: int = 5, timeout: float = 5):
+        from duckduckgo_search import DDGS
+
+        self._ddgs = DDGS
+        self.max_results = max_results
+        self.timeout = timeout
+
+    def search(self, query: str, region: str) -> list:
+        with self._ddgs(timeout=self.timeout) as ddgs:
+            return list(
+                ddgs.text(keywords=query, region=region, max_results=self.max_results)
+            )
+
+
+class GoogleProvider:
+    """Google Programmable Search (Custom Search JSON API)"""
+
+    name = "google"
+    URL = "https://www.googleapis.com/customsearch/v1"
+
+    def __init__(
+        self, api_key: str, engine_id: str, max_results: int = 5, timeout: float = 5
+    ):
+        self.api_key = api_key
+        self.engine_id = engine_id
+        self.max_results = max_results
+        self.timeout = timeout
+
+    def search(self, query: str, region: str) -> list:
+        params = {
+            "key": self.api_key,
+            "cx": self.engine_id,
+            "q": query,
+            "num": self.max_results,
+            # "ru-ru" -> interface language "ru"
+            "hl": region.split("-")[0],
+        }
+        with urlopen(f"{self.URL}?{urlencode(params)}", timeout=self.timeout) as r:
+            items = json.load(r).get("items", [])
+        return [
+            {"title": i.get("title"), "href": i.get("link"), "body": i.get("snippet")}
+            for i in items
+        ]
+
+
+class FixtureProvider:
+    """
+    Recorded responses for offline runs: a JSON object mapping normalized
+    queries to result lists. Unknown queries get the "*" entry, if any.
+    """
+
+    name = "fixture"
+
+    def __init__(self, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            self.responses: Dict[str, list] = {
+                normalize_query(q) if q != "*" else q: results
+                for q, results in json.load(f).items()
+            }
+
+    def search(self, query: str, region: str) -> list:
+        return list(
+            self.responses.get(normalize_query(query), self.responses.get("*", []))
+        )
+
+
+class SearchCache:
+    """
+    TTL cache of search results keyed on the normalized query and region.
+
+    The memory tier is an LRU of max_entries; with disk_path set, results are
+    also written as one JSON file per key and survive restarts.
+    """
+
+    def __init__(
+        self, ttl: float = 3600, max_entries: int = 256, disk_path: Optional[str] = None
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.disk_path = disk_path
+        if disk_path:
+            os.makedirs(disk_path, exist_ok=True)
+        self._memory: "OrderedDict[str, Tuple[float, list]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(query: str, region: str) -> str:
+        return hashlib.sha1(
+            f"{region}\0{normalize_query(query)}".encode("utf-8")
+        ).hexdigest()
+
+    def _disk_file(self, key: str) -> str:
+        return os.path.join(self.disk_path, f"{key}.json")
+
+    def get(self, query: str, region: str) -> Optional[list]:
+        key = self.key(query, region)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if self.disk_path:
+                try:
+                    with open(self._disk_file(key), "r", encoding="utf-8") as f:
+                        stored_at, results = json.load(f)
+                except (OSError, ValueError):
+                    stored_at, results = 0, None
+                if results is not None and now - stored_at < self.ttl:
+                    self._remember(key, stored_at, results)
+                    self.hits += 1
+                    return results
+            self.misses += 1
+            return None
+
+    def put(self, query: str, region: str, results: list) -> None:
+        key = self.key(query, region)
+        stored_at = time.time()
+        with self._lock:
+            self._remember(key, stored_at, results)
+        if self.disk_path:
+            # Write-then-rename, so a reader never sees half a file
+            tmp = f"{self._disk_file(key)}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump([stored_at, results], f, ensure_ascii=False)
+            os.replace(tmp, self._disk_file(key))
+
+    def _remember(self, key: str, stored_at: float, results: list) -> None:
+        self._memory[key] = (stored_at, results)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._memory),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class WebSearch:
+    """
+    Cached search over a primary provider and optional fallbacks.
+
+    Every provider call runs in a worker thread of that provider's own pool
+    and is abandoned after ``timeout`` seconds, so hanging calls to one
+    provider never hold up another. The timeout counts from the moment the
+    call starts; a call still queued after ``timeout`` seconds (the pool is
+    full of hanging calls) is dropped. A handler thus waits at most twice the
+    timeout per provider. submit() starts a search in the background so the
+    caller can prepare the rest of the request meanwhile.
+    """
+
+    def __init__(
+        self,
+        providers: Sequence,
+        cache: Optional[SearchCache] = None,
+        timeout: float = 5.0,
+        max_workers: int = 8,
+    ):
+        self.providers = list(providers)
+        self.cache = cache
+        self.timeout = timeout
+        # Provider calls and background searches wait on each other, so they
+        # must not share a pool; neither must two providers
+        self._pools = [
+            ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix=f"web-search-{p.name}"
+            )
+            for p in self.providers
+        ]
+        self._requests = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="web-search-request"
+        )
+
+    def _call(
+        self, provider, pool: ThreadPoolExecutor, query: str, region: str
+    ) -> Optional[list]:
+        """One provider under the timeout; None on timeout or error"""
+        started = threading.Event()
+
+        def call():
+            started.set()
+            return provider.search(query, region)
+
+        future = pool.submit(call)
+        # Time spent queued behind other calls does not count against the
+        # timeout, but a call that cannot even start in time is dropped
+        if not started.wait(self.timeout) and future.cancel():
+            SEARCH_RESULTS.inc(provider=provider.name, outcome="busy")
+            logging.warning(f"Поиск {provider.name} занят дольше {self.timeout}с")
+            return None
+        try:
+            results = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            SEARCH_RESULTS.inc(provider=provider.name, outcome="timeout")
+            logging.warning(f"Поиск {provider.name} не ответил за {self.timeout}с")
+            return None
+        except Exception:
+            SEARCH_RESULTS.inc(provider=provider.name, outcome="error")
+            logging.exception(f"Поиск {provider.name} упал")
+            return None
+        SEARCH_RESULTS.inc(provider=provider.name, outcome="ok" if results else "empty")
+        return list(results or [])
+
+    def search(self, query: str, region: str = "ru-ru") -> List[dict]:
+        """Results from the cache or the first provider that answers"""
+        if self.cache is not None:
+            cached = self.cache.get(query, region)
+            if cached is not None:
+                SEARCH_RESULTS.inc(provider="cache", outcome="ok")
+                return cached
+        results: List[dict] = []
+        for provider, pool in zip(self.providers, self._pools):
+            results = self._call(provider, pool, query, region) or []
+            if results:
+                break
+        if results and self.cache is not None:
+            self.cache.put(query, region, results)
+        return results
+
+    def submit(self, query: str, region: str = "ru-ru") -> Future:
+        """Start search() in the background"""
+        return self._requests.submit(self.search, query, region)
+
+    async def asearch(self, query: str, region: str = "ru-ru") -> List[dict]:
+        return await asyncio.wrap_future(self.submit(query, region))
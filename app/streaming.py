@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+import config as config
+
+# The final text is retried a few times if Telegram answers 429
+FINAL_EDIT_ATTEMPTS = 3
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Extract Telegram's retry_after from a 429 error, if it is one"""
+    if getattr(error, "error_code", None) != 429:
+        return None
+    result = getattr(error, "result_json", None) or {}
+    return float(result.get("parameters", {}).get("retry_after", 1))
+
+
+def _is_not_modified(error: Exception) -> bool:
+    """Telegram rejects edits that do not change the text; those are harmless"""
+    return "message is not modified" in str(getattr(error, "description", error))
+
+
+class _EditThrottle:
+    """Edit cadence bookkeeping shared by the sync and async editors"""
+
+    def __init__(
+        self,
+        interval: float,
+        min_delta: int,
+        can_edit: Optional[Callable[[], bool]] = None,
+    ):
+        self.interval = interval
+        self.min_delta = min_delta
+        # Partial edits are optional: skip them while the rate limiter is busy
+        self.can_edit = can_edit
+        self.sent_text = ""
+        self.next_edit_at = 0.0
+        self.edits = 0
+        self.pending_text = ""
+
+    def is_due(self, text: str) -> bool:
+        """True if the text changed enough and the edit window is open"""
+        if not text.strip() or text == self.sent_text:
+            return False
+        if time.monotonic() < self.next_edit_at:
+            return False
+        # First chunk goes out right away; later ones are coalesced
+        if self.sent_text and len(text) - len(self.sent_text) < self.min_delta:
+            return False
+        return self.can_edit is None or self.can_edit()
+
+    def sent(self, text: str) -> None:
+        self.sent_text = text
+        self.edits += 1
+        self.next_edit_at = time.monotonic() + self.interval
+
+    def failed(self, error: Exception) -> None:
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            logging.warning(f"Telegram просит подождать {retry_after}с перед правкой")
+            self.next_edit_at = time.monotonic() + retry_after
+        elif _is_not_modified(error):
+            self.sent_text = self.pending_text
+        else:
+            raise error
+
+
+class ThrottledEditor:
+    """Progressively edits a placeholder message, rate-limited and coalesced"""
+
+    def __init__(
+        self,
+        edit: Callable[[str], None],
+        interval: Optional[float] = None,
+        min_delta: Optional[int] = None,
+        can_edit: Optional[Callable[[], bool]] = None,
+    ):
+        self._edit = edit
+        self._throttle = _EditThrottle(
+            config.STREAM_EDIT_INTERVAL if interval is None else interval,
+            config.STREAM_MIN_DELTA_CHARS if min_delta is None else min_delta,
+            can_edit,
+        )
+
+    @property
+    def edits(self) -> int:
+        return self._throttle.edits
+
+    def update(self, text: str) -> None:
+        """Offer the latest partial text; edits only when the window allows"""
+        if self._throttle.is_due(text):
+            self._send(text)
+
+    def finish(self, text: str) -> None:
+        """Make sure the final text ends up in the message"""
+        for _ in range(FINAL_EDIT_ATTEMPTS):
+            if not text.strip() or text == self._throttle.sent_text:
+                return
+            wait = self._throttle.next_edit_at - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._send(text)
+
+    def _send(self, text: str) -> None:
+        self._throttle.pending_text = text
+        try:
+            self._edit(text)
+        except Exception as e:
+            self._throttle.failed(e)
+        else:
+            self._throttle.sent(text)
+
+
+class AsyncThrottledEditor:
+    """Asyncio variant of ThrottledEditor"""
+
+    def __init__(
+        self,
+        edit: Callable[[str], Awaitable[None]],
+        interval: Optional[float] = None,
+        min_delta: Optional[int] = None,
+        can_edit: Optional[Callable[[], bool]] = None,
+    ):
+        self._edit = edit
+        self._throttle = _EditThrottle(
+            config.STREAM_EDIT_INTERVAL if interval is None else interval,
+            config.STREAM_MIN_DELTA_CHARS if min_delta is None else min_delta,
+            can_edit,
+        )
+
+    @property
+    def edits(self) -> int:
+        return self._throttle.edits
+
+    async def update(self, text: str) -> None:
+        """Offer the latest partial text; edits only when the window allows"""
+        if self._throttle.is_due(text):
+            await self._send(text)
+
+    async def finish(self, text: str) -> None:
+        """Make sure the final text ends up in the message"""
+        for _ in range(FINAL_EDIT_ATTEMPTS):
+            if not text.strip() or text == self._throttle.sent_text:
+                return
+            wait = self._throttle.next_edit_at - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._send(text)
+
+    async def _send(self, text: str) -> None:
+        self._throttle.pending_text = text
+        try:
+            await self._edit(text)
+        except Exception as e:
+            self._throttle.failed(e)
+        else:
+            self._throttle.sent(text)
@@ -0,0 +1,203 @@
+"""
+Rolling per-chat summaries, folded in by a background LLM call.
+
+Messages that fall out of a chat's raw history window wait in
+ChatState.unsummarized. Once there are fold_size of them the chat is queued,
+and a worker thread asks the summary LLM to rewrite the chat's summary with
+those messages folded in. Prompts carry the summary, the waiting messages and
+a short raw tail instead of a long raw window. Every new summary is also
+indexed into Qdrant as a document of type "summary", one per chat, replaced
+in place.
+"""
+
+import logging
+import queue
+import threading
+from datetime import datetime
+from typing import Callable, Optional, Set
+
+import backends as backends
+import config as config
+import metrics as metrics
+from chat_state import ChatState, ChatStateStore
+from prompt_templates import summary_template
+
+# Sentinel that stops the worker
+_STOP = object()
+
+
+class ChatSummarizer:
+    """
+    Folds evicted messages into chat summaries in a background thread.
+
+    Args:
+        chats: Store with the chats' summaries and waiting messages.
+        index_document: Queues a document for indexing.
+        fold_size: Waiting messages that trigger a fold.
+        max_words: Length limit given to the LLM.
+        max_pending: Chats that may wait for a fold at once.
+        llm: Returns the LLM for summaries; backends.get_summary_llm by default.
+    """
+
+    def __init__(
+        self,
+        chats: ChatStateStore,
+        index_document: Callable[[dict], None],
+        fold_size: int = 6,
+        max_words: int = 120,
+        max_pending: int = 256,
+        llm: Optional[Callable] = None,
+    ):
+        self.chats = chats
+        self.index_document = index_document
+        self.fold_size = fold_size
+        self.max_words = max_words
+        # Waiting messages kept per chat while the LLM is down or behind
+        self.max_backlog = 4 * fold_size
+        self._llm = llm or backends.get_summary_llm
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_pending)
+        self._queued: Set[int] = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.folds = 0
+        self.failed = 0
+        self.trimmed = 0
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="chat-summarizer", daemon=True
+        )
+        self._thread.start()
+
+    def append(self, chat: ChatState, text: str) -> bool:
+        """
+        Add a message to the raw window, keeping the one it pushes out for the
+        next fold. Call inside ChatStateStore.edit(); True means submit().
+        """
+        if len(chat.messages) == chat.messages.maxlen:
+            chat.unsummarized.append(chat.messages[0])
+        chat.messages.append(text)
+        overflow = len(chat.unsummarized) - self.max_backlog
+        if overflow > 0:
+            del chat.unsummarized[:overflow]
+            chat.unsummarized_dropped += overflow
+            with self._lock:
+                self.trimmed += overflow
+        return len(chat.unsummarized) >= self.fold_size
+
+    def submit(self, chat_id: int) -> None:
+        """Queue a fold for a chat unless one is already waiting"""
+        with self._lock:
+            if chat_id in self._queued:
+                return
+            try:
+                self._queue.put_nowait(chat_id)
+            except queue.Full:
+                # The chat stays over fold_size and is submitted again later
+                return
+            self._queued.add(chat_id)
+
+    def _run(self) -> None:
+        while True:
+            chat_id = self._queue.get()
+            if chat_id is _STOP:
+                return
+            with self._lock:
+                self._queued.discard(chat_id)
+            try:
+                self.fold(chat_id)
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+                logging.exception(f"Не удалось обновить конспект чата {chat_id}")
+
+    def fold(self, chat_id: int) -> bool:
+        """Fold the chat's waiting messages into its summary now"""
+        with self.chats.edit(chat_id) as chat:
+            state = chat
+            batch = list(chat.unsummarized)
+            batch_end = chat.unsummarized_dropped + len(batch)
+            previous = chat.summary
+        if not batch:
+            return False
+        prompt = summary_template.format(
+            dan_username=config.DAN_USERNAME,
+            alex_username=config.ALEX_USERNAME,
+            artem_username=config.ARTEM_USERNAME,
+            summary=previous or "пока пусто",
+            messages="\n".join(batch),
+            max_words=self.max_words,
+        )
+        with metrics.span("summarize", messages=len(batch)):
+            summary = self._llm().complete(prompt).text.strip()
+        if not summary:
+            return False
+        with self.chats.edit(chat_id) as chat:
+            if chat is not state:
+                # Evicted and read back meanwhile; the next fold redoes it
+                return False
+            chat.summary = summary
+            # append() may have trimmed part of the batch while the LLM was
+            # busy; only what is left of it goes, newer messages stay
+            folded = max(batch_end - chat.unsummarized_dropped, 0)
+            del chat.unsummarized[:folded]
+            chat.unsummarized_dropped += folded
+        self.index_document(self.document(chat_id, summary))
+        with self._lock:
+            self.folds += 1
+        return True
+
+    @staticmethod
+    def document(chat_id: int, summary: str) -> dict:
+        """Summary as a memory document; one id per chat, so it is replaced"""
+        now = datetime.now()
+        return {
+            "id": f"{chat_id}_summary",
+            "text": f"Конспект разговора: {summary}",
+            "metadata": {
+                "author": "summary",
+                "date": now.isoformat(),
+                "chat_id": chat_id,
+                "timestamp": int(now.timestamp()),
+                "type": "summary",
+            },
+        }
+
+    def close(self) -> None:
+        """Finish the folds already queued and stop the worker"""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": len(self._queued),
+                "folds": self.folds,
+                "failed": self.failed,
+                "trimmed": self.trimmed,
+            }
+
+
+def create_summarizer(
+    chats: ChatStateStore, index_document: Callable[[dict], None]
+) -> ChatSummarizer:
+    """Build and start a summarizer configured from config.py"""
+    summarizer = ChatSummarizer(
+        chats,
+        index_document,
+        fold_size=config.SUMMARY_FOLD_MESSAGES,
+        max_words=config.SUMMARY_MAX_WORDS,
+        max_pending=config.SUMMARY_QUEUE_SIZE,
+    )
+    summarizer.start()
+    gauge = metrics.REGISTRY.gauge(
+        "ragbot_summarizer", "Rolling chat summaries", ["field"]
+    )
+    for field in ("pending", "folds", "failed", "trimmed"):
+        gauge.set_function(lambda field=field: summarizer.stats()[field], field=field)
+    return summarizer
@@ -0,0 +1,205 @@
+"""
+Message classification for the regular-message hot path.
+
+Commands ("@all", "запомни", "загугли") and passive triggers are classified
+in one call on one lower-cased copy of the message. All words are compiled
+into one regular expression shaped like a trie, so the cost barely grows with
+the number of triggers. Most messages contain none of them: a plain search
+rejects those, and only the rest are scanned for every word. Tables of up
+to SMALL_TABLE words skip the regex: a few plain substring checks are faster
+than one regex call. The bot mention is checked case-sensitively, as
+Telegram writes it. The last result is kept, because the handler filters
+and the handler itself ask about the same message.
+
+Passive triggers come from config.PASSIVE_TRIGGERS or, if TRIGGERS_PATH is
+set, from a JSON file of the same shape that is re-read when it changes.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import config as config
+
+COMMANDS = ("@all", "запомни", "загугли")
+# Up to this many words (commands included) plain `in` checks beat the regex
+SMALL_TABLE = 16
+
+
+class Classification(NamedTuple):
+    mention: bool
+    all: bool
+    remember: bool
+    web_search: bool
+    # First passive trigger in table order found in the text, with its replies
+    trigger: Optional[str]
+    responses: Tuple[str, ...]
+
+
+def trie_pattern(words) -> str:
+    """Regex alternation of words with shared prefixes factored out"""
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: dict) -> str:
+        branches = [
+            re.escape(char) + build(child) for char, child in node.items() if char
+        ]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        if "" not in node:
+            return body
+        # A word ends here and longer ones go on: the rest is optional
+        return f"(?:{body})?" if len(branches) == 1 else f"{body}?"
+
+    return build(trie)
+
+
+class _Table:
+    """Compiled form of one trigger table"""
+
+    def __init__(self, bot_username: str, triggers: Dict[str, List[str]]):
+        self.mention = f"@{bot_username}"
+        keys = [key.lower() for key in triggers if key]
+        # Table order decides between several triggers in one message
+        self.keys = tuple(dict.fromkeys(keys))
+        self.rank = {key: i for i, key in enumerate(keys)}
+        self.responses = {
+            key.lower(): tuple(replies) for key, replies in triggers.items()
+        }
+        self.words = tuple(dict.fromkeys([*COMMANDS, *keys]))
+        self.small = len(self.words) <= SMALL_TABLE
+        pattern = trie_pattern(self.words)
+        # A bare pattern keeps the engine's literal prefix scan, a lookahead
+        # does not: search() with it is the cheap "anything at all?" check
+        self.regex = re.compile(pattern)
+        # Overlapping matches: the longest word at every position; shorter
+        # words that are its prefixes occur there too
+        self.overlapping = re.compile(f"(?=({pattern}))")
+        self.implied = {
+            word: {other for other in self.words if word.startswith(other)}
+            for word in self.words
+        }
+        self.results: Dict[tuple, Classification] = {}
+        self.nothing = {
+            mention: Classification(mention, False, False, False, None, ())
+            for mention in (False, True)
+        }
+
+    def classify(self, text: str) -> Classification:
+        mention = self.mention in text
+        lowered = text.lower()
+        if self.small:
+            return self._classify_small(mention, lowered)
+        first = self.regex.search(lowered)
+        if first is None:
+            return self.nothing[mention]
+        found = set()
+        for word in self.overlapping.findall(lowered, first.start()):
+            found |= self.implied[word]
+        ranked = found & self.rank.keys()
+        trigger = min(ranked, key=self.rank.__getitem__) if ranked else None
+        return Classification(
+            mention,
+            "@all" in found,
+            "запомни" in found,
+            "загугли" in found,
+            trigger,
+            self.responses.get(trigger, ()),
+        )
+
+    def _classify_small(self, mention: bool, lowered: str) -> Classification:
+        all_ = "@all" in lowered
+        remember = "запомни" in lowered
+        web_search = "загугли" in lowered
+        for trigger in self.keys:
+            if trigger in lowered:
+                break
+        else:
+            trigger = None
+        # A small table has few distinct results: build each one once
+        key = (mention, all_, remember, web_search, trigger)
+        result = self.results.get(key)
+        if result is None:
+            result = Classification(*key, self.responses.get(trigger, ()))
+            self.results[key] = result
+        return result
+
+
+class TriggerMatcher:
+    """
+    Classifies messages in one scan; reloads the trigger file when it changes.
+
+    Args:
+        bot_username: Username without "@", for the mention check.
+        triggers: Trigger -> replies; config.PASSIVE_TRIGGERS by default.
+        path: JSON file with triggers that overrides the table.
+        reload_interval: Seconds between checks of the file's mtime.
+    """
+
+    def __init__(
+        self,
+        bot_username: str,
+        triggers: Optional[Dict[str, List[str]]] = None,
+        path: str = "",
+        reload_interval: float = 5.0,
+    ):
+        self.bot_username = bot_username
+        self.default_triggers = (
+            config.PASSIVE_TRIGGERS if triggers is None else triggers
+        )
+        self.path = path
+        self.reload_interval = reload_interval
+        self._mtime: Optional[float] = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self._install(self.default_triggers)
+        if path:
+            self.reload()
+
+    def _install(self, triggers: Dict[str, List[str]]) -> None:
+        # One attribute swap: readers see either the old or the new table
+        self._table = _Table(self.bot_username, triggers)
+        self._last: Tuple[Optional[str], Optional[Classification]] = (None, None)
+
+    def reload(self) -> bool:
+        """Re-read the trigger file if it changed; returns True if reloaded"""
+        with self._lock:
+            self._next_check = time.monotonic() + self.reload_interval
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                return False
+            if mtime == self._mtime:
+                return False
+            # A broken file is reported once, not at every check
+            self._mtime = mtime
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    triggers = json.load(f)
+                self._install(triggers)
+            except (OSError, ValueError, TypeError, AttributeError):
+                logging.exception(f"Не удалось загрузить триггеры из {self.path}")
+                return False
+            logging.info(f"Загружено {len(triggers)} триггеров из {self.path}")
+            return True
+
+    def classify(self, text: str) -> Classification:
+        if self.path and time.monotonic() >= self._next_check:
+            self.reload()
+        # Filters and handler ask about the same message back to back
+        last_text, last = self._last
+        if text == last_text:
+            return last
+        result = self._table.classify(text)
+        self._last = (text, result)
+        return result
@@ -0,0 +1,288 @@
+"""
+Webhook mode: an HTTP ingress and chat-sharded worker processes.
+
+    python webhook.py            # ingress + WEBHOOK_WORKERS workers
+    python webhook.py ingress    # only the ingress (workers run elsewhere)
+    python webhook.py worker     # one worker for WORKER_SHARD
+
+The ingress checks the secret Telegram sends with every update, reads the
+chat id and pushes the raw update onto that chat's shard of the work queue.
+It does no other work, so it answers Telegram in well under a millisecond of
+CPU. Each worker is a separate process with its own RagBot: it takes updates
+of its shard and runs them through the usual handlers. A chat always lands on
+the same worker, which keeps its history, and embedding in one worker does
+not hold the GIL of the ingress or of other workers.
+
+With the local queue the workers must be started by this process; with the
+Redis queue ingress and workers may run in different containers.
+"""
+
+import argparse
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+
+import config as config
+import metrics as metrics
+from work_queue import create_work_queue, shard_of
+
+logging.basicConfig(level=logging.INFO)
+
+WEBHOOK_UPDATES = metrics.REGISTRY.counter(
+    "ragbot_webhook_updates_total", "Webhook requests by outcome", ["outcome"]
+)
+
+# Update fields that carry a message, in the order Telegram documents them
+MESSAGE_FIELDS = (
+    "message",
+    "edited_message",
+    "channel_post",
+    "edited_channel_post",
+    "business_message",
+)
+
+
+def update_chat_id(update: dict) -> int:
+    """Chat an update belongs to; updates without a chat go by user, or to 0"""
+    for field in MESSAGE_FIELDS:
+        if field in update:
+            return update[field]["chat"]["id"]
+    callback = update.get("callback_query")
+    if callback and callback.get("message"):
+        return callback["message"]["chat"]["id"]
+    for value in update.values():
+        if isinstance(value, dict):
+            if isinstance(value.get("chat"), dict):
+                return value["chat"]["id"]
+            if isinstance(value.get("from"), dict):
+                return value["from"]["id"]
+    return 0
+
+
+class WebhookIngress:
+    """
+    Validates webhook requests and enqueues their updates.
+
+    Args:
+        work_queue: LocalWorkQueue or RedisWorkQueue.
+        shards: Number of worker shards.
+        secret: Expected X-Telegram-Bot-Api-Secret-Token; empty skips the check.
+        path: URL path Telegram posts to.
+        max_body: Largest accepted request body in bytes.
+    """
+
+    def __init__(
+        self,
+        work_queue,
+        shards: int,
+        secret: str = "",
+        path: str = "/telegram",
+        max_body: int = 1 << 20,
+    ):
+        self.work_queue = work_queue
+        self.shards = shards
+        self.secret = secret
+        self.path = path
+        self.max_body = max_body
+
+    def handle(self, path: str, headers, body: bytes) -> Tuple[int, str]:
+        """(HTTP status, outcome) for one request"""
+        if path.split("?")[0] != self.path:
+            return 404, "not_found"
+        token = headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if self.secret and not hmac.compare_digest(token, self.secret):
+            return 403, "forbidden"
+        try:
+            update = json.loads(body)
+            chat_id = update_chat_id(update)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return 400, "invalid"
+        if not isinstance(update.get("update_id"), int):
+            return 400, "invalid"
+        shard = shard_of(chat_id, self.shards)
+        if not self.work_queue.put(shard, body.decode("utf-8")):
+            # Telegram retries the update later; the worker has to catch up
+            return 503, "queue_full"
+        return 200, "queued"
+
+    def server(self, host: str, port: int) -> ThreadingHTTPServer:
+        ingress = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    status, outcome = 400, "invalid"
+                elif length > ingress.max_body:
+                    status, outcome = 413, "too_large"
+                else:
+                    status, outcome = ingress.handle(
+                        self.path, self.headers, self.rfile.read(length)
+                    )
+                WEBHOOK_UPDATES.inc(outcome=outcome)
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                # One line per update would flood the log
+                pass
+
+        return ThreadingHTTPServer((host, port), Handler)
+
+
+def register_webhook() -> None:
+    """Point Telegram at WEBHOOK_URL; skipped when it is not set"""
+    if not config.WEBHOOK_URL:
+        logging.warning("WEBHOOK_URL не задан, вебхук в Telegram не регистрирую")
+        return
+    from telebot import TeleBot
+
+    TeleBot(config.TELEGRAM_TOKEN).set_webhook(
+        url=config.WEBHOOK_URL,
+        secret_token=config.WEBHOOK_SECRET or None,
+        max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+    )
+    logging.info(f"Вебхук зарегистрирован: {config.WEBHOOK_URL}")
+
+
+def run_worker(shard: int, work_queue=None, metrics_port: Optional[int] = None):
+    """Process updates of one shard until SIGTERM and an empty shard"""
+    # Settings of this worker process only
+    config.BOT_MODE = "webhook"
+    config.WORKER_SHARD = shard
+    # The Bot API flood limit is per bot: every worker gets its share
+    config.TELEGRAM_RATE = config.TELEGRAM_RATE / config.WEBHOOK_WORKERS
+    if config.EMBED_CACHE_DIR:
+        # A worker only sees its own chats, so it keeps its own embedding cache
+        # and its share of the disk budget
+        config.EMBED_CACHE_DIR = os.path.join(config.EMBED_CACHE_DIR, f"worker-{shard}")
+        config.EMBED_CACHE_DISK_MAX_MB /= config.WEBHOOK_WORKERS
+    import backends as backends
+    from bot import RagBot
+    from telebot.types import Update
+
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stopping.set())
+    metrics.start_metrics_server(metrics_port)
+    if config.WARM_UP_MODELS:
+        backends.warm_up()
+    work_queue = work_queue or create_work_queue()
+    bot = RagBot(
+        token=config.TELEGRAM_TOKEN,
+        bot_username=config.BOT_USERNAME,
+        history_size=config.N_LAST_MESSAGES,
+    )
+    # Handlers only queue work on the scheduler: running them in this loop
+    # keeps updates of a chat in order and leaves nothing behind on shutdown
+    bot.bot.threaded = False
+    logging.info(f"Воркер {shard} из {config.WEBHOOK_WORKERS} запущен")
+    try:
+        while True:
+            item = work_queue.get(shard, timeout=1.0)
+            if item is None:
+                # The ingress stops first, so an empty shard means nothing is left
+                if stopping.is_set():
+                    break
+                continue
+            try:
+                bot.bot.process_new_updates([Update.de_json(item)])
+            except Exception:
+                logging.exception(f"Воркер {shard} не смог обработать апдейт")
+    finally:
+        bot.close()
+
+
+def run_ingress(work_queue) -> Tuple[ThreadingHTTPServer, threading.Thread]:
+    """Serve the webhook from a background thread"""
+    ingress = WebhookIngress(
+        work_queue,
+        config.WEBHOOK_WORKERS,
+        secret=config.WEBHOOK_SECRET,
+        path=config.WEBHOOK_PATH,
+        max_body=config.WEBHOOK_MAX_BODY,
+    )
+    server = ingress.server(config.WEBHOOK_HOST, config.WEBHOOK_PORT)
+    thread = threading.Thread(
+        target=server.serve_forever, name="webhook-http", daemon=True
+    )
+    thread.start()
+    logging.info(
+        f"Вебхук слушает :{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}, "
+        f"воркеров: {config.WEBHOOK_WORKERS}"
+    )
+    return server, thread
+
+
+def main():
+    """CLI entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "role", nargs="?", default="all", choices=("all", "ingress", "worker")
+    )
+    args = parser.parse_args()
+    config.BOT_MODE = "webhook"
+    if args.role == "worker":
+        run_worker(config.WORKER_SHARD)
+        return
+
+    local = config.WORK_QUEUE_BACKEND == "local"
+    if args.role == "ingress" and local:
+        parser.error("с локальной очередью воркеры запускает сам ингресс (role all)")
+    if args.role == "all" and config.REDIS_URL.startswith("memory://") and not local:
+        parser.error("REDIS_URL=memory:// не виден другим процессам")
+    if args.role == "all":
+        # Workers would race to create the collection on a fresh install
+        import db as db
+
+        client = db.get_qdrant_client()
+        db.ensure_collection(client, config.QDRANT_COLLECTION)
+        db.backfill_chat_payload(client, config.QDRANT_COLLECTION)
+    # Workers are started before any thread of this process, and without fork
+    context = multiprocessing.get_context("spawn")
+    work_queue = create_work_queue(context)
+    workers = []
+    if args.role == "all":
+        for shard in range(config.WEBHOOK_WORKERS):
+            # The ingress serves METRICS_PORT, worker i the port i + 1 above it
+            port = config.METRICS_PORT + 1 + shard if config.METRICS_PORT else 0
+            worker = context.Process(
+                target=run_worker,
+                # Redis workers connect on their own
+                args=(shard, work_queue if local else None, port),
+                name=f"bot-worker-{shard}",
+            )
+            worker.start()
+            workers.append(worker)
+
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stopping.set())
+    metrics.start_metrics_server()
+    server, _ = run_ingress(work_queue)
+    register_webhook()
+    while not stopping.wait(1.0):
+        for worker in workers:
+            if not worker.is_alive():
+                logging.error(f"{worker.name} завершился с кодом {worker.exitcode}")
+                stopping.set()
+    logging.info("Останавливаю вебхук, воркеры дорабатывают очередь")
+    server.shutdown()
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    main()
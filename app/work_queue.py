@@ -0,0 +1,172 @@
+"""
+Work queue between the webhook ingress and the bot workers.
+
+Updates are sharded by chat id: every update of a chat goes to the same
+shard and so to the same worker, which keeps that chat's history in memory.
+Items are JSON strings of Telegram updates.
+
+LocalWorkQueue is one multiprocessing queue per shard, for an ingress and
+workers started from one process. RedisWorkQueue is one Redis list per shard
+and works across containers; REDIS_URL=memory:// swaps Redis for the
+in-process MemoryRedis stand-in.
+"""
+
+import math
+import multiprocessing
+import queue
+import threading
+from collections import defaultdict, deque
+from typing import Callable, Deque, Dict, Optional
+
+import config as config
+import metrics as metrics
+
+
+def shard_of(chat_id: int, shards: int) -> int:
+    """Shard of a chat; Python's modulo is non-negative for negative group ids"""
+    return chat_id % shards
+
+
+def worker_owns() -> Optional[Callable[[int], bool]]:
+    """Chats this process serves as one of several webhook workers; None: all"""
+    if config.BOT_MODE != "webhook" or config.WEBHOOK_WORKERS <= 1:
+        return None
+    return lambda chat_id: (
+        shard_of(chat_id, config.WEBHOOK_WORKERS) == config.WORKER_SHARD
+    )
+
+
+class LocalWorkQueue:
+    """
+    Bounded multiprocessing queues, one per shard.
+
+    Args:
+        shards: Number of shards (worker processes).
+        max_size: Items a shard may hold before put() refuses more.
+        context: multiprocessing context the workers are started with.
+    """
+
+    def __init__(self, shards: int, max_size: int = 10000, context=None):
+        context = context or multiprocessing.get_context()
+        self.shards = shards
+        self._queues = [context.Queue(max_size) for _ in range(shards)]
+
+    def put(self, shard: int, item: str) -> bool:
+        """Enqueue an item; False if the shard is full"""
+        try:
+            self._queues[shard].put_nowait(item)
+        except queue.Full:
+            return False
+        return True
+
+    def get(self, shard: int, timeout: float = 1.0) -> Optional[str]:
+        """Next item of a shard, or None after timeout seconds"""
+        try:
+            return self._queues[shard].get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def depth(self, shard: int) -> int:
+        try:
+            return self._queues[shard].qsize()
+        except NotImplementedError:
+            # macOS has no sem_getvalue
+            return -1
+
+
+class MemoryRedis:
+    """In-process stand-in for the few Redis list commands the queue uses"""
+
+    def __init__(self):
+        self._lists: Dict[str, Deque[bytes]] = defaultdict(deque)
+        self._changed = threading.Condition()
+
+    def llen(self, key: str) -> int:
+        with self._changed:
+            return len(self._lists[key])
+
+    def lpush(self, key: str, value) -> int:
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        with self._changed:
+            self._lists[key].appendleft(value)
+            self._changed.notify_all()
+            return len(self._lists[key])
+
+    def brpop(self, key: str, timeout: float = 0):
+        with self._changed:
+            if not self._changed.wait_for(
+                lambda: self._lists[key], timeout=timeout or None
+            ):
+                return None
+            return key.encode("utf-8"), self._lists[key].pop()
+
+
+class RedisWorkQueue:
+    """
+    Redis lists, one per shard: LPUSH from the ingress, BRPOP in the workers.
+
+    Args:
+        client: redis.Redis or anything with llen/lpush/brpop.
+        shards: Number of shards.
+        max_size: Items a shard may hold before put() refuses more.
+        prefix: Key prefix; shard i lives in "<prefix>:<i>".
+    """
+
+    def __init__(
+        self,
+        client,
+        shards: int,
+        max_size: int = 10000,
+        prefix: str = "ragbot:updates",
+    ):
+        self.client = client
+        self.shards = shards
+        self.max_size = max_size
+        self.prefix = prefix
+
+    def _key(self, shard: int) -> str:
+        return f"{self.prefix}:{shard}"
+
+    def put(self, shard: int, item: str) -> bool:
+        # Not atomic with the push: the cap may be overshot by concurrent puts
+        if self.client.llen(self._key(shard)) >= self.max_size:
+            return False
+        self.client.lpush(self._key(shard), item)
+        return True
+
+    def get(self, shard: int, timeout: float = 1.0) -> Optional[str]:
+        # BRPOP takes whole seconds, and 0 would block forever
+        popped = self.client.brpop(self._key(shard), timeout=max(1, math.ceil(timeout)))
+        if popped is None:
+            return None
+        value = popped[1]
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    def depth(self, shard: int) -> int:
+        return int(self.client.llen(self._key(shard)))
+
+
+def create_work_queue(context=None):
+    """Work queue configured from config.py, with a depth gauge per shard"""
+    shards = config.WEBHOOK_WORKERS
+    if config.WORK_QUEUE_BACKEND == "local":
+        work_queue = LocalWorkQueue(shards, config.WORK_QUEUE_MAX_SIZE, context)
+    elif config.WORK_QUEUE_BACKEND == "redis":
+        if config.REDIS_URL.startswith("memory://"):
+            client = MemoryRedis()
+        else:
+            import redis
+
+            client = redis.Redis.from_url(config.REDIS_URL)
+        work_queue = RedisWorkQueue(
+            client, shards, config.WORK_QUEUE_MAX_SIZE, config.WORK_QUEUE_PREFIX
+        )
+    else:
+        raise ValueError(f"Неизвестная очередь {config.WORK_QUEUE_BACKEND!r}")
+    gauge = metrics.REGISTRY.gauge(
+        "ragbot_work_queue_depth", "Updates waiting for a worker", ["shard"]
+    )
+    for shard in range(shards):
+        gauge.set_function(lambda shard=shard: work_queue.depth(shard), shard=shard)
+    return work_queue